@@ -0,0 +1,505 @@
+#!/usr/bin/env python3
+
+"""
+LoRa airtime of received packets, and the channel utilisation it adds up to.
+
+Every packet heard is charged its time on air, computed from its raw length
+and the modulation of the radio profile that received it (spreading factor,
+bandwidth, coding rate, preamble; see RADIO_PROFILES, which common.py's
+create_radio configures the radios from). Airtime goes into a ring of
+fixed-width buckets, per bucket in total and per transmitting node: the
+last repeater in a flood path, or the originator when it was heard
+directly. Over each configured window that gives
+
+    utilisation = airtime heard / window length
+
+and each node's share of it. This counts what the receiver could hear;
+collisions and packets below its sensitivity are not in it. With several
+--source radios each has its own ring and level, as they may listen on
+different channels and would otherwise count shared packets twice.
+
+When utilisation over the shortest window crosses --airtime-thresholds the
+congestion level goes to "busy" and then "congested"; it drops back only
+below 80% of the threshold, so it does not flap. Clients ask with
+{"type": "airtime"} for a report and then get one every interval, plus a
+{"type": "congestion"} frame when a level changes.
+"""
+
+import asyncio
+import json
+import logging
+import math
+import time
+from typing import Any, NamedTuple
+
+logger = logging.getLogger("airtime")
+
+DEFAULT_WINDOWS = "60,900,3600"
+DEFAULT_BUCKET = 10.0
+DEFAULT_THRESHOLDS = "0.1,0.25"
+DEFAULT_UPDATE_INTERVAL = 5.0
+DEFAULT_TOP_NODES = 20
+
+LEVELS = ("ok", "busy", "congested")
+# A level is left once utilisation falls below this fraction of its threshold.
+_HYSTERESIS = 0.8
+
+_FLOOD_ROUTES = (0x00, 0x01)
+_TRANSPORT_ROUTES = (0x00, 0x03)
+_ADDRESSED_TYPES = (0x00, 0x01, 0x02, 0x07, 0x08)
+_PAYLOAD_TYPE_ADVERT = 0x04
+
+UNKNOWN_NODE = "unknown"
+
+
+class LoRaProfile(NamedTuple):
+    frequency: int
+    spreading_factor: int
+    bandwidth: int
+    # 5..8 for 4/5..4/8, as the SX1262 driver takes it.
+    coding_rate: int
+    preamble_length: int
+
+    def describe(self) -> dict[str, Any]:
+        return {
+            "frequency": self.frequency,
+            "sf": self.spreading_factor,
+            "bw": self.bandwidth,
+            "cr": f"4/{self.coding_rate}",
+            "preamble": self.preamble_length,
+        }
+
+
+# Frequency and modulation of each --radio-type; common.create_radio sets the radios up with these.
+RADIO_PROFILES = {
+    # EU: 869.618 MHz, SF8, 62.5 kHz, CR 4/8
+    "waveshare": LoRaProfile(869_618_000, 8, 62_500, 8, 17),
+    "uconsole": LoRaProfile(869_618_000, 8, 62_500, 8, 17),
+    # US: 910.525 MHz, SF7, 62.5 kHz, CR 4/5
+    "meshadv-mini": LoRaProfile(910_525_000, 7, 62_500, 5, 17),
+    # The preamble is not configured over KISS; assumed as for the SX1262 profiles.
+    "kiss-tnc": LoRaProfile(869_618_000, 8, 62_500, 8, 17),
+}
+# For radios without a profile of their own: recordings, simulation, companions.
+DEFAULT_PROFILE = "uconsole"
+
+
+def time_on_air(length: int, profile: LoRaProfile) -> float:
+    """Seconds on air of a `length`-byte packet, explicit header and CRC on (SX126x datasheet 6.1.4)."""
+    sf = profile.spreading_factor
+    symbol = (1 << sf) / profile.bandwidth
+    # The driver turns on low data rate optimization for symbols of 16 ms and longer.
+    ldro = symbol >= 0.016
+    cr = profile.coding_rate - 4 if profile.coding_rate > 4 else profile.coding_rate
+    if sf < 7:
+        preamble = profile.preamble_length + 6.25
+        bits = 8 * length + 16 - 4 * sf + 20
+        per_block = 4 * sf
+    else:
+        preamble = profile.preamble_length + 4.25
+        bits = 8 * length + 16 - 4 * sf + 8 + 20
+        per_block = 4 * (sf - 2) if ldro else 4 * sf
+    payload = 8 + max(math.ceil(bits / per_block), 0) * (cr + 4)
+    return (preamble + payload) * symbol
+
+
+def parse_profile(spec: str) -> LoRaProfile:
+    """A profile name, or "sf,bandwidth_khz,cr,preamble" e.g. "8,62.5,8,17"."""
+    if spec in RADIO_PROFILES:
+        return RADIO_PROFILES[spec]
+    try:
+        sf, bw, cr, preamble = spec.split(",")
+        profile = LoRaProfile(0, int(sf), int(float(bw) * 1000), int(cr), int(preamble))
+    except ValueError:
+        raise ValueError(
+            f"invalid airtime profile {spec!r}: use one of {', '.join(RADIO_PROFILES)} or sf,bw_khz,cr,preamble"
+        ) from None
+    if not 5 <= profile.spreading_factor <= 12 or profile.bandwidth <= 0 or not 1 <= profile.coding_rate <= 8:
+        raise ValueError(f"invalid airtime profile {spec!r}")
+    return profile
+
+
+def transmitter(raw: bytes) -> str | None:
+    """Hex hash of the node whose transmission this was: the last flood hop, or the originator heard directly."""
+    if len(raw) < 2:
+        return None
+    header = raw[0]
+    route_type = header & 0x03
+    if route_type not in _FLOOD_ROUTES:
+        # A direct path lists the hops still ahead, not who sent it.
+        return None
+    idx = 5 if route_type in _TRANSPORT_ROUTES else 1
+    if idx >= len(raw):
+        return None
+    path_len = raw[idx]
+    hash_size = (path_len >> 6) + 1
+    hops = path_len & 0x3F
+    idx += 1
+    if hops:
+        end = idx + hops * hash_size
+        return raw[end - hash_size : end].hex() if end <= len(raw) else None
+    payload = raw[idx:]
+    payload_type = (header >> 2) & 0x0F
+    if payload_type == _PAYLOAD_TYPE_ADVERT:
+        return payload[:1].hex() or None
+    if payload_type in _ADDRESSED_TYPES:
+        return payload[1:2].hex() or None
+    return None
+
+
+class _Bucket:
+    __slots__ = ("start", "airtime", "packets", "nodes")
+
+    def __init__(self):
+        self.reset(-1.0)
+
+    def reset(self, start: float) -> None:
+        self.start = start
+        self.airtime = 0.0
+        self.packets = 0
+        self.nodes: dict[str, float] = {}
+
+
+class _Channel:
+    """The bucket ring and congestion level of one receiver: the single radio, or one --source."""
+
+    def __init__(self, source: str | None, profile: LoRaProfile, slots: int):
+        self.source = source
+        self.profile = profile
+        self.buckets = [_Bucket() for _ in range(slots)]
+        self.level = 0
+        # Utilisation above 1.0 was warned about and has not dropped back yet.
+        self.overfull = False
+
+        self.packets = 0
+        self.airtime = 0.0
+        self.level_changes = 0
+
+
+class AirtimeMeter:
+    """Airtime per bucket for the longest window, and the congestion level over the shortest, per receiver.
+
+    Each source is metered on its own: sources may listen on different
+    channels, and a packet heard by two of them was only on the air once.
+    """
+
+    def __init__(
+        self,
+        profile: LoRaProfile,
+        windows: list[float],
+        bucket: float = DEFAULT_BUCKET,
+        thresholds: tuple[float, float] = (0.1, 0.25),
+    ):
+        if not windows or bucket <= 0 or min(windows) < bucket:
+            raise ValueError("airtime windows must be at least one bucket long")
+        self.profile = profile
+        self.windows = sorted(windows)
+        self.bucket = bucket
+        self.thresholds = thresholds
+        self._slots = math.ceil(self.windows[-1] / bucket) + 1
+        # Source id (None for the single radio) -> its channel, in the order first heard.
+        self._channels: dict[str | None, _Channel] = {}
+        # Source id -> profile, for sources with a radio of their own.
+        self._source_profiles: dict[str, LoRaProfile] = {}
+        # Seconds on air by packet length, per profile.
+        self._tables: dict[LoRaProfile, list[float]] = {}
+        self._started = time.time()
+        self.name = "airtime"
+
+    @property
+    def level(self) -> int:
+        """The highest congestion level of any receiver."""
+        return max((channel.level for channel in self._channels.values()), default=0)
+
+    def set_source_profiles(self, profiles: dict[str, LoRaProfile]) -> None:
+        self._source_profiles = dict(profiles)
+        # Known radios are reported from the start, also while they hear nothing.
+        for source in profiles:
+            self._channel(source)
+
+    def _channel(self, source: str | None) -> _Channel:
+        channel = self._channels.get(source)
+        if channel is None:
+            profile = self._source_profiles.get(source, self.profile) if source is not None else self.profile
+            channel = self._channels[source] = _Channel(source, profile, self._slots)
+        return channel
+
+    def time_on_air(self, length: int, source: str | None = None) -> float:
+        profile = self._source_profiles.get(source, self.profile) if source is not None else self.profile
+        return self._time_on_air(length, profile)
+
+    def _time_on_air(self, length: int, profile: LoRaProfile) -> float:
+        table = self._tables.get(profile)
+        if table is None:
+            table = self._tables[profile] = [time_on_air(n, profile) for n in range(256)]
+        return table[length] if length < 256 else time_on_air(length, profile)
+
+    def observe(self, raw: bytes, ts: float, source: str | None = None) -> float:
+        """Charge one packet to the receiver that heard it; returns its time on air in seconds."""
+        channel = self._channel(source)
+        airtime = self._time_on_air(len(raw), channel.profile)
+        period = math.floor(ts / self.bucket)
+        bucket = channel.buckets[period % self._slots]
+        start = period * self.bucket
+        if bucket.start != start:
+            if bucket.start > start:
+                # Older than the ring reaches.
+                return airtime
+            bucket.reset(start)
+        bucket.airtime += airtime
+        bucket.packets += 1
+        node = transmitter(raw) or UNKNOWN_NODE
+        bucket.nodes[node] = bucket.nodes.get(node, 0.0) + airtime
+        channel.packets += 1
+        channel.airtime += airtime
+        return airtime
+
+    def window(
+        self, seconds: float, now: float | None = None, top: int = DEFAULT_TOP_NODES, source: str | None = None
+    ) -> dict[str, Any]:
+        """Utilisation and per-node airtime one receiver heard over the last `seconds`, at bucket granularity."""
+        now = now if now is not None else time.time()
+        newest = math.floor(now / self.bucket) * self.bucket
+        oldest = newest - (math.ceil(seconds / self.bucket) - 1) * self.bucket
+        # Only the time the meter has been running counts, so a fresh start does not read as idle.
+        span = max(self.bucket, now - max(oldest, self._started))
+        airtime = 0.0
+        packets = 0
+        nodes: dict[str, float] = {}
+        channel = self._channels.get(source)
+        for bucket in channel.buckets if channel is not None else ():
+            if oldest <= bucket.start <= newest:
+                airtime += bucket.airtime
+                packets += bucket.packets
+                for node, value in bucket.nodes.items():
+                    nodes[node] = nodes.get(node, 0.0) + value
+        ranked = sorted(nodes.items(), key=lambda item: item[1], reverse=True)[:top]
+        return {
+            "window": seconds,
+            "span": round(span, 1),
+            "packets": packets,
+            "airtime": round(airtime, 3),
+            "utilisation": round(airtime / span, 4),
+            "nodes": [
+                {"node": node, "airtime": round(value, 3), "share": round(value / airtime, 4) if airtime else 0.0}
+                for node, value in ranked
+            ],
+            "node_count": len(nodes),
+        }
+
+    def check(self, now: float | None = None) -> list[dict[str, Any]]:
+        """Re-evaluate each receiver's congestion level over the shortest window; congestion frames for changes."""
+        now = now if now is not None else time.time()
+        frames = []
+        for channel in self._channels.values():
+            utilisation = self.window(self.windows[0], now, top=0, source=channel.source)["utilisation"]
+            self._check_overfull(channel, utilisation)
+            frame = self._check_level(channel, utilisation, now)
+            if frame is not None:
+                frames.append(frame)
+        return frames
+
+    def _check_overfull(self, channel: _Channel, utilisation: float) -> None:
+        # A radio cannot hear more airtime than the window is long; more means a wrong profile or synthetic traffic.
+        if utilisation > 1.0 and not channel.overfull:
+            channel.overfull = True
+            logger.warning(
+                f"Airtime{_on(channel.source)} adds up to {utilisation:.1%} of the last {self.windows[0]:g}s, "
+                f"more than one radio can hear; check --airtime-profile against {channel.profile.describe()}"
+            )
+        elif utilisation <= 1.0:
+            channel.overfull = False
+
+    def _check_level(self, channel: _Channel, utilisation: float, now: float) -> dict[str, Any] | None:
+        level = channel.level
+        while level < len(self.thresholds) and utilisation >= self.thresholds[level]:
+            level += 1
+        while level > 0 and utilisation < self.thresholds[level - 1] * _HYSTERESIS:
+            level -= 1
+        if level == channel.level:
+            return None
+        previous, channel.level = channel.level, level
+        channel.level_changes += 1
+        message = (
+            f"Channel utilisation{_on(channel.source)} {utilisation:.1%} over {self.windows[0]:g}s: "
+            f"{LEVELS[previous]} -> {LEVELS[level]}"
+        )
+        if level > previous:
+            logger.warning(message)
+        else:
+            logger.info(message)
+        return {
+            "type": "congestion",
+            "source": channel.source,
+            "level": LEVELS[level],
+            "previous": LEVELS[previous],
+            "utilisation": utilisation,
+            "window": self.windows[0],
+            "thresholds": list(self.thresholds),
+            "ts": now,
+        }
+
+    def report(self, now: float | None = None, top: int = DEFAULT_TOP_NODES) -> dict[str, Any]:
+        return {
+            "type": "airtime",
+            "level": LEVELS[self.level],
+            "thresholds": list(self.thresholds),
+            "sources": [
+                {
+                    "source": channel.source,
+                    "profile": channel.profile.describe(),
+                    "level": LEVELS[channel.level],
+                    "windows": [self.window(seconds, now, top, channel.source) for seconds in self.windows],
+                }
+                for channel in self._channels.values()
+            ],
+        }
+
+    def stats(self) -> dict[str, Any]:
+        # Keyed as in SourceSet.stats: "<source>_<key>", bare for the single radio.
+        out: dict[str, Any] = {}
+        for channel in self._channels.values():
+            prefix = "" if channel.source is None else f"{channel.source}_"
+            out[f"{prefix}packets"] = channel.packets
+            out[f"{prefix}airtime_s"] = round(channel.airtime, 3)
+            out[f"{prefix}level"] = channel.level
+            for seconds in self.windows:
+                out[f"{prefix}utilisation_{seconds:g}s"] = self.window(seconds, top=0, source=channel.source)[
+                    "utilisation"
+                ]
+            out[f"{prefix}level_changes"] = channel.level_changes
+        return out
+
+
+def _on(source: str | None) -> str:
+    return "" if source is None else f" on source {source}"
+
+
+class AirtimeFeed:
+    """Checks the congestion level each interval and sends reports to the subscribed clients."""
+
+    def __init__(self, meter: AirtimeMeter, interval: float = DEFAULT_UPDATE_INTERVAL):
+        self.meter = meter
+        self.interval = interval
+        # id(sender) -> (sender, top nodes wanted)
+        self._subscribers: dict[int, tuple[Any, int]] = {}
+        self._task: asyncio.Task | None = None
+
+    def subscribe(self, sender, top: int = DEFAULT_TOP_NODES) -> None:
+        self._subscribers[id(sender)] = (sender, top)
+
+    def unsubscribe(self, sender) -> None:
+        self._subscribers.pop(id(sender), None)
+
+    def flush(self) -> None:
+        # The levels are tracked also without subscribers, for the log and /metrics.
+        congestion = self.meter.check()
+        for key, (sender, _top) in list(self._subscribers.items()):
+            if getattr(sender, "closed", False):
+                del self._subscribers[key]
+        if not self._subscribers:
+            return
+        now = time.time()
+        congestion_frames = [json.dumps(frame) for frame in congestion]
+        frames: dict[int, str] = {}
+        for sender, top in self._subscribers.values():
+            for congestion_frame in congestion_frames:
+                sender.enqueue(congestion_frame)
+            frame = frames.get(top)
+            if frame is None:
+                frame = frames[top] = json.dumps(self.meter.report(now, top))
+            sender.enqueue(frame)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Sending airtime reports failed: {e}")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+def register_airtime_commands(stream, feed: AirtimeFeed) -> None:
+    """Client message {"type": "airtime"}: a report, then one per interval unless "subscribe" is false."""
+
+    def airtime(sender, message):
+        try:
+            top = max(0, int(message.get("top", DEFAULT_TOP_NODES)))
+        except (TypeError, ValueError):
+            sender.enqueue(json.dumps({"type": "error", "request": "airtime", "message": "top must be a number"}))
+            return
+        if message.get("subscribe", True):
+            feed.subscribe(sender, top)
+        else:
+            feed.unsubscribe(sender)
+        sender.enqueue(json.dumps(feed.meter.report(top=top)))
+
+    stream.register_command("airtime", airtime)
+
+
+def add_airtime_arguments(parser) -> None:
+    """Register the airtime options on an argparse parser."""
+    parser.add_argument(
+        "--airtime-profile",
+        default=None,
+        help=f"LoRa profile for airtime: {', '.join(RADIO_PROFILES)} or sf,bw_khz,cr,preamble "
+        f"(default: the --radio-type's, else {DEFAULT_PROFILE}; unless given, --source radios use their kind's)",
+    )
+    parser.add_argument(
+        "--airtime-windows",
+        default=DEFAULT_WINDOWS,
+        help=f"Channel utilisation windows in seconds, comma-separated, empty to disable (default: {DEFAULT_WINDOWS})",
+    )
+    parser.add_argument(
+        "--airtime-bucket",
+        type=float,
+        default=DEFAULT_BUCKET,
+        help=f"Seconds per airtime bucket (default: {DEFAULT_BUCKET:g})",
+    )
+    parser.add_argument(
+        "--airtime-thresholds",
+        default=DEFAULT_THRESHOLDS,
+        help=f"Utilisation at which the channel is busy,congested (default: {DEFAULT_THRESHOLDS})",
+    )
+    parser.add_argument(
+        "--airtime-update-interval",
+        type=float,
+        default=DEFAULT_UPDATE_INTERVAL,
+        help=f"Seconds between congestion checks and airtime reports to clients (default: {DEFAULT_UPDATE_INTERVAL:g})",
+    )
+
+
+def source_profiles(sources) -> dict[str, LoRaProfile]:
+    """Profiles of the --source radios whose kind has one."""
+    if sources is None:
+        return {}
+    return {source.id: RADIO_PROFILES[source.kind] for source in sources.sources if source.kind in RADIO_PROFILES}
+
+
+def create_airtime(args) -> AirtimeFeed | None:
+    windows = [float(item) for item in (args.airtime_windows or "").split(",") if item.strip()]
+    if not windows:
+        return None
+    spec = args.airtime_profile or getattr(args, "radio_type", None)
+    profile = parse_profile(spec if spec in RADIO_PROFILES or args.airtime_profile else DEFAULT_PROFILE)
+    try:
+        busy, congested = (float(item) for item in args.airtime_thresholds.split(","))
+    except ValueError:
+        raise ValueError(f"invalid --airtime-thresholds {args.airtime_thresholds!r}, expected busy,congested") from None
+    if not 0 < busy <= congested:
+        raise ValueError(f"invalid --airtime-thresholds {args.airtime_thresholds!r}: need 0 < busy <= congested")
+    meter = AirtimeMeter(profile, windows, args.airtime_bucket, (busy, congested))
+    return AirtimeFeed(meter, args.airtime_update_interval)
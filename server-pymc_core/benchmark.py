@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for the decode and fan-out hot paths.
+
+Each stage runs over a fixed corpus per payload type (generated from a
+seeded simulated mesh, or a recording given with --corpus) and reports
+packets/s, p50/p99 per-packet latency and memory per packet. Fan-out is
+measured with 1, 10 and 100 in-process clients.
+
+    python3 benchmark.py                          # run and print a table
+    python3 benchmark.py --save-baseline base.json
+    python3 benchmark.py --compare base.json      # exit 1 on regressions
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Any, Callable
+
+from pymc_core.protocol import Packet
+
+from column_store import ColumnStore
+from packet_analyser_common import (
+    DEFAULT_CHANNELS,
+    DECODERS,
+    DecodeCache,
+    IndexedGroupTextHandler,
+    build_packet_json,
+    create_default_channel_db,
+    decode_by_type,
+    drive_handler,
+)
+from subscriptions import MATCH_ALL, PAYLOAD_TYPES
+from wire_format import FORMAT_BINARY, FORMAT_JSON, encode_binary, encode_json
+
+DEFAULT_PACKETS_PER_TYPE = 500
+DEFAULT_FANOUT_CLIENTS = (1, 10, 100)
+DEFAULT_REGRESSION_PCT = 10.0
+
+
+def percentile(sorted_values: list[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def build_corpus(packets_per_type: int, corpus_path: str | None = None) -> dict[str, list[bytes]]:
+    """Raw packets grouped by payload type name."""
+    corpus: dict[str, list[bytes]] = defaultdict(list)
+
+    if corpus_path:
+        from replay_source import iter_replay_records
+
+        for record in iter_replay_records(corpus_path):
+            pkt = Packet()
+            try:
+                pkt.read_from(record.raw)
+            except Exception:
+                continue
+            name = PAYLOAD_TYPES.get(pkt.get_payload_type(), f"UNKNOWN_{pkt.get_payload_type()}")
+            if len(corpus[name]) < packets_per_type:
+                corpus[name].append(record.raw)
+        return dict(corpus)
+
+    from sim_radio import DEFAULT_TRAFFIC_MIX, SimulatedRadio
+
+    sim = SimulatedRadio(nodes=64, channels=DEFAULT_CHANNELS, seed=1234)
+    for kind in DEFAULT_TRAFFIC_MIX:
+        for _ in range(packets_per_type):
+            pkt = sim._build(kind)
+            name = PAYLOAD_TYPES.get(pkt.get_payload_type())
+            corpus[name].append(pkt.write_to())
+    return dict(corpus)
+
+
+def measure(stage: str, items: list[Any], fn: Callable[[Any], Any], *, memory: bool = True) -> dict[str, Any]:
+    """Time fn over every item, then (separately, as tracing skews timing) its memory use."""
+    timings = []
+    gc.disable()
+    try:
+        clock = time.perf_counter_ns
+        for item in items:
+            start = clock()
+            fn(item)
+            timings.append(clock() - start)
+    finally:
+        gc.enable()
+
+    total_s = sum(timings) / 1e9
+    timings.sort()
+    result = {
+        "stage": stage,
+        "packets": len(items),
+        "packets_per_s": round(len(items) / total_s) if total_s > 0 else 0,
+        "p50_us": round(percentile(timings, 50) / 1000, 2),
+        "p99_us": round(percentile(timings, 99) / 1000, 2),
+    }
+
+    if memory:
+        # Peak transient bytes per call and blocks still held afterwards, averaged per packet.
+        peak_total = 0
+        tracemalloc.start()
+        try:
+            for item in items:
+                tracemalloc.reset_peak()
+                before, _ = tracemalloc.get_traced_memory()
+                fn(item)
+                _, peak = tracemalloc.get_traced_memory()
+                peak_total += peak - before
+        finally:
+            tracemalloc.stop()
+        blocks_before = sys.getallocatedblocks()
+        kept = [fn(item) for item in items]
+        retained = sys.getallocatedblocks() - blocks_before
+        del kept
+        result["peak_bytes_per_pkt"] = round(peak_total / len(items)) if items else 0
+        result["retained_blocks_per_pkt"] = round(retained / len(items), 1) if items else 0
+    return result
+
+
+def bench_stages(corpus: dict[str, list[bytes]]) -> list[dict[str, Any]]:
+    channel_db = create_default_channel_db()
+    group_handler = IndexedGroupTextHandler(None, None, lambda _msg: None, None, channel_db=channel_db)
+    results = []
+
+    for name, raws in corpus.items():
+        def parse(raw: bytes) -> Packet:
+            pkt = Packet()
+            pkt.read_from(raw)
+            return pkt
+
+        results.append(measure(f"{name}/parse", raws, parse))
+        packets = [parse(raw) for raw in raws]
+
+        if name == "GRP_TXT":
+            results.append(measure(f"{name}/decrypt", packets, lambda pkt: drive_handler(group_handler(pkt))))
+
+        ptype = packets[0].get_payload_type() if packets else None
+        if ptype in DECODERS:
+            key, decoder, _ = DECODERS[ptype]
+            results.append(measure(f"{name}/_decode_{key}", packets, decoder))
+        results.append(measure(f"{name}/decode_by_type", packets, lambda pkt: decode_by_type(pkt, None)))
+        # Every packet twice, as in a flood: the second pass hits the cache where the decoder allows.
+        cache = DecodeCache(len(packets) + 1)
+        results.append(
+            measure(f"{name}/decode_by_type[cached]", packets + packets, lambda pkt: decode_by_type(pkt, cache))
+        )
+
+        events = [build_packet_json(pkt) for pkt in packets]
+        results.append(measure(f"{name}/build_packet_json", packets, lambda pkt: build_packet_json(pkt, 0.0)))
+        results.append(measure(f"{name}/encode_json", events, encode_json))
+        results.append(measure(f"{name}/encode_binary", events, encode_binary))
+        results.append(measure(f"{name}/column_store.append", events, ColumnStore(len(events) * 2).append))
+    return results
+
+
+class _NullWebSocket:
+    """Stands in for a client connection; send() completes immediately."""
+
+    remote_address = ("bench", 0)
+    subprotocol = None
+
+    async def send(self, frame) -> None:
+        pass
+
+    async def close(self, code: int = 1000, reason: str = "") -> None:
+        pass
+
+
+async def _bench_fanout(events: list[dict[str, Any]], clients: int, fmt: str) -> dict[str, Any]:
+    from stream_server import PacketStreamServer
+
+    stream = PacketStreamServer(client_queue_size=len(events) + 1)
+    senders = []
+    for _ in range(clients):
+        sender = stream.broadcaster.add(_NullWebSocket(), fmt)
+        stream.subscriptions.set(sender, MATCH_ALL)
+        senders.append(sender)
+
+    timings = []
+    started = time.perf_counter()
+    for event in events:
+        start = time.perf_counter_ns()
+        stream.publish(event)
+        timings.append(time.perf_counter_ns() - start)
+    # Drained when every writer task has sent every frame.
+    while any(s.depth for s in senders):
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - started
+    dropped = sum(s.dropped for s in senders)
+    await stream.stop()
+
+    timings.sort()
+    return {
+        "stage": f"fanout[{fmt}]/{clients} clients",
+        "packets": len(events),
+        "packets_per_s": round(len(events) / elapsed) if elapsed > 0 else 0,
+        "p50_us": round(percentile(timings, 50) / 1000, 2),
+        "p99_us": round(percentile(timings, 99) / 1000, 2),
+        "frames_per_s": round(len(events) * clients / elapsed) if elapsed > 0 else 0,
+        "dropped": dropped,
+    }
+
+
+def bench_fanout(corpus: dict[str, list[bytes]], client_counts: tuple[int, ...]) -> list[dict[str, Any]]:
+    events = []
+    for raws in corpus.values():
+        for raw in raws:
+            pkt = Packet()
+            pkt.read_from(raw)
+            events.append(build_packet_json(pkt, 0.0))
+
+    results = []
+    for fmt in (FORMAT_JSON, FORMAT_BINARY):
+        for clients in client_counts:
+            results.append(asyncio.run(_bench_fanout(events, clients, fmt)))
+    return results
+
+
+def compare(results: list[dict[str, Any]], baseline: list[dict[str, Any]], threshold_pct: float) -> list[str]:
+    """Stages whose throughput dropped by more than threshold_pct against the baseline."""
+    base = {r["stage"]: r for r in baseline}
+    regressions = []
+    for r in results:
+        b = base.get(r["stage"])
+        if not b or not b.get("packets_per_s"):
+            continue
+        change = (r["packets_per_s"] - b["packets_per_s"]) / b["packets_per_s"] * 100
+        r["vs_baseline_pct"] = round(change, 1)
+        if change < -threshold_pct:
+            regressions.append(f"{r['stage']}: {b['packets_per_s']} -> {r['packets_per_s']} packets/s ({change:+.1f}%)")
+    return regressions
+
+
+def print_table(results: list[dict[str, Any]]) -> None:
+    columns = [
+        "stage",
+        "packets_per_s",
+        "p50_us",
+        "p99_us",
+        "peak_bytes_per_pkt",
+        "retained_blocks_per_pkt",
+        "frames_per_s",
+        "dropped",
+        "vs_baseline_pct",
+    ]
+    columns = [c for c in columns if any(c in r for r in results)]
+    widths = {c: max(len(c), *(len(str(r.get(c, ""))) for r in results)) for c in columns}
+    print("  ".join(c.ljust(widths[c]) for c in columns))
+    for r in results:
+        print("  ".join(str(r.get(c, "")).ljust(widths[c]) for c in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark decoding, serialization and fan-out")
+    parser.add_argument(
+        "--packets",
+        type=int,
+        default=DEFAULT_PACKETS_PER_TYPE,
+        help=f"Packets per payload type in the corpus (default: {DEFAULT_PACKETS_PER_TYPE})",
+    )
+    parser.add_argument("--corpus", default=None, help="Use a recording (see replay_source.py) instead of generated packets")
+    parser.add_argument(
+        "--clients",
+        default=",".join(map(str, DEFAULT_FANOUT_CLIENTS)),
+        help="Comma-separated fan-out client counts (default: 1,10,100)",
+    )
+    parser.add_argument("--skip-fanout", action="store_true", help="Only benchmark the per-packet stages")
+    parser.add_argument("--save-baseline", default=None, help="Write the results to this JSON file")
+    parser.add_argument("--compare", default=None, help="Compare against a saved baseline; exit 1 on regression")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_REGRESSION_PCT,
+        help=f"Throughput drop in percent reported as a regression (default: {DEFAULT_REGRESSION_PCT:g})",
+    )
+    parser.add_argument("--json", action="store_true", help="Print results as JSON instead of a table")
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.packets, args.corpus)
+    results = bench_stages(corpus)
+    if not args.skip_fanout:
+        results += bench_fanout(corpus, tuple(int(n) for n in args.clients.split(",") if n))
+
+    regressions = []
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f)["results"], args.threshold)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump({"created": time.time(), "python": sys.version.split()[0], "results": results}, f, indent=2)
+
+    if regressions:
+        print("\nRegressions:", file=sys.stderr)
+        for line in regressions:
+            print(f"  {line}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+
+"""
+Append-only, segmented capture of received packets.
+
+Packets are buffered in memory and written in blocks by a single background
+thread, so the event loop never touches the disk and the SD card sees a few
+large writes instead of one per packet. A segment file is rotated by size or
+age, and each has a sparse .idx file with one entry per block, so a time
+range is read back by jumping straight to the right blocks of a mmapped
+segment.
+
+Segment file "capture-<first ts in ms>.seg", a sequence of blocks:
+
+    magic "YCB1" | flags u8 | count u32 | stored_len u32 | first_ts f64 | last_ts f64
+    stored_len bytes of records, zlib-compressed when flags & 1
+
+    record: ts f64 | rssi i16 | snr i16 (quarter dB) | len u16 | raw packet bytes
+            (-32768 means unknown rssi/snr)
+
+Index file "capture-<...>.idx": first_ts f64 | last_ts f64 | offset u64 per block.
+"""
+
+import asyncio
+import bisect
+import logging
+import mmap
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Iterator, NamedTuple
+
+logger = logging.getLogger("capture_log")
+
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+
+BLOCK_MAGIC = b"YCB1"
+FLAG_ZLIB = 0x01
+
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+DEFAULT_SEGMENT_SECONDS = 24 * 3600
+DEFAULT_BLOCK_RECORDS = 256
+DEFAULT_FLUSH_INTERVAL = 10.0
+
+UNKNOWN_I16 = -32768
+
+_BLOCK = struct.Struct("<4sBIIdd")
+_RECORD = struct.Struct("<dhhH")
+_INDEX = struct.Struct("<ddQ")
+
+
+class CaptureRecord(NamedTuple):
+    ts: float
+    raw: bytes
+    rssi: int | None
+    snr: float | None
+
+
+def _i16(value: Any, scale: float = 1.0) -> int:
+    if value is None:
+        return UNKNOWN_I16
+    return max(-32767, min(32767, int(round(float(value) * scale))))
+
+
+def encode_block(records: list[CaptureRecord], compress: bool = False) -> bytes:
+    body = b"".join(
+        _RECORD.pack(r.ts, _i16(r.rssi), _i16(r.snr, 4.0), len(r.raw)) + r.raw for r in records
+    )
+    flags = 0
+    if compress:
+        body = zlib.compress(body, 6)
+        flags |= FLAG_ZLIB
+    return _BLOCK.pack(BLOCK_MAGIC, flags, len(records), len(body), records[0].ts, records[-1].ts) + body
+
+
+def decode_block(data, offset: int) -> tuple[list[CaptureRecord], int] | None:
+    """Records of the block at `offset` and the offset after it, or None at a truncated tail."""
+    if offset + _BLOCK.size > len(data):
+        return None
+    magic, flags, count, stored_len, _first_ts, _last_ts = _BLOCK.unpack_from(data, offset)
+    start = offset + _BLOCK.size
+    end = start + stored_len
+    if magic != BLOCK_MAGIC or end > len(data):
+        return None
+
+    body = bytes(data[start:end])
+    if flags & FLAG_ZLIB:
+        body = zlib.decompress(body)
+
+    records = []
+    pos = 0
+    for _ in range(count):
+        ts, rssi, snr, n = _RECORD.unpack_from(body, pos)
+        pos += _RECORD.size
+        records.append(
+            CaptureRecord(
+                ts,
+                body[pos : pos + n],
+                None if rssi == UNKNOWN_I16 else rssi,
+                None if snr == UNKNOWN_I16 else snr / 4.0,
+            )
+        )
+        pos += n
+    return records, end
+
+
+class _Segment:
+    def __init__(self, directory: Path, first_ts: float):
+        stem = directory / f"capture-{int(first_ts * 1000):013d}"
+        self.path = stem.with_suffix(SEGMENT_SUFFIX)
+        self.index_path = stem.with_suffix(INDEX_SUFFIX)
+        self.opened_at = time.monotonic()
+        self._data = open(self.path, "ab")
+        self._index = open(self.index_path, "ab")
+        self.size = self._data.tell()
+
+    def write(self, block: bytes, first_ts: float, last_ts: float) -> None:
+        self._data.write(block)
+        self._data.flush()
+        self._index.write(_INDEX.pack(first_ts, last_ts, self.size))
+        self._index.flush()
+        self.size += len(block)
+
+    def close(self) -> None:
+        self._data.close()
+        self._index.close()
+
+
+class CaptureWriter:
+    """Buffers records on the event loop and writes blocks from one background thread."""
+
+    def __init__(
+        self,
+        directory: str | Path,
+        *,
+        max_segment_bytes: int = DEFAULT_SEGMENT_BYTES,
+        max_segment_seconds: float = DEFAULT_SEGMENT_SECONDS,
+        block_records: int = DEFAULT_BLOCK_RECORDS,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        compress: bool = False,
+    ):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_seconds = max_segment_seconds
+        self.block_records = max(1, block_records)
+        self.flush_interval = flush_interval
+        self.compress = compress
+        self.name = "capture"
+
+        self._pending: list[CaptureRecord] = []
+        # One worker keeps blocks in order and owns the segment file.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="capture")
+        self._segment: _Segment | None = None
+        self._writes: set[asyncio.Future] = set()
+        self._flush_task: asyncio.Task | None = None
+
+        self.records = 0
+        self.blocks = 0
+        self.bytes_written = 0
+        self.segments = 0
+        self.errors = 0
+
+    def append(self, raw: bytes, ts: float, rssi: Any = None, snr: Any = None) -> None:
+        """Queue one packet. Cheap and non-blocking; call from the event loop."""
+        self._pending.append(CaptureRecord(ts, bytes(raw), rssi, snr))
+        self.records += 1
+        if len(self._pending) >= self.block_records:
+            self.flush()
+
+    def flush(self) -> None:
+        """Hand the buffered records to the writer thread."""
+        if not self._pending:
+            return
+        records, self._pending = self._pending, []
+        future = asyncio.get_running_loop().run_in_executor(self._executor, self._write_block, records)
+        self._writes.add(future)
+        future.add_done_callback(self._writes.discard)
+
+    def _write_block(self, records: list[CaptureRecord]) -> None:
+        try:
+            block = encode_block(records, self.compress)
+            segment = self._segment
+            if segment is not None and (
+                segment.size + len(block) > self.max_segment_bytes
+                or time.monotonic() - segment.opened_at > self.max_segment_seconds
+            ):
+                segment.close()
+                segment = self._segment = None
+            if segment is None:
+                segment = self._segment = _Segment(self.directory, records[0].ts)
+                self.segments += 1
+                logger.info(f"Capture segment opened: {segment.path}")
+            segment.write(block, records[0].ts, records[-1].ts)
+            self.blocks += 1
+            self.bytes_written += len(block)
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Capture write of {len(records)} records failed: {e}")
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+
+    def start(self) -> None:
+        if self._flush_task is None and self.flush_interval > 0:
+            self._flush_task = asyncio.create_task(self._flush_periodically())
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        self.flush()
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+        self._executor.shutdown(wait=True)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "records": self.records,
+            "pending": len(self._pending),
+            "blocks": self.blocks,
+            "bytes": self.bytes_written,
+            "segments": self.segments,
+            "errors": self.errors,
+        }
+
+
+def _segment_start(path: Path) -> float:
+    return int(path.stem.rsplit("-", 1)[1]) / 1000.0
+
+
+def list_segments(directory: str | Path) -> list[Path]:
+    return sorted(Path(directory).glob(f"capture-*{SEGMENT_SUFFIX}"), key=_segment_start)
+
+
+def _read_index(path: Path) -> list[tuple[float, float, int]]:
+    try:
+        data = path.read_bytes()
+    except OSError:
+        return []
+    usable = len(data) - len(data) % _INDEX.size
+    return [_INDEX.unpack_from(data, off) for off in range(0, usable, _INDEX.size)]
+
+
+def _start_offset(index: list[tuple[float, float, int]], start: float | None) -> int:
+    """Offset of the first block that can hold records at or after `start`."""
+    if start is None or not index:
+        return 0
+    # Blocks are written in time order, so last_ts is (nearly) sorted.
+    i = bisect.bisect_left([last_ts for _first, last_ts, _off in index], start)
+    if i >= len(index):
+        # Every indexed block ends before `start`; unindexed blocks may follow.
+        last = index[-1]
+        return last[2]
+    return index[i][2]
+
+
+def read_segment(path: Path, start: float | None = None, end: float | None = None) -> Iterator[CaptureRecord]:
+    if path.stat().st_size == 0:
+        return
+    offset = _start_offset(_read_index(path.with_suffix(INDEX_SUFFIX)), start)
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        while True:
+            block = decode_block(data, offset)
+            if block is None:
+                return
+            records, offset = block
+            for record in records:
+                if start is not None and record.ts < start:
+                    continue
+                if end is not None and record.ts > end:
+                    return
+                yield record
+
+
+def read_capture(
+    directory: str | Path, start: float | None = None, end: float | None = None
+) -> Iterator[CaptureRecord]:
+    """Records with start <= ts <= end from every segment in `directory`, in order."""
+    segments = list_segments(directory)
+    starts = [_segment_start(p) for p in segments]
+    for i, path in enumerate(segments):
+        if end is not None and starts[i] > end:
+            return
+        # Skip segments wholly before the range: the next one already starts earlier than `start`.
+        if start is not None and i + 1 < len(segments) and starts[i + 1] <= start:
+            continue
+        yield from read_segment(path, start, end)
+
+
+def add_capture_arguments(parser) -> None:
+    """Register the capture log options on an argparse parser."""
+    parser.add_argument(
+        "--capture-dir",
+        default=None,
+        help="Write every received packet to segmented capture files in this directory",
+    )
+    parser.add_argument(
+        "--capture-segment-mb",
+        type=float,
+        default=DEFAULT_SEGMENT_BYTES / (1024 * 1024),
+        help=f"Rotate capture segments at this size in MiB (default: {DEFAULT_SEGMENT_BYTES // (1024 * 1024)})",
+    )
+    parser.add_argument(
+        "--capture-segment-hours",
+        type=float,
+        default=DEFAULT_SEGMENT_SECONDS / 3600,
+        help=f"Rotate capture segments after this many hours (default: {DEFAULT_SEGMENT_SECONDS // 3600})",
+    )
+    parser.add_argument(
+        "--capture-flush-interval",
+        type=float,
+        default=DEFAULT_FLUSH_INTERVAL,
+        help=f"Seconds between capture block writes when traffic is low (default: {DEFAULT_FLUSH_INTERVAL:g})",
+    )
+    parser.add_argument(
+        "--capture-compress",
+        action="store_true",
+        help="zlib-compress capture blocks",
+    )
+
+
+def create_capture_writer(args) -> CaptureWriter | None:
+    if not args.capture_dir:
+        return None
+    return CaptureWriter(
+        args.capture_dir,
+        max_segment_bytes=int(args.capture_segment_mb * 1024 * 1024),
+        max_segment_seconds=args.capture_segment_hours * 3600,
+        flush_interval=args.capture_flush_interval,
+        compress=args.capture_compress,
+    )
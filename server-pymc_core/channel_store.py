@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+"""
+Group channel keys indexed by their 1-byte channel hash.
+
+Keys are derived once when a channel is added, so a GRP_TXT packet only
+costs a dict lookup plus one HMAC check per channel sharing its hash,
+however many channels are configured. Channels can be loaded from a file
+and added or removed at runtime.
+
+Channel files are either JSON (a list of {"name", "secret"} objects, or
+{"channels": [...]}) or plain text with one channel per line:
+
+    Public 8b3387e9c5cdea6ac9e5edbaa115cd72
+    #hashtag-channel
+    # comment (hash followed by a space)
+
+Hashtag channels without a secret use the MeshCore convention
+secret = sha256(name)[:16].
+"""
+
+import hashlib
+import json
+import logging
+from pathlib import Path
+from typing import Any, Iterable
+
+logger = logging.getLogger("channel_store")
+
+
+def hashtag_channel_secret(name: str) -> str:
+    return hashlib.sha256(name.encode("utf-8")).digest()[:16].hex()
+
+
+def _secret_bytes(secret: str) -> bytes:
+    try:
+        return bytes.fromhex(secret)
+    except ValueError:
+        return secret.encode("utf-8")
+
+
+def channel_hash_for_secret(secret: str) -> int:
+    """First byte of sha256 over the secret, hashing a 128-bit key as 16 bytes (as the firmware does)."""
+    secret_bytes = _secret_bytes(secret)
+    if len(secret_bytes) >= 32 and secret_bytes[16:32] == b"\x00" * 16:
+        secret_bytes = secret_bytes[:16]
+    elif len(secret_bytes) > 32:
+        secret_bytes = secret_bytes[:32]
+    return hashlib.sha256(secret_bytes).digest()[0]
+
+
+class ChannelKey:
+    __slots__ = ("name", "secret", "channel_hash", "key", "entry")
+
+    def __init__(self, name: str, secret: str):
+        self.name = name
+        self.secret = secret
+        self.channel_hash = channel_hash_for_secret(secret)
+        # HMAC key / AES key material as used for decryption: the secret padded to 32 bytes.
+        self.key = _secret_bytes(secret)[:32].ljust(32, b"\x00")
+        # The channel_db-style dict handed to GroupTextHandler.
+        self.entry = {"name": name, "secret": secret}
+
+
+class ChannelStore:
+    """channel_db implementation with a channel_hash index.
+
+    Also satisfies the plain get_channels() interface pymc_core expects.
+    """
+
+    def __init__(self, channels: Iterable[dict[str, Any]] = ()):
+        self._by_name: dict[str, ChannelKey] = {}
+        self._by_hash: dict[int, list[ChannelKey]] = {}
+        self._by_secret: dict[str, ChannelKey] = {}
+        # Bumped on every change, so copies held elsewhere (decode pool workers) can tell they are stale.
+        self.version = 0
+        self.load(channels)
+
+    def __len__(self) -> int:
+        return len(self._by_name)
+
+    def load(self, channels: Iterable[dict[str, Any]]) -> None:
+        """Replace every channel with `channels`; on error the previous channels are kept."""
+        previous = self._by_name, self._by_hash, self._by_secret
+        self._by_name, self._by_hash, self._by_secret = {}, {}, {}
+        try:
+            for channel in channels:
+                self.add(channel["name"], channel.get("secret"))
+        except Exception:
+            self._by_name, self._by_hash, self._by_secret = previous
+            raise
+        self.version += 1
+
+    def add(self, name: str, secret: str | None = None) -> ChannelKey:
+        """Add or replace a channel. Hashtag channels may omit the secret."""
+        if not secret:
+            if not name.startswith("#"):
+                raise ValueError(f"channel {name!r} needs a secret")
+            secret = hashtag_channel_secret(name)
+
+        self.remove(name)
+        channel = ChannelKey(name, secret)
+        self._by_name[name] = channel
+        self._by_hash.setdefault(channel.channel_hash, []).append(channel)
+        self._by_secret[secret] = channel
+        self.version += 1
+        return channel
+
+    def remove(self, name: str) -> bool:
+        channel = self._by_name.pop(name, None)
+        if channel is None:
+            return False
+        same_hash = self._by_hash.get(channel.channel_hash, [])
+        same_hash.remove(channel)
+        if not same_hash:
+            del self._by_hash[channel.channel_hash]
+        if self._by_secret.get(channel.secret) is channel:
+            del self._by_secret[channel.secret]
+        self.version += 1
+        return True
+
+    def by_hash(self, channel_hash: int) -> list[dict[str, Any]]:
+        return [channel.entry for channel in self._by_hash.get(channel_hash, ())]
+
+    def key_for_secret(self, secret: str) -> bytes | None:
+        channel = self._by_secret.get(secret)
+        return channel.key if channel is not None else None
+
+    def get_channels(self) -> list[dict[str, Any]]:
+        return [channel.entry for channel in self._by_name.values()]
+
+    def describe(self) -> list[dict[str, Any]]:
+        """Channel names and hashes, without secrets."""
+        return [{"name": c.name, "channel_hash": c.channel_hash} for c in self._by_name.values()]
+
+
+def load_channel_file(path: str | Path) -> list[dict[str, Any]]:
+    text = Path(path).read_text(encoding="utf-8")
+    if text.lstrip().startswith(("[", "{")):
+        data = json.loads(text)
+        channels = data.get("channels", []) if isinstance(data, dict) else data
+        for channel in channels:
+            if not isinstance(channel, dict) or not isinstance(channel.get("name"), str):
+                raise ValueError(f"{path}: every channel needs a name")
+        return channels
+
+    channels = []
+    for lineno, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line == "#" or line.startswith("# "):
+            continue
+        parts = line.split()
+        if len(parts) > 2:
+            raise ValueError(f"{path}:{lineno}: expected 'name [secret]'")
+        channels.append({"name": parts[0], "secret": parts[1] if len(parts) == 2 else None})
+    return channels
+
+
+def register_channel_commands(stream, store: ChannelStore, allow_admin: bool = False) -> None:
+    """Client messages to list channels and, when allowed, add or remove them."""
+
+    def reply(sender, **fields):
+        sender.enqueue(json.dumps({"type": "channels", **fields}))
+
+    def list_channels(sender, message):
+        reply(sender, channels=store.describe())
+
+    def add_channel(sender, message):
+        if not allow_admin:
+            reply(sender, error="channel admin disabled")
+            return
+        try:
+            channel = store.add(str(message.get("name") or ""), message.get("secret"))
+        except ValueError as e:
+            reply(sender, error=str(e))
+            return
+        logger.info(f"WS client {sender.peer} added channel {channel.name} (hash {channel.channel_hash:02X})")
+        reply(sender, channels=store.describe())
+
+    def remove_channel(sender, message):
+        if not allow_admin:
+            reply(sender, error="channel admin disabled")
+            return
+        name = str(message.get("name") or "")
+        if store.remove(name):
+            logger.info(f"WS client {sender.peer} removed channel {name}")
+        reply(sender, channels=store.describe())
+
+    stream.register_command("channels", list_channels)
+    stream.register_command("add_channel", add_channel)
+    stream.register_command("remove_channel", remove_channel)
+
+
+def add_channel_arguments(parser, admin: bool = True) -> None:
+    """Register the channel key options on an argparse parser."""
+    parser.add_argument(
+        "--channels-file",
+        default=None,
+        help="Group channel definitions (JSON or 'name [secret]' lines), reloaded on SIGHUP",
+    )
+    if not admin:
+        return
+    parser.add_argument(
+        "--channel-admin",
+        action="store_true",
+        help="Allow WebSocket clients to add and remove channels at runtime",
+    )
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+"""
+Parsing of the small JSON control protocol clients may speak over /ws.
+
+Every client message is a JSON object with a "type" key, e.g.
+{"type": "backfill", "last": 200}. Anything else is logged and ignored, so
+clients that never send anything keep working unchanged.
+"""
+
+import json
+import logging
+from typing import Any
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger("client_protocol")
+
+MAX_CLIENT_MESSAGE_SIZE = 64 * 1024
+
+
+def parse_client_message(message: str | bytes, peer=None) -> dict[str, Any] | None:
+    if len(message) > MAX_CLIENT_MESSAGE_SIZE:
+        logger.warning(f"WS client {peer} sent an oversized message ({len(message)} bytes)")
+        return None
+
+    try:
+        parsed = json.loads(message)
+    except (ValueError, UnicodeDecodeError):
+        logger.warning(f"WS client {peer} sent invalid JSON")
+        return None
+
+    if not isinstance(parsed, dict) or not isinstance(parsed.get("type"), str):
+        logger.warning(f"WS client {peer} sent a message without a type")
+        return None
+    return parsed
+
+
+def request_path(ws) -> str | None:
+    """Request path including the query string, for both websockets server APIs."""
+    return getattr(ws, "path", None) or getattr(getattr(ws, "request", None), "path", None)
+
+
+def batching_requested(path: str | None) -> bool:
+    """True when the client connected with "?batch=1" (JSON clients opting into array frames)."""
+    if not path or "?" not in path:
+        return False
+    value = parse_qs(urlsplit(path).query).get("batch", ["0"])[0]
+    return value.lower() in ("1", "true", "yes")
@@ -0,0 +1,533 @@
+#!/usr/bin/env python3
+
+"""
+Columnar in-memory store of recent packets, for analytics over large windows.
+
+A published event dict costs a few KiB; holding hundreds of thousands of
+them is not an option on a small host. ColumnStore keeps the numeric fields
+of each packet in fixed-width columns and its raw bytes in a contiguous
+arena, about 30 bytes plus the packet itself per row:
+
+    ts f64 | header u8 | payload_type u8 | route_type u8 | rssi i16 | snr i16 (quarter dB)
+    path_len u8 | crc u32 | src_hash i16 | source u8 | flags u8 | raw offset u32
+
+(-32768 means unknown rssi/snr, -1 an unknown source hash.) Rows go into
+preallocated chunks; when the store is over its row or byte cap the oldest
+chunk is dropped whole, so growth and eviction never copy rows.
+
+Filters and aggregates run a chunk at a time: with NumPy installed they are
+vectorized over zero-copy views of the columns, otherwise they loop over
+the same arrays in Python. {"type": "analytics"} client messages expose
+them, as does GET /analytics with the same keys as query parameters (see
+register_analytics_commands).
+"""
+
+import json
+import math
+import time
+from array import array
+from collections import deque
+from typing import Any
+
+from capture_log import UNKNOWN_I16, _i16
+from packet_store import query_spec_from_params
+from subscriptions import PAYLOAD_TYPES, ROUTE_TYPES, _hash_bytes, _type_codes, packet_hashes
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - optional speed-up
+    np = None
+
+DEFAULT_COLUMN_MAX_ROWS = 500_000
+DEFAULT_COLUMN_MAX_MB = 64.0
+DEFAULT_CHUNK_ROWS = 16384
+MAX_ANALYTICS_ROWS = 5000
+DEFAULT_ANALYTICS_PATH = "/analytics"
+
+FLAG_REPEAT = 0x01
+FLAG_DECRYPTED = 0x02
+
+UNKNOWN_HASH = -1
+
+# name -> array typecode
+COLUMNS = (
+    ("ts", "d"),
+    ("header", "B"),
+    ("payload_type", "B"),
+    ("route_type", "B"),
+    ("rssi", "h"),
+    ("snr", "h"),
+    ("path_len", "B"),
+    ("crc", "I"),
+    ("src_hash", "h"),
+    ("source", "B"),
+    ("flags", "B"),
+)
+
+GROUP_KEYS = ("payload_type", "route_type", "src_hash", "source")
+
+_PAYLOAD_TYPE_CODES = {name: code for code, name in PAYLOAD_TYPES.items()}
+_ROUTE_TYPE_CODES = {name: code for code, name in ROUTE_TYPES.items()}
+
+
+class _Chunk:
+    """`capacity` preallocated rows; columns never resize, so NumPy views of them stay valid."""
+
+    __slots__ = ("capacity", "rows", "columns", "offsets", "arena", "first_ts", "last_ts")
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.rows = 0
+        self.columns = {name: array(code, [0]) * capacity for name, code in COLUMNS}
+        # Row i's raw bytes are arena[offsets[i]:offsets[i + 1]].
+        self.offsets = array("I", [0]) * (capacity + 1)
+        self.arena = bytearray()
+        self.first_ts = math.inf
+        self.last_ts = -math.inf
+
+    @property
+    def full(self) -> bool:
+        return self.rows >= self.capacity
+
+    @property
+    def nbytes(self) -> int:
+        columns = sum(col.itemsize * len(col) for col in self.columns.values())
+        return columns + self.offsets.itemsize * len(self.offsets) + len(self.arena)
+
+    def raw(self, row: int) -> bytes:
+        return bytes(self.arena[self.offsets[row] : self.offsets[row + 1]])
+
+
+class ColumnFilter:
+    """A validated analytics filter: the same keys as a packet store query, for columns."""
+
+    def __init__(self, spec: dict[str, Any]):
+        def number(key: str) -> float | None:
+            value = spec.get(key)
+            if value is None or value == "":
+                return None
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"invalid {key}: {value!r}") from None
+
+        self.start = number("start")
+        self.end = number("end")
+        self.min_rssi = number("min_rssi")
+        self.min_snr = number("min_snr")
+        self.payload_types = (
+            _type_codes(spec["payload_type"], _PAYLOAD_TYPE_CODES, "payload type")
+            if spec.get("payload_type") is not None
+            else None
+        )
+        self.route_types = (
+            _type_codes(spec["route_type"], _ROUTE_TYPE_CODES, "route type")
+            if spec.get("route_type") is not None
+            else None
+        )
+        self.src_hashes = _hash_bytes(spec["src_hash"], "src_hash") if spec.get("src_hash") is not None else None
+        sources = spec.get("source")
+        self.sources = frozenset(sources if isinstance(sources, list) else [sources]) if sources is not None else None
+        repeats = spec.get("repeats", True)
+        self.repeats = repeats.lower() not in ("0", "false", "no") if isinstance(repeats, str) else bool(repeats)
+
+
+class ColumnStore:
+    """Recent packets as columns in fixed-size chunks, oldest chunk evicted first."""
+
+    def __init__(
+        self,
+        max_rows: int = DEFAULT_COLUMN_MAX_ROWS,
+        max_bytes: int = int(DEFAULT_COLUMN_MAX_MB * 1024 * 1024),
+        chunk_rows: int = DEFAULT_CHUNK_ROWS,
+    ):
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.chunk_rows = max(1, chunk_rows)
+        self._chunks: deque[_Chunk] = deque()
+        # Receiving source ids, interned to the u8 stored per row; index 0 is "no source".
+        self._sources: list[str | None] = [None]
+        self._source_index: dict[str | None, int] = {None: 0}
+        self._rows = 0
+        self._bytes = 0
+        self.name = "columns"
+
+        self.appended = 0
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return self._rows
+
+    @property
+    def nbytes(self) -> int:
+        return self._bytes
+
+    def _source(self, source: str | None) -> int:
+        index = self._source_index.get(source)
+        if index is None:
+            if len(self._sources) > 0xFF:
+                return 0
+            index = self._source_index[source] = len(self._sources)
+            self._sources.append(source)
+        return index
+
+    def append(self, event: dict[str, Any]) -> None:
+        """Add one published event; without a packet section (raw-only bridges) the header comes from the raw bytes."""
+        packet = event.get("packet") or {}
+        radio = event.get("radio") or {}
+        routing = event.get("routing") or {}
+        decoded = event.get("decoded") or {}
+        try:
+            raw = bytes.fromhex((event.get("raw_packet") or {}).get("hex") or "")
+        except ValueError:
+            raw = b""
+        header = packet.get("header")
+        if header is None:
+            header = raw[0] if raw else 0
+        ptype = packet.get("payload_type")
+        rtype = packet.get("route_type")
+        _dest, src = packet_hashes(event) if "decoded" in event else (None, None)
+        flags = FLAG_REPEAT if "dup_of" in event else 0
+        if (decoded.get("group_text") or decoded.get("text") or {}).get("decrypted"):
+            flags |= FLAG_DECRYPTED
+
+        chunk = self._chunks[-1] if self._chunks else None
+        if chunk is None or chunk.full:
+            chunk = _Chunk(self.chunk_rows)
+            self._chunks.append(chunk)
+            self._bytes += chunk.nbytes
+        row = chunk.rows
+        ts = event.get("ts") or time.time()
+        columns = chunk.columns
+        columns["ts"][row] = ts
+        columns["header"][row] = header & 0xFF
+        columns["payload_type"][row] = (header >> 2) & 0x0F if ptype is None else ptype & 0xFF
+        columns["route_type"][row] = header & 0x03 if rtype is None else rtype & 0xFF
+        columns["rssi"][row] = _i16(radio.get("rssi"))
+        columns["snr"][row] = _i16(radio.get("snr"), 4.0)
+        columns["path_len"][row] = min(0xFF, routing.get("path_len") or 0)
+        columns["crc"][row] = (packet.get("crc") or 0) & 0xFFFFFFFF
+        columns["src_hash"][row] = UNKNOWN_HASH if src is None else src
+        columns["source"][row] = self._source(event.get("source"))
+        columns["flags"][row] = flags
+        chunk.arena += raw
+        chunk.offsets[row + 1] = len(chunk.arena)
+        chunk.rows += 1
+        chunk.first_ts = min(chunk.first_ts, ts)
+        chunk.last_ts = max(chunk.last_ts, ts)
+        self._rows += 1
+        self._bytes += len(raw)
+        self.appended += 1
+
+        while len(self._chunks) > 1 and (self._rows > self.max_rows or self._bytes > self.max_bytes):
+            oldest = self._chunks.popleft()
+            self._rows -= oldest.rows
+            self._bytes -= oldest.nbytes
+            self.evicted += oldest.rows
+
+    def _chunks_for(self, flt: ColumnFilter) -> list[_Chunk]:
+        return [
+            chunk
+            for chunk in self._chunks
+            if chunk.rows
+            and (flt.start is None or chunk.last_ts >= flt.start)
+            and (flt.end is None or chunk.first_ts <= flt.end)
+        ]
+
+    def _source_codes(self, flt: ColumnFilter) -> frozenset[int] | None:
+        if flt.sources is None:
+            return None
+        return frozenset(i for i, source in enumerate(self._sources) if source in flt.sources)
+
+    def _mask_numpy(self, chunk: _Chunk, flt: ColumnFilter, sources: frozenset[int] | None):
+        n = chunk.rows
+        col = {name: np.frombuffer(chunk.columns[name], dtype=chunk.columns[name].typecode, count=n) for name, _ in COLUMNS}
+        mask = np.ones(n, dtype=bool)
+        if flt.start is not None:
+            mask &= col["ts"] >= flt.start
+        if flt.end is not None:
+            mask &= col["ts"] <= flt.end
+        if flt.payload_types is not None:
+            mask &= np.isin(col["payload_type"], list(flt.payload_types))
+        if flt.route_types is not None:
+            mask &= np.isin(col["route_type"], list(flt.route_types))
+        if flt.src_hashes is not None:
+            mask &= np.isin(col["src_hash"], list(flt.src_hashes))
+        if sources is not None:
+            mask &= np.isin(col["source"], list(sources))
+        if flt.min_rssi is not None:
+            mask &= (col["rssi"] != UNKNOWN_I16) & (col["rssi"] >= flt.min_rssi)
+        if flt.min_snr is not None:
+            mask &= (col["snr"] != UNKNOWN_I16) & (col["snr"] >= flt.min_snr * 4)
+        if not flt.repeats:
+            mask &= (col["flags"] & FLAG_REPEAT) == 0
+        return col, mask
+
+    def _rows_python(self, chunk: _Chunk, flt: ColumnFilter, sources: frozenset[int] | None) -> list[int]:
+        c = chunk.columns
+        ts, ptype, rtype, src, source = c["ts"], c["payload_type"], c["route_type"], c["src_hash"], c["source"]
+        rssi, snr, flags = c["rssi"], c["snr"], c["flags"]
+        rows = []
+        for i in range(chunk.rows):
+            if flt.start is not None and ts[i] < flt.start:
+                continue
+            if flt.end is not None and ts[i] > flt.end:
+                continue
+            if flt.payload_types is not None and ptype[i] not in flt.payload_types:
+                continue
+            if flt.route_types is not None and rtype[i] not in flt.route_types:
+                continue
+            if flt.src_hashes is not None and src[i] not in flt.src_hashes:
+                continue
+            if sources is not None and source[i] not in sources:
+                continue
+            if flt.min_rssi is not None and (rssi[i] == UNKNOWN_I16 or rssi[i] < flt.min_rssi):
+                continue
+            if flt.min_snr is not None and (snr[i] == UNKNOWN_I16 or snr[i] < flt.min_snr * 4):
+                continue
+            if not flt.repeats and flags[i] & FLAG_REPEAT:
+                continue
+            rows.append(i)
+        return rows
+
+    def _key(self, group_by: str | None, bucket: float | None, name: str, value) -> Any:
+        if bucket is not None:
+            return math.floor(value / bucket) * bucket
+        if group_by == "payload_type":
+            return PAYLOAD_TYPES.get(value, str(value))
+        if group_by == "route_type":
+            return ROUTE_TYPES.get(value, str(value))
+        if group_by == "src_hash":
+            return None if value == UNKNOWN_HASH else f"{value:02x}"
+        if group_by == "source":
+            return self._sources[value] if value < len(self._sources) else None
+        return None
+
+    def aggregate(self, flt: ColumnFilter, group_by: str | None = None) -> list[dict[str, Any]]:
+        """Count, raw bytes, RSSI/SNR min/avg/max and decrypted rows of the matching rows, per group.
+
+        `group_by` is one of GROUP_KEYS, "time:<seconds>" for a histogram, or None for one total.
+        """
+        bucket = None
+        if group_by is not None and group_by.startswith("time:"):
+            try:
+                bucket = float(group_by[5:])
+            except ValueError:
+                bucket = 0
+            if not bucket or bucket <= 0:
+                raise ValueError(f"invalid time bucket: {group_by!r}")
+            column = "ts"
+        elif group_by is None or group_by in GROUP_KEYS:
+            column = group_by
+        else:
+            raise ValueError(f"group_by must be one of {', '.join(GROUP_KEYS)} or time:<seconds>")
+
+        sources = self._source_codes(flt)
+        # key -> [count, bytes, decrypted, rssi n/sum/min/max, snr n/sum/min/max]
+        groups: dict[Any, list] = {}
+
+        def merge(key, count, nbytes, decrypted, rssi, snr) -> None:
+            acc = groups.get(key)
+            if acc is None:
+                acc = groups[key] = [0, 0, 0, 0, 0.0, math.inf, -math.inf, 0, 0.0, math.inf, -math.inf]
+            acc[0] += count
+            acc[1] += nbytes
+            acc[2] += decrypted
+            for base, (n, total, low, high) in ((3, rssi), (7, snr)):
+                if n:
+                    acc[base] += n
+                    acc[base + 1] += total
+                    acc[base + 2] = min(acc[base + 2], low)
+                    acc[base + 3] = max(acc[base + 3], high)
+
+        for chunk in self._chunks_for(flt):
+            if np is not None:
+                self._aggregate_numpy(chunk, flt, sources, column, bucket, group_by, merge)
+            else:
+                self._aggregate_python(chunk, flt, sources, column, bucket, group_by, merge)
+
+        out = []
+        for key, acc in groups.items():
+            out.append(
+                {
+                    "key": key,
+                    "count": acc[0],
+                    "bytes": acc[1],
+                    "decrypted": acc[2],
+                    "rssi": _signal(acc[3], acc[4], acc[5], acc[6]),
+                    "snr": _signal(acc[7], acc[8] / 4, acc[9] / 4, acc[10] / 4),
+                }
+            )
+        out.sort(key=lambda g: (g["key"] is None, g["key"] if bucket is not None else -g["count"]))
+        return out
+
+    def _aggregate_numpy(self, chunk, flt, sources, column, bucket, group_by, merge) -> None:
+        col, mask = self._mask_numpy(chunk, flt, sources)
+        if not mask.any():
+            return
+        offsets = np.frombuffer(chunk.offsets, dtype=chunk.offsets.typecode, count=chunk.rows + 1)
+        sizes = (offsets[1:] - offsets[:-1])[mask]
+        decrypted = ((col["flags"][mask] & FLAG_DECRYPTED) != 0).astype(np.int64)
+        rssi = col["rssi"][mask].astype(np.int64)
+        snr = col["snr"][mask].astype(np.int64)
+        if column is None:
+            keys, inverse = np.zeros(1), np.zeros(int(mask.sum()), dtype=np.int64)
+        else:
+            values = col[column][mask]
+            if bucket is not None:
+                values = np.floor(values / bucket)
+            keys, inverse = np.unique(values, return_inverse=True)
+        groups = len(keys)
+        counts = np.bincount(inverse, minlength=groups)
+        nbytes = np.bincount(inverse, weights=sizes, minlength=groups)
+        decrypts = np.bincount(inverse, weights=decrypted, minlength=groups)
+        signals = []
+        for values in (rssi, snr):
+            known = values != UNKNOWN_I16
+            idx, vals = inverse[known], values[known]
+            n = np.bincount(idx, minlength=groups)
+            total = np.bincount(idx, weights=vals, minlength=groups)
+            low = np.full(groups, np.iinfo(np.int64).max)
+            high = np.full(groups, np.iinfo(np.int64).min)
+            np.minimum.at(low, idx, vals)
+            np.maximum.at(high, idx, vals)
+            signals.append((n, total, low, high))
+        for g in range(groups):
+            if column is None:
+                key = None
+            elif bucket is not None:
+                key = float(keys[g]) * bucket
+            else:
+                key = self._key(group_by, None, column, int(keys[g]))
+            merge(
+                key,
+                int(counts[g]),
+                int(nbytes[g]),
+                int(decrypts[g]),
+                *[(int(n[g]), float(total[g]), int(low[g]), int(high[g])) for n, total, low, high in signals],
+            )
+
+    def _aggregate_python(self, chunk, flt, sources, column, bucket, group_by, merge) -> None:
+        c = chunk.columns
+        offsets, rssi, snr, flags = chunk.offsets, c["rssi"], c["snr"], c["flags"]
+        values = c[column] if column is not None else None
+        for i in self._rows_python(chunk, flt, sources):
+            key = self._key(group_by, bucket, column, values[i]) if values is not None else None
+            r, s = rssi[i], snr[i]
+            merge(
+                key,
+                1,
+                offsets[i + 1] - offsets[i],
+                1 if flags[i] & FLAG_DECRYPTED else 0,
+                (0, 0, 0, 0) if r == UNKNOWN_I16 else (1, r, r, r),
+                (0, 0, 0, 0) if s == UNKNOWN_I16 else (1, s, s, s),
+            )
+
+    def rows(self, flt: ColumnFilter, limit: int = 100) -> list[dict[str, Any]]:
+        """The newest `limit` matching rows, oldest first, with their raw bytes as hex."""
+        sources = self._source_codes(flt)
+        out: list[dict[str, Any]] = []
+        for chunk in reversed(self._chunks_for(flt)):
+            if np is not None:
+                _col, mask = self._mask_numpy(chunk, flt, sources)
+                matched = np.flatnonzero(mask).tolist()
+            else:
+                matched = self._rows_python(chunk, flt, sources)
+            c = chunk.columns
+            for i in reversed(matched):
+                out.append(
+                    {
+                        "ts": c["ts"][i],
+                        "header": c["header"][i],
+                        "payload_type": c["payload_type"][i],
+                        "route_type": c["route_type"][i],
+                        "rssi": None if c["rssi"][i] == UNKNOWN_I16 else c["rssi"][i],
+                        "snr": None if c["snr"][i] == UNKNOWN_I16 else c["snr"][i] / 4,
+                        "path_len": c["path_len"][i],
+                        "crc": c["crc"][i],
+                        "src_hash": None if c["src_hash"][i] == UNKNOWN_HASH else f"{c['src_hash'][i]:02x}",
+                        "source": self._sources[c["source"][i]],
+                        "repeat": bool(c["flags"][i] & FLAG_REPEAT),
+                        "raw": chunk.raw(i).hex(),
+                    }
+                )
+                if len(out) >= limit:
+                    return out[::-1]
+        return out[::-1]
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "rows": len(self),
+            "chunks": len(self._chunks),
+            "bytes": self.nbytes,
+            "appended": self.appended,
+            "evicted": self.evicted,
+        }
+
+
+def _signal(n: int, total: float, low: float, high: float) -> dict[str, Any] | None:
+    if not n:
+        return None
+    return {"n": n, "min": low, "avg": round(total / n, 2), "max": high}
+
+
+def analyse(store: ColumnStore, spec: dict[str, Any]) -> dict[str, Any]:
+    """The reply to one analytics request; raises ValueError for an invalid one."""
+    flt = ColumnFilter(spec)
+    reply: dict[str, Any] = {"type": "analytics", "request": spec.get("request")}
+    started = time.perf_counter()
+    reply["groups"] = store.aggregate(flt, spec.get("group_by") or None)
+    if spec.get("rows"):
+        try:
+            limit = int(spec["rows"])
+        except (TypeError, ValueError):
+            raise ValueError(f"invalid rows: {spec['rows']!r}") from None
+        reply["rows"] = store.rows(flt, max(1, min(MAX_ANALYTICS_ROWS, limit)))
+    reply["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    return reply
+
+
+def register_analytics_commands(stream, store: ColumnStore, path: str = DEFAULT_ANALYTICS_PATH) -> None:
+    """{"type": "analytics", ...filter, "group_by": ..., "rows": N} client messages, and GET `path`."""
+
+    def analytics(sender, message):
+        try:
+            reply = analyse(store, message)
+        except ValueError as e:
+            sender.enqueue(json.dumps({"type": "error", "request": "analytics", "message": str(e)}))
+            return
+        sender.enqueue(json.dumps(reply))
+
+    async def http_analytics(params: dict[str, list[str]]) -> tuple[str, str]:
+        return "application/json", json.dumps(analyse(store, query_spec_from_params(params)))
+
+    stream.register_command("analytics", analytics)
+    if path:
+        stream.register_http(path, http_analytics)
+
+
+def add_column_store_arguments(parser) -> None:
+    """Register the column store options on an argparse parser."""
+    parser.add_argument(
+        "--column-max-rows",
+        type=int,
+        default=DEFAULT_COLUMN_MAX_ROWS,
+        help=f"Recent packets kept in the columnar analytics store, 0 to disable (default: {DEFAULT_COLUMN_MAX_ROWS})",
+    )
+    parser.add_argument(
+        "--column-max-mb",
+        type=float,
+        default=DEFAULT_COLUMN_MAX_MB,
+        help=f"Memory cap of the columnar store in MiB (default: {DEFAULT_COLUMN_MAX_MB:g})",
+    )
+    parser.add_argument(
+        "--analytics-path",
+        default=DEFAULT_ANALYTICS_PATH,
+        help=f"HTTP path serving analytics next to /ws, empty to disable (default: {DEFAULT_ANALYTICS_PATH})",
+    )
+
+
+def create_column_store(args) -> ColumnStore | None:
+    if args.column_max_rows <= 0:
+        return None
+    return ColumnStore(args.column_max_rows, int(args.column_max_mb * 1024 * 1024))
@@ -24,6 +24,20 @@ from pymc_core import LocalIdentity
 from pymc_core.hardware.base import LoRaRadio
 from pymc_core.node.node import MeshNode
 
+from airtime import RADIO_PROFILES
+
+
+def _modulation(radio_type: str) -> dict:
+    """SX1262 frequency and modulation settings of a radio profile (shared with airtime.py)."""
+    profile = RADIO_PROFILES[radio_type]
+    return {
+        "frequency": profile.frequency,
+        "spreading_factor": profile.spreading_factor,
+        "bandwidth": profile.bandwidth,
+        "coding_rate": profile.coding_rate,
+        "preamble_length": profile.preamble_length,
+    }
+
 
 def create_radio(radio_type: str = "waveshare", serial_port: str = "/dev/ttyUSB0") -> LoRaRadio:
     """Create a radio instance with configuration for specified hardware.
@@ -45,11 +59,12 @@ def create_radio(radio_type: str = "waveshare", serial_port: str = "/dev/ttyUSB0
             logger.debug("Using KISS Serial Wrapper")
 
             # KISS TNC configuration
+            profile = RADIO_PROFILES["kiss-tnc"]
             kiss_config = {
-                "frequency": int(869.618 * 1000000),  # EU: 869.525 MHz
-                "bandwidth": int(62.5 * 1000),  # 250 kHz
-                "spreading_factor": 8,  # LoRa SF11
-                "coding_rate": 8,  # LoRa CR 4/5
+                "frequency": profile.frequency,
+                "bandwidth": profile.bandwidth,
+                "spreading_factor": profile.spreading_factor,
+                "coding_rate": profile.coding_rate,
                 "sync_word": 0x12,  # Sync word
                 "power": 22,  # TX power
             }
@@ -81,12 +96,8 @@ def create_radio(radio_type: str = "waveshare", serial_port: str = "/dev/ttyUSB0
                 "irq_pin": 16,
                 "txen_pin": 13,  # GPIO 13 for TX enable
                 "rxen_pin": 12,
-                "frequency": int(869.618 * 1000000),  # EU: 869.618 MHz
                 "tx_power": 22,
-                "spreading_factor": 8,
-                "bandwidth": int(62.5 * 1000),
-                "coding_rate": 8,
-                "preamble_length": 17,
+                **_modulation("waveshare"),
                 "is_waveshare": True,
             },
             "uconsole": {
@@ -98,12 +109,8 @@ def create_radio(radio_type: str = "waveshare", serial_port: str = "/dev/ttyUSB0
                 "irq_pin": 26,
                 "txen_pin": -1,
                 "rxen_pin": -1,
-                "frequency": int(869.618 * 1000000),  # EU: 869.525 MHz
                 "tx_power": 22,
-                "spreading_factor": 8,
-                "bandwidth": int(62.5 * 1000),
-                "coding_rate": 8,
-                "preamble_length": 17,
+                **_modulation("uconsole"),
                 "use_dio3_tcxo": True,
                 "use_dio2_rf": True,
             },
@@ -116,12 +123,8 @@ def create_radio(radio_type: str = "waveshare", serial_port: str = "/dev/ttyUSB0
                 "irq_pin": 16,
                 "txen_pin": -1,
                 "rxen_pin": 12,
-                "frequency": int(910.525 * 1000000),  # US: 910.525 MHz
                 "tx_power": 22,
-                "spreading_factor": 7,
-                "bandwidth": int(62.5 * 1000),
-                "coding_rate": 5,
-                "preamble_length": 17,
+                **_modulation("meshadv-mini"),
             },
         }
 
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+"""
+Optional worker pool for parsing, group text decryption and decoding.
+
+With --decode-workers N the ingest consumer hands raw packet bytes to N
+worker processes (or threads with --decode-pool thread) and goes on to the
+next packet, so decrypt-heavy traffic uses the idle cores instead of the
+event loop that also serves the radio and every WebSocket. Workers return
+the "decoded" section; dedup, event building and serialization stay on the
+loop, where each event's annotations and per-client projections are known.
+
+Results are handed back in submission order across all sources, so a slow
+packet never lets a later one overtake it and events still leave in the
+order they were received (and timestamped). Each worker keeps its own
+decode cache and a copy of the group channels; when the channels change
+the workers are replaced.
+"""
+
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import BrokenExecutor, Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+from typing import Any, Callable
+
+from channel_store import ChannelStore
+from packet_analyser_common import DEFAULT_DECODE_CACHE_SIZE, DecodeCache, RawPacketDecoder, decode_by_type
+
+logger = logging.getLogger("decode_pool")
+
+POOL_PROCESS = "process"
+POOL_THREAD = "thread"
+POOL_KINDS = (POOL_PROCESS, POOL_THREAD)
+
+# Packets in flight per worker before the ingest consumer waits.
+IN_FLIGHT_PER_WORKER = 8
+
+_worker = threading.local()
+
+
+def _init_worker(channels: list[dict[str, Any]], cache_size: int) -> None:
+    _worker.decoder = RawPacketDecoder(ChannelStore(channels))
+    _worker.cache = DecodeCache(cache_size)
+
+
+def _decode(raw: bytes) -> dict[str, Any] | None:
+    """The decoded section of a raw packet, or None when it is not a valid packet. Runs in a worker."""
+    pkt = _worker.decoder.packet_sync(raw)
+    if pkt is None:
+        return None
+    return decode_by_type(pkt, _worker.cache)
+
+
+class DecodePool:
+    """Decodes raw packets on worker processes or threads, delivering results in submission order."""
+
+    def __init__(
+        self,
+        channels: ChannelStore,
+        workers: int,
+        kind: str = POOL_PROCESS,
+        cache_size: int = DEFAULT_DECODE_CACHE_SIZE,
+    ):
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        if kind not in POOL_KINDS:
+            raise ValueError(f"unknown decode pool kind: {kind}")
+        self.channels = channels
+        self.workers = workers
+        self.kind = kind
+        self.cache_size = cache_size
+        self.name = "decode_pool"
+
+        self._executor: Executor | None = None
+        self._channels_version = -1
+        self._broken = False
+        self._slots = asyncio.Semaphore(workers * IN_FLIGHT_PER_WORKER)
+        # (future, done) in submission order; one drain task hands them back while it is non-empty.
+        self._pending: deque = deque()
+        self._drain_task: asyncio.Task | None = None
+
+        self.submitted = 0
+        self.completed = 0
+        self.invalid = 0
+        self.errors = 0
+        self.restarts = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._pending)
+
+    def _create_executor(self) -> Executor:
+        initargs = (self.channels.get_channels(), self.cache_size)
+        if self.kind == POOL_THREAD:
+            return ThreadPoolExecutor(
+                self.workers, thread_name_prefix="decode", initializer=_init_worker, initargs=initargs
+            )
+        # Spawned rather than forked: the parent has serial, capture and trace threads running.
+        return ProcessPoolExecutor(
+            self.workers, mp_context=get_context("spawn"), initializer=_init_worker, initargs=initargs
+        )
+
+    def _replace_executor(self, reason: str) -> None:
+        old = self._executor
+        self._channels_version = self.channels.version
+        self._broken = False
+        self._executor = self._create_executor()
+        if old is not None:
+            self.restarts += 1
+            logger.info(f"Restarting {self.workers} decode {self.kind} workers: {reason}")
+            # Packets already submitted to the old workers still complete, in order.
+            old.shutdown(wait=False)
+
+    def start(self) -> None:
+        if self._executor is None:
+            self._replace_executor("started")
+            logger.info(f"Decoding on {self.workers} {self.kind} workers")
+
+    async def submit(self, raw: bytes, done: Callable[[dict[str, Any]], None]) -> None:
+        """Queue `raw` for decoding; done(decoded) runs on the loop after every earlier packet's.
+
+        Waits while the pool is saturated, so bursts back up into the ingest queue.
+        """
+        await self._slots.acquire()
+        if self._broken:
+            self._replace_executor("a worker died")
+        elif self._channels_version != self.channels.version:
+            self._replace_executor("group channels changed")
+        try:
+            future = asyncio.wrap_future(self._executor.submit(_decode, raw))
+        except BrokenExecutor:
+            self._replace_executor("a worker died")
+            future = asyncio.wrap_future(self._executor.submit(_decode, raw))
+        self.submitted += 1
+
+        self._pending.append((future, done))
+        if self._drain_task is None:
+            self._drain_task = asyncio.create_task(self._drain(), name="decode-drain")
+
+    async def _drain(self) -> None:
+        pending = self._pending
+        while pending:
+            future, done = pending[0]
+            try:
+                decoded = await future
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Decode worker failed: {e}")
+                # A crashed process breaks the whole pool; the next submit replaces it.
+                self._broken = self._broken or isinstance(e, BrokenExecutor)
+                continue
+            finally:
+                pending.popleft()
+                self._slots.release()
+
+            self.completed += 1
+            if decoded is None:
+                self.invalid += 1
+                continue
+            try:
+                done(decoded)
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Handling a decoded packet failed: {e}")
+        self._drain_task = None
+
+    async def close(self) -> None:
+        if self._drain_task is not None:
+            self._drain_task.cancel()
+            try:
+                await self._drain_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._drain_task = None
+        self._pending.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "in_flight": self.in_flight,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "invalid": self.invalid,
+            "errors": self.errors,
+            "restarts": self.restarts,
+        }
+
+
+def add_decode_pool_arguments(parser) -> None:
+    """Register the decode worker pool options on an argparse parser."""
+    parser.add_argument(
+        "--decode-workers",
+        type=int,
+        default=0,
+        help="Worker processes/threads decoding and decrypting packets, 0 to decode on the event loop (default: 0)",
+    )
+    parser.add_argument(
+        "--decode-pool",
+        choices=POOL_KINDS,
+        default=POOL_PROCESS,
+        help=f"Run decode workers as processes or threads (default: {POOL_PROCESS})",
+    )
+
+
+def create_decode_pool(args, channels: ChannelStore) -> DecodePool | None:
+    if args.decode_workers <= 0:
+        return None
+    return DecodePool(channels, args.decode_workers, args.decode_pool, args.decode_cache_size)
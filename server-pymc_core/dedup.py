@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+"""
+Flood-repeat deduplication for the analyser pipeline.
+
+In a mesh the same logical packet (same payload type and payload bytes) is
+heard many times while it is re-flooded with growing paths. DedupCache keys
+packets on a hash of the payload, remembers every hearing (RSSI/SNR/path)
+inside a time window, and lets the server decide what to send:
+
+  pass      every copy is sent; repeats carry "dup_of" and reuse the first
+            copy's decoded section instead of decoding again
+  collapse  the first copy is sent in full, repeats as small "repeat" updates
+  suppress  only the first copy is sent
+
+A MeshNode's dispatcher drops repeats before the server gets them, so
+server.py records their hearings from the raw frames instead (hear()):
+the hearing history and counts are complete, but only first copies are
+published. With --source every copy goes through the modes above.
+"""
+
+import hashlib
+from collections import OrderedDict
+from typing import Any
+
+from packet_analyser_common import _format_path, build_packet_json
+from pymc_core.protocol import Packet
+
+DEDUP_OFF = "off"
+DEDUP_PASS = "pass"
+DEDUP_COLLAPSE = "collapse"
+DEDUP_SUPPRESS = "suppress"
+DEDUP_MODES = (DEDUP_OFF, DEDUP_PASS, DEDUP_COLLAPSE, DEDUP_SUPPRESS)
+
+DEFAULT_DEDUP_WINDOW = 30.0
+DEFAULT_DEDUP_MAX_ENTRIES = 4096
+DEFAULT_DEDUP_MAX_HEARINGS = 32
+
+
+def payload_key(payload_type: int, payload: bytes) -> str:
+    return hashlib.blake2b(bytes([payload_type & 0xFF]) + bytes(payload), digest_size=8).hexdigest()
+
+
+class DedupEntry:
+    __slots__ = ("key", "first_ts", "last_ts", "count", "hearings", "packet", "decoded")
+
+    def __init__(self, key: str, ts: float):
+        self.key = key
+        self.first_ts = ts
+        self.last_ts = ts
+        self.count = 0
+        # (ts, rssi, snr, path_hex, source) per hearing, capped at max_hearings.
+        self.hearings: list[tuple[float, Any, Any, str, str | None]] = []
+        # Sections of the first copy's event, reused for repeats.
+        self.packet: dict[str, Any] | None = None
+        self.decoded: dict[str, Any] | None = None
+
+    def describe(self) -> dict[str, Any]:
+        return {
+            "pkt_hash": self.key,
+            "first_ts": self.first_ts,
+            "last_ts": self.last_ts,
+            "count": self.count,
+            "sources": sorted({source for *_, source in self.hearings if source is not None}),
+            "hearings": [
+                {"ts": ts, "rssi": rssi, "snr": snr, "path": path, "source": source}
+                for ts, rssi, snr, path, source in self.hearings
+            ],
+        }
+
+
+class DedupCache:
+    """Time-windowed LRU of recently heard payloads, bounded in entries and hearings."""
+
+    def __init__(
+        self,
+        window: float = DEFAULT_DEDUP_WINDOW,
+        max_entries: int = DEFAULT_DEDUP_MAX_ENTRIES,
+        max_hearings: int = DEFAULT_DEDUP_MAX_HEARINGS,
+    ):
+        self.window = window
+        self.max_entries = max(1, max_entries)
+        self.max_hearings = max(1, max_hearings)
+        self._entries: OrderedDict[str, DedupEntry] = OrderedDict()
+        self.name = "dedup"
+
+        self.unique = 0
+        self.duplicates = 0
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> DedupEntry | None:
+        return self._entries.get(key)
+
+    def observe(
+        self, key: str, ts: float, rssi: Any, snr: Any, path: str, source: str | None = None
+    ) -> tuple[DedupEntry, bool]:
+        """Record one hearing. Returns (entry, is_first_copy)."""
+        self._expire(ts)
+
+        entry = self._entries.get(key)
+        if entry is not None and ts - entry.first_ts > self.window:
+            del self._entries[key]
+            entry = None
+
+        first = entry is None
+        if first:
+            entry = DedupEntry(key, ts)
+            self._entries[key] = entry
+            self.unique += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+        else:
+            self._entries.move_to_end(key)
+            self.duplicates += 1
+
+        entry.count += 1
+        entry.last_ts = ts
+        if len(entry.hearings) < self.max_hearings:
+            entry.hearings.append((ts, rssi, snr, path, source))
+        return entry, first
+
+    def _expire(self, now: float) -> None:
+        # `now` is the newest receive timestamp, so replayed input expires consistently.
+        # Entries are in least-recently-heard order; stop at the first live one.
+        horizon = now - self.window
+        while self._entries:
+            entry = next(iter(self._entries.values()))
+            if entry.last_ts >= horizon:
+                break
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "unique": self.unique,
+            "duplicates": self.duplicates,
+            "evicted": self.evicted,
+        }
+
+
+class PacketDeduplicator:
+    """Turns received packets into the events to publish under a dedup mode."""
+
+    def __init__(self, cache: DedupCache, mode: str = DEDUP_PASS):
+        if mode not in DEDUP_MODES or mode == DEDUP_OFF:
+            raise ValueError(f"Unsupported dedup mode: {mode}")
+        self.cache = cache
+        self.mode = mode
+
+    def hear(self, raw: bytes, rx_ts: float, rssi: Any = None, snr: Any = None, source: str | None = None) -> None:
+        """Record a hearing of a raw frame whose packet reaches process() only if it is the first copy."""
+        pkt = Packet()
+        try:
+            pkt.read_from(raw)
+        except (ValueError, IndexError):
+            return
+        key = payload_key(pkt.get_payload_type(), pkt.get_payload())
+        self.cache.observe(key, rx_ts, rssi, snr, _format_path(pkt), source)
+
+    def process(
+        self,
+        pkt,
+        rx_ts: float,
+        source: str | None = None,
+        decoded: dict[str, Any] | None = None,
+        heard: bool = False,
+    ) -> dict[str, Any] | None:
+        """Event to publish for this packet, or None when it should not be sent.
+
+        `source` is the id of the receiving source when server.py runs several;
+        copies heard by different sources are matched like flood repeats.
+        `decoded` is the packet's decoded section if it was already decoded
+        elsewhere (a decode pool worker). `heard` says hear() already
+        recorded this copy.
+        """
+        key = payload_key(pkt.get_payload_type(), pkt.get_payload())
+        rssi = getattr(pkt, "_rssi", None)
+        snr = getattr(pkt, "_snr", None)
+        entry = self.cache.get(key) if heard else None
+        if entry is None:
+            entry, first = self.cache.observe(key, rx_ts, rssi, snr, _format_path(pkt), source)
+        else:
+            first = entry.packet is None
+
+        if first:
+            event = build_packet_json(pkt, rx_ts, decoded)
+            entry.packet = event["packet"]
+            entry.decoded = event["decoded"]
+            event["pkt_hash"] = key
+            return event
+
+        if self.mode == DEDUP_SUPPRESS:
+            return None
+
+        if self.mode == DEDUP_COLLAPSE:
+            return {
+                "type": "repeat",
+                "ts": rx_ts,
+                "dup_of": key,
+                "repeat": entry.count,
+                "packet": entry.packet,
+                "radio": {"rssi": rssi, "snr": snr},
+                "routing": {"path_len": getattr(pkt, "path_len", None), "path": _format_path(pkt)},
+            }
+
+        event = build_packet_json(pkt, rx_ts, decoded=entry.decoded)
+        event["dup_of"] = key
+        event["repeat"] = entry.count
+        return event
+
+
+def add_dedup_arguments(parser) -> None:
+    """Register the dedup command line options on an argparse parser."""
+    parser.add_argument(
+        "--dedup-mode",
+        choices=DEDUP_MODES,
+        default=DEDUP_PASS,
+        help=f"How flood repeats of the same payload are sent (default: {DEDUP_PASS})",
+    )
+    parser.add_argument(
+        "--dedup-window",
+        type=float,
+        default=DEFAULT_DEDUP_WINDOW,
+        help=f"Seconds a payload is remembered after its first hearing (default: {DEFAULT_DEDUP_WINDOW:g})",
+    )
+    parser.add_argument(
+        "--dedup-max-entries",
+        type=int,
+        default=DEFAULT_DEDUP_MAX_ENTRIES,
+        help=f"Distinct payloads remembered at once (default: {DEFAULT_DEDUP_MAX_ENTRIES})",
+    )
+    parser.add_argument(
+        "--dedup-max-hearings",
+        type=int,
+        default=DEFAULT_DEDUP_MAX_HEARINGS,
+        help=f"RSSI/SNR/path hearings stored per payload (default: {DEFAULT_DEDUP_MAX_HEARINGS})",
+    )
+
+
+def create_deduplicator(args) -> PacketDeduplicator | None:
+    if args.dedup_mode == DEDUP_OFF:
+        return None
+    cache = DedupCache(args.dedup_window, args.dedup_max_entries, args.dedup_max_hearings)
+    return PacketDeduplicator(cache, args.dedup_mode)
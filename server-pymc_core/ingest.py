@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+"""
+Ingestion stage between the radio callback and decode/broadcast.
+
+The receive callback only stamps the arrival time and queues the packet;
+consumer tasks do the decoding and fan-out, so bursts downstream never back
+up into packet reception.
+
+With a MeshNode, packets reach the server only after the dispatcher has
+parsed, deduplicated and decrypted them, so ArrivalStamps times the raw
+frames in the radio's own RX callback instead.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Awaitable, Callable
+
+logger = logging.getLogger("ingest")
+
+DEFAULT_INGEST_QUEUE_SIZE = 1024
+
+# Frames stamped but not (yet) handed on by the dispatcher, kept at most.
+ARRIVAL_STAMPS = 1024
+# A stamp this old belongs to an earlier copy of the frame, not to a new one.
+ARRIVAL_MAX_AGE = 30.0
+
+
+class IngestQueue:
+    """Bounded hand-off queue stamping each item with its receive time."""
+
+    def __init__(
+        self,
+        handler: Callable[[Any, float], Awaitable[None]],
+        *,
+        maxsize: int = DEFAULT_INGEST_QUEUE_SIZE,
+        workers: int = 1,
+        name: str = "ingest",
+    ):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+
+        self._handler = handler
+        self._queue: asyncio.Queue[tuple[float, Any]] = asyncio.Queue(maxsize=maxsize)
+        self._workers = workers
+        self._tasks: list[asyncio.Task] = []
+        self.name = name
+        self.maxsize = maxsize
+
+        self.received = 0
+        self.processed = 0
+        self.errors = 0
+        self.overflow = 0
+        self.high_water = 0
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, item: Any, rx_ts: float | None = None) -> bool:
+        """Stamp and queue an item without blocking. Safe to use as the radio callback."""
+        if rx_ts is None:
+            rx_ts = time.time()
+        self.received += 1
+
+        try:
+            self._queue.put_nowait((rx_ts, item))
+        except asyncio.QueueFull:
+            # Never block the receive path: the newest packet is the one dropped.
+            self.overflow += 1
+            if self.overflow == 1 or self.overflow % 100 == 0:
+                logger.warning(f"{self.name} queue full ({self.maxsize}), dropped={self.overflow}")
+            return False
+
+        depth = self._queue.qsize()
+        if depth > self.high_water:
+            self.high_water = depth
+        return True
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        for i in range(self._workers):
+            self._tasks.append(asyncio.create_task(self._consume(), name=f"{self.name}-{i}"))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._tasks = []
+
+    async def _consume(self) -> None:
+        while True:
+            rx_ts, item = await self._queue.get()
+            try:
+                await self._handler(item, rx_ts)
+                self.processed += 1
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"{self.name} handler failed: {e}")
+            finally:
+                self._queue.task_done()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "depth": self._queue.qsize(),
+            "maxsize": self.maxsize,
+            "high_water": self.high_water,
+            "received": self.received,
+            "processed": self.processed,
+            "errors": self.errors,
+            "overflow": self.overflow,
+        }
+
+
+class ArrivalStamps:
+    """Receive times of raw frames, taken ahead of a MeshNode dispatcher and looked up by its packets."""
+
+    def __init__(self, maxsize: int = ARRIVAL_STAMPS, max_age: float = ARRIVAL_MAX_AGE):
+        # Oldest first; frames the dispatcher drops (repeats, bad bytes) age out from the front.
+        self._stamps: dict[bytes, float] = {}
+        # KISS TNCs call back from their serial RX thread.
+        self._lock = threading.Lock()
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self.name = "arrivals"
+
+        self.stamped = 0
+        self.matched = 0
+        self.missed = 0
+
+    def install(self, node, heard: Callable[[bytes, float, Any, Any], None] | None = None) -> None:
+        """Stamp each frame in the radio's RX callback, then hand it to the dispatcher as before.
+
+        `heard(raw, rx_ts, rssi, snr)` sees every frame on the event loop,
+        including the repeats the dispatcher drops. Call from the event loop.
+        """
+        forward = node.dispatcher._on_packet_received
+        radio = node.radio
+        loop = asyncio.get_running_loop()
+        loop_thread = threading.get_ident()
+
+        def on_rx(data: bytes, rssi: Any = None, snr: Any = None) -> None:
+            raw = bytes(data)
+            rx_ts = time.time()
+            self.stamp(raw, rx_ts)
+            if heard is not None:
+                # SX1262 passes only the data; its last RSSI/SNR belong to this frame.
+                if rssi is None and hasattr(radio, "get_last_rssi"):
+                    rssi = radio.get_last_rssi()
+                if snr is None and hasattr(radio, "get_last_snr"):
+                    snr = radio.get_last_snr()
+                if threading.get_ident() == loop_thread:
+                    heard(raw, rx_ts, rssi, snr)
+                else:
+                    loop.call_soon_threadsafe(heard, raw, rx_ts, rssi, snr)
+            forward(data, rssi, snr)
+
+        radio.set_rx_callback(on_rx)
+
+    def stamp(self, raw: bytes, rx_ts: float | None = None) -> None:
+        if rx_ts is None:
+            rx_ts = time.time()
+        with self._lock:
+            self.stamped += 1
+            # Keep the first copy's time while the dispatcher may still be working on it.
+            first = self._stamps.get(raw)
+            if first is not None and rx_ts - first < self.max_age:
+                return
+            self._stamps.pop(raw, None)
+            self._stamps[raw] = rx_ts
+            if len(self._stamps) > self.maxsize:
+                del self._stamps[next(iter(self._stamps))]
+
+    def take(self, raw: bytes) -> float | None:
+        """The arrival time stamped for these bytes, or None if they were never seen."""
+        with self._lock:
+            rx_ts = self._stamps.pop(raw, None)
+        if rx_ts is None:
+            self.missed += 1
+        else:
+            self.matched += 1
+        return rx_ts
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "pending": len(self._stamps),
+            "stamped": self.stamped,
+            "matched": self.matched,
+            "missed": self.missed,
+        }
+
+
+def add_ingest_arguments(parser) -> None:
+    """Register the shared ingestion command line options on an argparse parser."""
+    parser.add_argument(
+        "--ingest-queue-size",
+        type=int,
+        default=DEFAULT_INGEST_QUEUE_SIZE,
+        help=f"Packets buffered between radio receive and decoding (default: {DEFAULT_INGEST_QUEUE_SIZE})",
+    )
+    parser.add_argument(
+        "--ingest-workers",
+        type=int,
+        default=1,
+        help="Decode/broadcast consumer tasks; more than one may reorder events (default: 1)",
+    )
+    parser.add_argument(
+        "--stats-interval",
+        type=float,
+        default=60.0,
+        help="Seconds between ingest/client stats log lines, 0 to disable (default: 60)",
+    )
+
+
+async def log_stats_periodically(interval: float, ingest: IngestQueue, broadcaster, *others) -> None:
+    """Log ingest queue and client fan-out stats every `interval` seconds.
+
+    `others` are extra components with a `name` and a flat `stats()` dict.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        s = ingest.stats()
+        dropped = sum(c["dropped"] for c in broadcaster.stats())
+        logger.info(
+            f"{ingest.name}: depth={s['depth']}/{s['maxsize']} high_water={s['high_water']} "
+            f"overflow={s['overflow']} processed={s['processed']} errors={s['errors']} "
+            f"clients={len(broadcaster)} client_drops={dropped}"
+        )
+        for other in others:
+            logger.info(f"{other.name}: " + " ".join(f"{k}={v}" for k, v in other.stats().items()))
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+"""
+Prometheus metrics for the packet servers, served as text at /metrics on
+the same port as /ws.
+
+Counters and histograms are updated inline on the hot path (a dict lookup
+and, for histograms, a bisect). Queue depths, client lag and the flat
+stats() of other components are read when the endpoint is scraped.
+
+Exported families (all prefixed "yampa_"):
+
+    packets_received_total{payload_type,route_type}   every packet heard
+    decode_errors_total{payload_type}                  decoders reporting an error
+    group_text_total{channel,channel_hash,result}      decrypted / undecrypted group text
+    stage_seconds{stage}                               queue, decode, serialize, send
+    serialized_bytes_total{format}                     frames encoded for clients
+    radio_rssi_dbm, radio_snr_db                       signal distributions
+    clients_connected, client_*{peer}                  fan-out queues, lag and drops
+    ingest_*, <component>_*                            scrape-time stats() values
+"""
+
+import bisect
+import math
+import time
+from typing import Any, Callable, Iterable
+
+from subscriptions import PAYLOAD_TYPES, ROUTE_TYPES
+
+DEFAULT_METRICS_PATH = "/metrics"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+PREFIX = "yampa_"
+
+STAGE_QUEUE = "queue"
+STAGE_DECODE = "decode"
+STAGE_SERIALIZE = "serialize"
+STAGE_SEND = "send"
+
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+)
+RSSI_BUCKETS = (-130, -120, -110, -100, -90, -80, -70, -60, -50, -40)
+SNR_BUCKETS = (-20, -15, -10, -7.5, -5, -2.5, 0, 2.5, 5, 7.5, 10, 15)
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        self.name = PREFIX + name
+        self.help = help_text
+        self.label_names = labels
+        # Unlabelled counters are exported as 0 before their first increment.
+        self._values: dict[tuple, float] = {} if labels else {(): 0}
+
+    def inc(self, *labels: Any, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def snapshot(self) -> list[list]:
+        """The values as JSON-friendly [labels, value] pairs."""
+        return [[list(labels), value] for labels, value in self._values.items()]
+
+    def merged(self, snapshots: Iterable[list[list]]) -> "Counter":
+        """A copy with the values of other processes' snapshots added."""
+        out = Counter(self.name.removeprefix(PREFIX), self.help, self.label_names)
+        out._values = dict(self._values)
+        for snapshot in snapshots:
+            for labels, value in snapshot:
+                out.inc(*labels, amount=value)
+        return out
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self._values.items():
+            yield f"{self.name}{_labels(self.label_names, labels)} {_number(value)}"
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: tuple[float, ...], labels: tuple[str, ...] = ()):
+        self.name = PREFIX + name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.label_names = labels
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels: Any) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def snapshot(self, keep: Callable[[tuple], bool] = lambda _labels: True) -> list[list]:
+        """The series as JSON-friendly [labels, bucket counts, sum] lists."""
+        return [[list(labels), counts, total] for labels, (counts, total) in self._series.items() if keep(labels)]
+
+    def merged(self, snapshots: Iterable[list[list]]) -> "Histogram":
+        """A copy with the series of other processes' snapshots added."""
+        out = Histogram(self.name.removeprefix(PREFIX), self.help, self.buckets, self.label_names)
+        out._series = {labels: [list(counts), total] for labels, (counts, total) in self._series.items()}
+        for snapshot in snapshots:
+            for labels, counts, total in snapshot:
+                series = out._series.setdefault(tuple(labels), [[0] * (len(self.buckets) + 1), 0.0])
+                series[0] = [a + b for a, b in zip(series[0], counts)]
+                series[1] += total
+        return out
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = 'le="' + _number(float(bound)) + '"'
+                yield f"{self.name}_bucket{_labels(self.label_names, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.label_names, labels)} {_number(total)}"
+            yield f"{self.name}_count{_labels(self.label_names, labels)} {cumulative}"
+
+
+def _gauge(name: str, help_text: str, samples: Iterable[tuple[dict[str, Any], float]]) -> Iterable[str]:
+    yield f"# HELP {PREFIX}{name} {help_text}"
+    yield f"# TYPE {PREFIX}{name} gauge"
+    for labels, value in samples:
+        yield f"{PREFIX}{name}{_labels(tuple(labels), tuple(labels.values()))} {_number(value)}"
+
+
+class PacketMetrics:
+    """The metric families shared by server.py and server_companion.py."""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.packets = Counter(
+            "packets_received_total", "Packets heard by the radio.", ("payload_type", "route_type")
+        )
+        self.decode_errors = Counter(
+            "decode_errors_total", "Packets whose decoder reported an error.", ("payload_type",)
+        )
+        self.group_text = Counter(
+            "group_text_total",
+            "Group text packets by channel and decryption result.",
+            ("channel", "channel_hash", "result"),
+        )
+        self.stages = Histogram(
+            "stage_seconds",
+            "Time spent per pipeline stage: queue (rx to consumer), decode, serialize, send (enqueue to sent).",
+            LATENCY_BUCKETS,
+            ("stage",),
+        )
+        self.serialized_bytes = Counter(
+            "serialized_bytes_total", "Bytes of event frames serialized for clients.", ("format",)
+        )
+        self.client_drops = Counter(
+            "client_dropped_frames_total", "Frames dropped by full client queues, all clients.", ()
+        )
+        self.rssi = Histogram("radio_rssi_dbm", "RSSI of received packets.", RSSI_BUCKETS)
+        self.snr = Histogram("radio_snr_db", "SNR of received packets.", SNR_BUCKETS)
+
+        self._ingest = None
+        self._broadcaster = None
+        self._components: list[Any] = []
+        # Fan-out worker processes' client_snapshot()s, by worker.
+        self._remote: dict[Any, dict[str, Any]] = {}
+
+    def watch(self, ingest, broadcaster, *others) -> None:
+        """Components whose state is read at scrape time; `others` have a `name` and a flat `stats()`."""
+        self._ingest = ingest
+        self._broadcaster = broadcaster
+        self._components = list(others)
+
+    def observe_packet(self, header: int, rssi: Any = None, snr: Any = None) -> None:
+        payload_type = (header >> 2) & 0x0F
+        route_type = header & 0x03
+        self.packets.inc(
+            PAYLOAD_TYPES.get(payload_type, f"UNKNOWN_{payload_type}"),
+            ROUTE_TYPES.get(route_type, f"UNKNOWN_{route_type}"),
+        )
+        if rssi is not None:
+            self.rssi.observe(rssi)
+        if snr is not None:
+            self.snr.observe(snr)
+
+    def observe_event(self, event: dict[str, Any]) -> None:
+        """Decode errors and group text decryption results of a published event."""
+        # Repeats reuse the decoded section of the first copy, which was already counted.
+        if "dup_of" in event or event.get("type") == "repeat":
+            return
+        decoded = event.get("decoded")
+        if not decoded:
+            return
+        for key, section in decoded.items():
+            if not isinstance(section, dict):
+                continue
+            if "error" in section:
+                self.decode_errors.inc(event.get("packet", {}).get("payload_type_name", key))
+            if key == "group_text":
+                channel_hash = section.get("channel_hash")
+                self.group_text.inc(
+                    section.get("channel_name") or "",
+                    f"{channel_hash:02x}" if isinstance(channel_hash, int) else "",
+                    "decrypted" if section.get("decrypted") else "undecrypted",
+                )
+
+    def observe_stage(self, stage: str, seconds: float) -> None:
+        self.stages.observe(seconds, stage)
+
+    def observe_frame(self, fmt: str, frame: str | bytes) -> None:
+        self.serialized_bytes.inc(fmt, amount=len(frame))
+
+    def observe_serialize(self, seconds: float) -> None:
+        self.stages.observe(seconds, STAGE_SERIALIZE)
+
+    def observe_send(self, lag: float) -> None:
+        self.stages.observe(lag, STAGE_SEND)
+
+    def observe_drop(self) -> None:
+        self.client_drops.inc()
+
+    def client_snapshot(self) -> dict[str, Any]:
+        """The client-side families, as a fan-out worker process reports them (see ws_workers.py)."""
+        return {
+            "stages": self.stages.snapshot(lambda labels: labels[0] in (STAGE_SERIALIZE, STAGE_SEND)),
+            "serialized_bytes": self.serialized_bytes.snapshot(),
+            "client_drops": self.client_drops.snapshot(),
+        }
+
+    def set_remote(self, key: Any, snapshot: dict[str, Any] | None) -> None:
+        """Add (or with None, forget) a worker's client_snapshot() to what render() exports."""
+        if snapshot is None:
+            self._remote.pop(key, None)
+        else:
+            self._remote[key] = snapshot
+
+    def render(self) -> str:
+        lines: list[str] = []
+        stages, serialized_bytes, client_drops = self.stages, self.serialized_bytes, self.client_drops
+        if self._remote:
+            remote = list(self._remote.values())
+            stages = stages.merged(r["stages"] for r in remote)
+            serialized_bytes = serialized_bytes.merged(r["serialized_bytes"] for r in remote)
+            client_drops = client_drops.merged(r["client_drops"] for r in remote)
+        for family in (
+            self.packets,
+            self.decode_errors,
+            self.group_text,
+            stages,
+            serialized_bytes,
+            client_drops,
+            self.rssi,
+            self.snr,
+        ):
+            lines.extend(family.render())
+
+        uptime = time.time() - self.started_at
+        lines.extend(_gauge("uptime_seconds", "Seconds since the server started.", [({}, uptime)]))
+        if self._ingest is not None:
+            lines.extend(self._render_stats(self._ingest))
+        if self._broadcaster is not None:
+            lines.extend(self._render_clients(self._broadcaster))
+        for component in self._components:
+            lines.extend(self._render_stats(component))
+        return "\n".join(lines) + "\n"
+
+    def _render_stats(self, component) -> Iterable[str]:
+        for key, value in component.stats().items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            yield from _gauge(f"{component.name}_{key}", f"{component.name} {key}.", [({}, value)])
+
+    def _render_clients(self, broadcaster) -> Iterable[str]:
+        clients = broadcaster.stats()
+        yield from _gauge("clients_connected", "Connected WebSocket clients.", [({}, len(clients))])
+
+        def per_client(key: str) -> list[tuple[dict[str, Any], float]]:
+            return [({"peer": c["peer"], "format": c["format"]}, c[key]) for c in clients]
+
+        yield from _gauge("client_queue_depth", "Frames waiting in a client's send queue.", per_client("queue_depth"))
+        yield from _gauge(
+            "client_queue_age_seconds", "Age of the oldest frame in a client's send queue.", per_client("queue_age")
+        )
+        yield from _gauge("client_lag_seconds", "Enqueue-to-send time of a client's last frame.", per_client("last_lag"))
+        yield from _gauge("client_max_lag_seconds", "Largest enqueue-to-send time of a client.", per_client("max_lag"))
+        yield from _gauge("client_sent_frames", "Frames sent to a client.", per_client("sent"))
+        yield from _gauge("client_dropped_frames", "Frames dropped for a client.", per_client("dropped"))
+
+
+def register_metrics_endpoint(stream, metrics: PacketMetrics, path: str = DEFAULT_METRICS_PATH) -> None:
+    """Serve `metrics` at `path` on the stream server's port."""
+    stream.register_http(path, lambda _params: (CONTENT_TYPE, metrics.render()))
+
+
+def add_metrics_arguments(parser) -> None:
+    """Register the metrics endpoint options on an argparse parser."""
+    parser.add_argument(
+        "--metrics-path",
+        default=DEFAULT_METRICS_PATH,
+        help=f"HTTP path serving Prometheus metrics next to /ws, empty to disable (default: {DEFAULT_METRICS_PATH})",
+    )
+
+
+def create_metrics(args) -> PacketMetrics | None:
+    return PacketMetrics() if args.metrics_path else None
@@ -5,20 +5,54 @@ import asyncio
 import json
 import sys
 
-from packet_analyser_common import build_packet_json, create_analyser_node
+from capture_log import add_capture_arguments, create_capture_writer
+from channel_store import add_channel_arguments
+from packet_analyser_common import (
+    RADIO_TYPES,
+    build_packet_json,
+    create_analyser_node,
+    create_default_channel_db,
+    create_source_radio,
+)
+from replay_source import ReplayRadio, add_replay_source_arguments
+from sim_radio import add_sim_radio_arguments
 
 
-async def run_analyser(radio_type: str, serial_port: str):
-    node = create_analyser_node(radio_type=radio_type, serial_port=serial_port)
+async def run_analyser(args: argparse.Namespace):
+    channels = create_default_channel_db(args.channels_file)
+    node = create_analyser_node(
+        radio_type=args.radio_type,
+        serial_port=args.serial_port,
+        channel_db=channels,
+        radio=create_source_radio(args, channels.get_channels()),
+    )
+    capture = create_capture_writer(args)
 
     async def on_packet(pkt):
         out = build_packet_json(pkt)
+        if capture is not None:
+            capture.append(pkt.write_to(), out["ts"], out["radio"]["rssi"], out["radio"]["snr"])
+        if args.quiet:
+            return
         sys.stdout.write(json.dumps(out, ensure_ascii=False) + "\n")
         sys.stdout.flush()
 
     node.dispatcher.set_packet_received_callback(on_packet)
 
-    await node.start()
+    if capture is not None:
+        capture.start()
+    try:
+        if isinstance(node.radio, ReplayRadio):
+            # Stop once the recording has been played back instead of listening forever.
+            node_task = asyncio.create_task(node.start())
+            await node.radio.finished.wait()
+            await asyncio.sleep(0.5)
+            node_task.cancel()
+        else:
+            await node.start()
+    finally:
+        if capture is not None:
+            await capture.close()
 
 
 def main():
@@ -27,7 +61,7 @@ def main():
     )
     parser.add_argument(
         "--radio-type",
-        choices=["waveshare", "uconsole", "meshadv-mini", "kiss-tnc"],
+        choices=RADIO_TYPES,
         default="uconsole",
         help="Radio hardware type (default: uconsole)",
     )
@@ -36,11 +70,20 @@ def main():
         default="/dev/ttyUSB0",
         help="Serial port for KISS TNC (default: /dev/ttyUSB0)",
     )
+    add_replay_source_arguments(parser)
+    add_sim_radio_arguments(parser)
+    parser.add_argument(
+        "--quiet",
+        action="store_true",
+        help="Do not print JSON lines (useful with --capture-dir)",
+    )
+    add_channel_arguments(parser, admin=False)
+    add_capture_arguments(parser)
 
     args = parser.parse_args()
 
     try:
-        asyncio.run(run_analyser(args.radio_type, args.serial_port))
+        asyncio.run(run_analyser(args))
     except KeyboardInterrupt:
         pass
 
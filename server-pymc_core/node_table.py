@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+"""
+Incremental node table built from decoded adverts.
+
+Every advert event updates one row keyed on the advertiser's public key:
+name, flags, position, last seen time, last RSSI/SNR, the fewest hops it
+was heard over and how many distinct adverts were heard. Flood repeats of
+an advert (events with "dup_of") refresh the signal and hop distance
+without counting as a new advert. Nodes silent for longer than the maximum
+age are evicted.
+
+Clients ask for the table with {"type": "nodes"} and get one snapshot;
+unless they pass "subscribe": false they then receive a "node_delta" frame
+per interval carrying only the rows that changed and the keys evicted.
+Frames carry a "seq"; a client that sees a gap (a delta dropped by its
+send queue) asks for a new snapshot.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any
+
+logger = logging.getLogger("node_table")
+
+DEFAULT_NODE_MAX_AGE = 72 * 3600.0
+DEFAULT_NODE_MAX_ENTRIES = 10000
+DEFAULT_NODE_DELTA_INTERVAL = 1.0
+
+
+class NodeEntry:
+    __slots__ = (
+        "pub_key",
+        "name",
+        "flags",
+        "latitude",
+        "longitude",
+        "first_seen",
+        "last_seen",
+        "last_rssi",
+        "last_snr",
+        "hops",
+        "adverts",
+        "advert_ts",
+        "source",
+    )
+
+    def __init__(self, pub_key: str, ts: float):
+        self.pub_key = pub_key
+        self.name: str | None = None
+        self.flags: int | None = None
+        self.latitude: float | None = None
+        self.longitude: float | None = None
+        self.first_seen = ts
+        self.last_seen = ts
+        self.last_rssi = None
+        self.last_snr = None
+        self.hops: int | None = None
+        self.adverts = 0
+        # The advert's own timestamp, telling a new advert from a repeat of the last one.
+        self.advert_ts: int | None = None
+        self.source: str | None = None
+
+    def describe(self) -> dict[str, Any]:
+        return {
+            "pub_key": self.pub_key,
+            "name": self.name,
+            "flags": self.flags,
+            "latitude": self.latitude,
+            "longitude": self.longitude,
+            "first_seen": self.first_seen,
+            "last_seen": self.last_seen,
+            "last_rssi": self.last_rssi,
+            "last_snr": self.last_snr,
+            "hops": self.hops,
+            "adverts": self.adverts,
+            "source": self.source,
+        }
+
+
+class NodeTable:
+    """Nodes by public key, least recently heard first, with the keys changed since the last delta."""
+
+    def __init__(self, max_age: float = DEFAULT_NODE_MAX_AGE, max_entries: int = DEFAULT_NODE_MAX_ENTRIES):
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self._nodes: OrderedDict[str, NodeEntry] = OrderedDict()
+        self._changed: set[str] = set()
+        self._removed: set[str] = set()
+        self.seq = 0
+        self.name = "nodes"
+
+        self.adverts = 0
+        self.repeats = 0
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def get(self, pub_key: str) -> NodeEntry | None:
+        return self._nodes.get(pub_key)
+
+    def observe(self, event: dict[str, Any]) -> NodeEntry | None:
+        """Update the table from one published event; returns the row touched, if any."""
+        advert = (event.get("decoded") or {}).get("advert")
+        if not advert or not advert.get("pub_key"):
+            return None
+        pub_key = advert["pub_key"]
+        ts = event.get("ts") or time.time()
+        radio = event.get("radio") or {}
+        hops = (event.get("routing") or {}).get("path_len")
+
+        node = self._nodes.get(pub_key)
+        if node is None:
+            node = self._nodes[pub_key] = NodeEntry(pub_key, ts)
+            self._removed.discard(pub_key)
+        else:
+            self._nodes.move_to_end(pub_key)
+
+        repeat = "dup_of" in event or (advert.get("timestamp") is not None and advert.get("timestamp") == node.advert_ts)
+        if repeat:
+            self.repeats += 1
+            if hops is not None and (node.hops is None or hops < node.hops):
+                node.hops = hops
+        else:
+            self.adverts += 1
+            node.adverts += 1
+            node.advert_ts = advert.get("timestamp")
+            node.hops = hops
+            appdata = advert.get("appdata") or {}
+            node.flags = appdata.get("flags", node.flags)
+            node.name = appdata.get("node_name", node.name)
+            if "latitude" in appdata and "longitude" in appdata:
+                node.latitude = appdata["latitude"]
+                node.longitude = appdata["longitude"]
+
+        node.last_seen = max(node.last_seen, ts)
+        node.last_rssi = radio.get("rssi")
+        node.last_snr = radio.get("snr")
+        node.source = event.get("source", node.source)
+        self._changed.add(pub_key)
+
+        while len(self._nodes) > self.max_entries:
+            self._remove(next(iter(self._nodes)))
+        return node
+
+    def _remove(self, pub_key: str) -> None:
+        del self._nodes[pub_key]
+        self._changed.discard(pub_key)
+        self._removed.add(pub_key)
+        self.evicted += 1
+
+    def evict(self, now: float | None = None) -> int:
+        """Drop nodes not heard for max_age seconds; returns how many were dropped."""
+        cutoff = (now if now is not None else time.time()) - self.max_age
+        evicted = 0
+        # Rows are in the order they were last heard, so the silent ones come first.
+        while self._nodes:
+            pub_key, node = next(iter(self._nodes.items()))
+            if node.last_seen >= cutoff:
+                break
+            self._remove(pub_key)
+            evicted += 1
+        return evicted
+
+    def snapshot(self) -> dict[str, Any]:
+        return {"type": "nodes", "seq": self.seq, "nodes": [node.describe() for node in self._nodes.values()]}
+
+    def take_delta(self) -> dict[str, Any] | None:
+        """The rows changed and keys removed since the last call, or None if nothing changed."""
+        if not self._changed and not self._removed:
+            return None
+        self.seq += 1
+        delta = {
+            "type": "node_delta",
+            "seq": self.seq,
+            "nodes": [self._nodes[pub_key].describe() for pub_key in self._changed],
+            "removed": sorted(self._removed),
+        }
+        self._changed.clear()
+        self._removed.clear()
+        return delta
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "nodes": len(self._nodes),
+            "adverts": self.adverts,
+            "repeats": self.repeats,
+            "evicted": self.evicted,
+            "seq": self.seq,
+        }
+
+
+class NodeDeltas:
+    """Sends each interval's delta frame (node_delta, or that of another table with the same interface) to the subscribed clients."""
+
+    def __init__(self, table: NodeTable, interval: float = DEFAULT_NODE_DELTA_INTERVAL):
+        self.table = table
+        self.interval = interval
+        self._subscribers: dict[int, Any] = {}
+        self._task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self._subscribers)
+
+    def subscribe(self, sender) -> None:
+        self._subscribers[id(sender)] = sender
+
+    def unsubscribe(self, sender) -> None:
+        self._subscribers.pop(id(sender), None)
+
+    def flush(self) -> None:
+        self.table.evict()
+        delta = self.table.take_delta()
+        # Clients that went away since the last delta are forgotten here.
+        for key, sender in list(self._subscribers.items()):
+            if getattr(sender, "closed", False):
+                del self._subscribers[key]
+        if delta is None or not self._subscribers:
+            return
+        frame = json.dumps(delta)
+        for sender in self._subscribers.values():
+            sender.enqueue(frame)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Sending {self.table.name} deltas failed: {e}")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+def register_node_commands(stream, deltas: NodeDeltas) -> None:
+    """Client message {"type": "nodes"}: a snapshot of the node table, then deltas unless "subscribe" is false."""
+
+    def nodes(sender, message):
+        # Pending changes go out to the current subscribers first, so the snapshot's seq is current.
+        deltas.flush()
+        if message.get("subscribe", True):
+            deltas.subscribe(sender)
+        else:
+            deltas.unsubscribe(sender)
+        sender.enqueue(json.dumps(deltas.table.snapshot()))
+
+    stream.register_command("nodes", nodes)
+
+
+def add_node_table_arguments(parser) -> None:
+    """Register the node table options on an argparse parser."""
+    parser.add_argument(
+        "--node-max-age",
+        type=float,
+        default=DEFAULT_NODE_MAX_AGE,
+        help=f"Seconds a silent node stays in the node table (default: {DEFAULT_NODE_MAX_AGE:g})",
+    )
+    parser.add_argument(
+        "--node-max-entries",
+        type=int,
+        default=DEFAULT_NODE_MAX_ENTRIES,
+        help=f"Nodes kept at most, least recently heard dropped first (default: {DEFAULT_NODE_MAX_ENTRIES})",
+    )
+    parser.add_argument(
+        "--node-delta-interval",
+        type=float,
+        default=DEFAULT_NODE_DELTA_INTERVAL,
+        help=f"Seconds between node_delta frames to subscribed clients (default: {DEFAULT_NODE_DELTA_INTERVAL:g})",
+    )
+
+
+def create_node_table(args) -> NodeDeltas:
+    return NodeDeltas(NodeTable(args.node_max_age, args.node_max_entries), args.node_delta_interval)
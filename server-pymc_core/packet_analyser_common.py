@@ -1,18 +1,25 @@
 #!/usr/bin/env python3
 
+import asyncio
+import logging
 import os
+import signal
 import sys
 import time
-from typing import Any
+from collections import OrderedDict
+from typing import Any, Callable
 
 # Add the src directory to the path so we can import pymc_core
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
 
+from channel_store import ChannelStore, load_channel_file
 from common import create_radio
 
 from pymc_core import LocalIdentity
+from pymc_core.hardware.base import LoRaRadio
 from pymc_core.node.handlers.group_text import GroupTextHandler
 from pymc_core.node.node import MeshNode
+from pymc_core.protocol import Packet
 from pymc_core.protocol.constants import (
     PAYLOAD_TYPE_ACK,
     PAYLOAD_TYPE_ADVERT,
@@ -22,8 +29,10 @@ from pymc_core.protocol.constants import (
     PAYLOAD_TYPE_TRACE,
     PAYLOAD_TYPE_TXT_MSG,
 )
+from pymc_core.protocol.crypto import CryptoUtils
 from pymc_core.protocol.utils import PAYLOAD_TYPES, ROUTE_TYPES, decode_appdata, parse_advert_payload
 
+logger = logging.getLogger("packet_analyser")
 
 PUBLIC_CHANNEL_NAME = "Public"
 PUBLIC_CHANNEL_SECRET = "8b3387e9c5cdea6ac9e5edbaa115cd72"
@@ -31,6 +40,12 @@ PUBLIC_CHANNEL_SECRET = "8b3387e9c5cdea6ac9e5edbaa115cd72"
 TEST_CHANNEL_NAME = "#test"
 TEST_CHANNEL_SECRET = "9cd8fcf22a47333b591d96a2b848b73f"
 
+DEFAULT_DECODE_CACHE_SIZE = 2048
+
+# "file" replays a recording (replay_source.py) and "simulated" generates
+# synthetic traffic (sim_radio.py) instead of opening hardware.
+RADIO_TYPES = ["waveshare", "uconsole", "meshadv-mini", "kiss-tnc", "file", "simulated"]
+
 
 class StaticChannelDB:
     def __init__(self, channels: list[dict[str, Any]]):
@@ -48,13 +63,128 @@ class EmptyContacts:
         return None
 
 
-def create_default_channel_db() -> StaticChannelDB:
-    return StaticChannelDB(
-        [
-            {"name": PUBLIC_CHANNEL_NAME, "secret": PUBLIC_CHANNEL_SECRET},
-            {"name": TEST_CHANNEL_NAME, "secret": TEST_CHANNEL_SECRET},
-        ]
-    )
+DEFAULT_CHANNELS = [
+    {"name": PUBLIC_CHANNEL_NAME, "secret": PUBLIC_CHANNEL_SECRET},
+    {"name": TEST_CHANNEL_NAME, "secret": TEST_CHANNEL_SECRET},
+]
+
+
+def load_channels(channels_file: str | None = None) -> list[dict[str, Any]]:
+    """The built-in channels plus those defined in `channels_file` (which win on name clashes)."""
+    channels = list(DEFAULT_CHANNELS)
+    if channels_file:
+        channels.extend(load_channel_file(channels_file))
+    return channels
+
+
+def create_default_channel_db(channels_file: str | None = None) -> ChannelStore:
+    return ChannelStore(load_channels(channels_file))
+
+
+def install_channel_reload(store: ChannelStore, channels_file: str | None) -> None:
+    """Reload `channels_file` into `store` on SIGHUP. Call from the event loop."""
+    if not channels_file or not hasattr(signal, "SIGHUP"):
+        return
+
+    def reload_channels():
+        try:
+            store.load(load_channels(channels_file))
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Channel reload failed, keeping current channels: {e}")
+            return
+        logger.info(f"Reloaded {len(store)} group channels")
+
+    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reload_channels)
+
+
+def drive_handler(coro) -> None:
+    """Run a packet handler coroutine to completion without an event loop.
+
+    Handlers only await when they have an event service to publish to, which
+    the analyser never gives them.
+    """
+    try:
+        coro.send(None)
+    except StopIteration:
+        pass
+    else:
+        coro.close()
+        raise RuntimeError("handler awaited unexpectedly")
+
+
+class IndexedGroupTextHandler(GroupTextHandler):
+    """GroupTextHandler resolving candidates through a ChannelStore's hash index and cached keys."""
+
+    def _get_channels_by_hash(self, channel_hash: int) -> list[dict]:
+        if isinstance(self.channel_db, ChannelStore):
+            return self.channel_db.by_hash(channel_hash)
+        return super()._get_channels_by_hash(channel_hash)
+
+    def _decrypt_channel_message(self, channel_secret: str, mac: bytes, ciphertext: bytes):
+        key = None
+        if isinstance(self.channel_db, ChannelStore):
+            key = self.channel_db.key_for_secret(channel_secret)
+        if key is None:
+            return super()._decrypt_channel_message(channel_secret, mac, ciphertext)
+        try:
+            if CryptoUtils._hmac_sha256(key, ciphertext)[:2] != mac:
+                return None
+            return CryptoUtils._aes_decrypt(key[:16], ciphertext)
+        except Exception as e:
+            self.log(f"Channel message decryption error: {e}")
+            return None
+
+
+class RawPacketDecoder:
+    """Raw packet bytes to Packets ready for build_packet_json, for sources without a MeshNode.
+
+    Group text is decrypted by the same IndexedGroupTextHandler the analyser
+    node registers, so the events match server.py's.
+    """
+
+    def __init__(self, channel_db: ChannelStore | StaticChannelDB):
+        self.group_handler = IndexedGroupTextHandler(
+            None, EmptyContacts(), lambda _msg: None, None, channel_db=channel_db
+        )
+        self.name = "decoder"
+        self.decoded = 0
+        self.errors = 0
+
+    def parse(self, raw: bytes, rssi: Any = None, snr: Any = None) -> Packet | None:
+        """The parsed packet without decryption, or None when `raw` is not a valid packet."""
+        pkt = Packet()
+        try:
+            pkt.read_from(raw)
+        except (ValueError, IndexError):
+            self.errors += 1
+            return None
+        pkt._rssi = rssi
+        pkt._snr = snr
+        return pkt
+
+    async def packet(self, raw: bytes, rssi: Any = None, snr: Any = None) -> Packet | None:
+        """The parsed and decrypted packet, or None when `raw` is not a valid packet."""
+        pkt = self.parse(raw, rssi, snr)
+        if pkt is None:
+            return None
+        if pkt.get_payload_type() == PAYLOAD_TYPE_GRP_TXT:
+            # Without an event service the handler only decrypts into pkt.decrypted.
+            await self.group_handler(pkt)
+        self.decoded += 1
+        return pkt
+
+    def packet_sync(self, raw: bytes, rssi: Any = None, snr: Any = None) -> Packet | None:
+        """packet() for callers without an event loop, such as decode pool workers."""
+        pkt = self.parse(raw, rssi, snr)
+        if pkt is None:
+            return None
+        if pkt.get_payload_type() == PAYLOAD_TYPE_GRP_TXT:
+            drive_handler(self.group_handler(pkt))
+        self.decoded += 1
+        return pkt
+
+    def stats(self) -> dict[str, Any]:
+        return {"decoded": self.decoded, "errors": self.errors}
 
 
 def _format_path(pkt) -> str:
@@ -183,33 +313,105 @@ def _decode_trace(pkt) -> dict[str, Any]:
         return {"error": str(e)}
 
 
-def decode_by_type(pkt) -> dict[str, Any]:
+# payload_type -> (decoded section key, decoder, cacheable). Cacheable decoders
+# depend on the payload bytes only; decoders reading per-packet state such as
+# handler decryption results must be registered with cacheable=False.
+DECODERS: dict[int, tuple[str, Callable[[Any], dict[str, Any]], bool]] = {}
+
+
+def register_decoder(
+    payload_type: int, key: str, decoder: Callable[[Any], dict[str, Any]], *, cacheable: bool = True
+) -> None:
+    """Decode packets of `payload_type` into decoded[key]. Replaces any earlier decoder."""
+    DECODERS[payload_type] = (key, decoder, cacheable)
+
+
+register_decoder(PAYLOAD_TYPE_ADVERT, "advert", _decode_advert)
+register_decoder(PAYLOAD_TYPE_GRP_TXT, "group_text", _decode_group_text, cacheable=False)
+register_decoder(PAYLOAD_TYPE_TXT_MSG, "text", _decode_text, cacheable=False)
+register_decoder(PAYLOAD_TYPE_ACK, "ack", _decode_ack)
+register_decoder(PAYLOAD_TYPE_CONTROL, "control", _decode_control)
+register_decoder(PAYLOAD_TYPE_PATH, "path", _decode_path)
+register_decoder(PAYLOAD_TYPE_TRACE, "trace", _decode_trace)
+
+
+class DecodeCache:
+    """Bounded LRU of decoded sections keyed on (payload_type, payload bytes).
+
+    Cached sections are shared between events and must be treated as read-only.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_DECODE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple[int, bytes], dict[str, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.name = "decode_cache"
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def resize(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        while len(self._entries) > max(0, max_entries):
+            self._entries.popitem(last=False)
+
+    def get(self, key: tuple[int, bytes]) -> dict[str, Any] | None:
+        decoded = self._entries.get(key)
+        if decoded is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return decoded
+
+    def put(self, key: tuple[int, bytes], decoded: dict[str, Any]) -> None:
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = decoded
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+DECODE_CACHE = DecodeCache()
+
+
+def decode_by_type(pkt, cache: DecodeCache | None = DECODE_CACHE) -> dict[str, Any]:
     ptype = pkt.get_payload_type()
+    entry = DECODERS.get(ptype)
+    if entry is None:
+        return {}
+
+    key, decoder, cacheable = entry
+    if not cacheable or cache is None or cache.max_entries <= 0:
+        return {key: decoder(pkt)}
 
-    if ptype == PAYLOAD_TYPE_ADVERT:
-        return {"advert": _decode_advert(pkt)}
-    if ptype == PAYLOAD_TYPE_GRP_TXT:
-        return {"group_text": _decode_group_text(pkt)}
-    if ptype == PAYLOAD_TYPE_TXT_MSG:
-        return {"text": _decode_text(pkt)}
-    if ptype == PAYLOAD_TYPE_ACK:
-        return {"ack": _decode_ack(pkt)}
-    if ptype == PAYLOAD_TYPE_CONTROL:
-        return {"control": _decode_control(pkt)}
-    if ptype == PAYLOAD_TYPE_PATH:
-        return {"path": _decode_path(pkt)}
-    if ptype == PAYLOAD_TYPE_TRACE:
-        return {"trace": _decode_trace(pkt)}
-
-    return {}
-
-
-def build_packet_json(pkt) -> dict[str, Any]:
+    cache_key = (ptype, bytes(pkt.get_payload()))
+    decoded = cache.get(cache_key)
+    if decoded is None:
+        decoded = {key: decoder(pkt)}
+        cache.put(cache_key, decoded)
+    return decoded
+
+
+def build_packet_json(
+    pkt, rx_ts: float | None = None, decoded: dict[str, Any] | None = None
+) -> dict[str, Any]:
     payload_type = pkt.get_payload_type()
     route_type = pkt.get_route_type()
 
     return {
-        "ts": time.time(),
+        "ts": rx_ts if rx_ts is not None else time.time(),
         "raw_packet": {
             "hex": pkt.write_to().hex() if hasattr(pkt, "write_to") else "",
         },
@@ -234,23 +436,51 @@ def build_packet_json(pkt) -> dict[str, Any]:
         "payload": {
             "hex": _payload_hex(pkt),
         },
-        "decoded": decode_by_type(pkt),
+        "decoded": decoded if decoded is not None else decode_by_type(pkt),
     }
 
 
+def add_decode_arguments(parser) -> None:
+    """Register the decode options on an argparse parser."""
+    parser.add_argument(
+        "--decode-cache-size",
+        type=int,
+        default=DEFAULT_DECODE_CACHE_SIZE,
+        help=f"Decoded payloads memoized for repeats, 0 to disable (default: {DEFAULT_DECODE_CACHE_SIZE})",
+    )
+
+
+def create_source_radio(args, channels: list[dict[str, Any]] | None = None) -> LoRaRadio | None:
+    """The non-hardware radio selected by --radio-type, or None to open real hardware."""
+    if args.radio_type == "file":
+        from replay_source import create_replay_radio
+
+        return create_replay_radio(args)
+    if args.radio_type == "simulated":
+        from sim_radio import create_sim_radio
+
+        return create_sim_radio(args, channels)
+    return None
+
+
 def create_analyser_node(
     *,
     radio_type: str,
     serial_port: str,
     node_name: str = "PacketAnalyser",
-    channel_db: StaticChannelDB | None = None,
+    channel_db: ChannelStore | StaticChannelDB | None = None,
+    radio: LoRaRadio | None = None,
 ) -> MeshNode:
+    """Listening node for the analyser. Pass `radio` to use a radio not built by common.create_radio."""
     identity = LocalIdentity()
 
-    radio = create_radio(radio_type, serial_port)
-    if radio_type == "kiss-tnc":
-        if not radio.connect():
-            raise RuntimeError(f"KISS radio connection failed on {serial_port}")
+    if radio is None:
+        radio = create_radio(radio_type, serial_port)
+        if radio_type == "kiss-tnc":
+            if not radio.connect():
+                raise RuntimeError(f"KISS radio connection failed on {serial_port}")
+        else:
+            radio.begin()
     else:
         radio.begin()
 
@@ -266,7 +496,7 @@ def create_analyser_node(
         event_service=None,
     )
 
-    group_handler = GroupTextHandler(
+    group_handler = IndexedGroupTextHandler(
         identity,
         node.contacts,
         lambda _msg: None,
@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+
+"""
+Optional SQLite store of published events, for historical queries.
+
+Every event the server publishes is queued on the event loop and written by
+one background thread in batched transactions, next to a few indexed
+columns (ts, payload type, source node hash, channel hash and name, advert
+public key, receiving source, payload hash). The event itself is kept as
+its JSON frame, so query results are assembled from stored text without
+decoding it again.
+
+Queries run on their own connection in a worker thread (the database is in
+WAL mode, so they never wait for the writer) and are paginated by a cursor
+on (ts, id): a page ends with the cursor of the next one. They are served
+as {"type": "query"} client messages, streamed in chunks, and as GET
+/query?... on the WebSocket port.
+
+Rows older than the retention period are deleted, and the oldest rows go
+when the database outgrows its size cap; freed pages are returned to the
+filesystem by incremental vacuuming.
+"""
+
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
+
+from subscriptions import PAYLOAD_TYPES, _hash_bytes, _type_codes, packet_hashes
+from wire_format import encode_json
+
+logger = logging.getLogger("packet_store")
+
+DEFAULT_QUERY_PATH = "/query"
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_RETENTION_DAYS = 30.0
+DEFAULT_MAX_MB = 1024.0
+DEFAULT_MAINTENANCE_INTERVAL = 300.0
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+DEFAULT_QUERY_CHUNK_SIZE = 100
+# Rows deleted per statement while enforcing retention, so the writer never holds a long transaction.
+DELETE_BATCH = 5000
+
+_PAYLOAD_TYPE_CODES = {name: code for code, name in PAYLOAD_TYPES.items()}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS packets (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    payload_type INTEGER,
+    src_hash INTEGER,
+    channel_hash INTEGER,
+    channel_name TEXT,
+    pub_key TEXT,
+    source TEXT,
+    pkt_hash TEXT,
+    event TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS packets_ts ON packets (ts);
+CREATE INDEX IF NOT EXISTS packets_type_ts ON packets (payload_type, ts);
+CREATE INDEX IF NOT EXISTS packets_src_ts ON packets (src_hash, ts) WHERE src_hash IS NOT NULL;
+CREATE INDEX IF NOT EXISTS packets_channel_ts ON packets (channel_hash, ts) WHERE channel_hash IS NOT NULL;
+CREATE INDEX IF NOT EXISTS packets_pub_key_ts ON packets (pub_key, ts) WHERE pub_key IS NOT NULL;
+"""
+
+_INSERT = (
+    "INSERT INTO packets (ts, payload_type, src_hash, channel_hash, channel_name, pub_key, source, pkt_hash, event)"
+    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+
+def event_row(event: dict[str, Any]) -> tuple:
+    """The packets row of one published event."""
+    decoded = event.get("decoded") or {}
+    group_text = decoded.get("group_text") or {}
+    advert = decoded.get("advert") or {}
+    _dest, src = packet_hashes(event)
+    return (
+        event.get("ts") or time.time(),
+        (event.get("packet") or {}).get("payload_type"),
+        src,
+        group_text.get("channel_hash"),
+        group_text.get("channel_name"),
+        advert.get("pub_key") or None,
+        event.get("source"),
+        event.get("pkt_hash") or event.get("dup_of"),
+        encode_json(event),
+    )
+
+
+def connect(path: str | Path, readonly: bool = False) -> sqlite3.Connection:
+    if readonly:
+        return sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=30.0, isolation_level=None)
+    conn = sqlite3.connect(str(path), timeout=30.0, isolation_level=None, check_same_thread=False)
+    # Only takes effect on a new database, and must come before anything writes to it.
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def _float(value: Any, what: str) -> float | None:
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid {what}: {value!r}") from None
+
+
+def _strings(value: Any) -> list[str]:
+    values = value if isinstance(value, list) else [value]
+    return [str(v) for v in values]
+
+
+class PacketQuery:
+    """A validated query: the WHERE clause and its page position."""
+
+    def __init__(self, spec: dict[str, Any]):
+        self.start = _float(spec.get("start"), "start")
+        self.end = _float(spec.get("end"), "end")
+        order = str(spec.get("order") or "asc").lower()
+        if order not in ("asc", "desc"):
+            raise ValueError(f"invalid order: {spec.get('order')!r}")
+        self.descending = order == "desc"
+        try:
+            self.limit = int(spec.get("limit") or DEFAULT_PAGE_SIZE)
+        except (TypeError, ValueError):
+            raise ValueError(f"invalid limit: {spec.get('limit')!r}") from None
+        self.limit = max(1, min(MAX_PAGE_SIZE, self.limit))
+
+        clauses: list[str] = []
+        params: list[Any] = []
+
+        def any_of(column: str, values) -> None:
+            values = sorted(values)
+            clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+
+        if self.start is not None:
+            clauses.append("ts >= ?")
+            params.append(self.start)
+        if self.end is not None:
+            clauses.append("ts <= ?")
+            params.append(self.end)
+        if spec.get("payload_type") is not None:
+            any_of("payload_type", _type_codes(spec["payload_type"], _PAYLOAD_TYPE_CODES, "payload type"))
+        if spec.get("src_hash") is not None:
+            any_of("src_hash", _hash_bytes(spec["src_hash"], "src_hash"))
+        if spec.get("channel_hash") is not None:
+            any_of("channel_hash", _hash_bytes(spec["channel_hash"], "channel_hash"))
+        if spec.get("channel") is not None:
+            any_of("channel_name", _strings(spec["channel"]))
+        if spec.get("pub_key") is not None:
+            any_of("pub_key", [key.lower() for key in _strings(spec["pub_key"])])
+        if spec.get("source") is not None:
+            any_of("source", _strings(spec["source"]))
+        if spec.get("pkt_hash") is not None:
+            any_of("pkt_hash", _strings(spec["pkt_hash"]))
+
+        self.cursor = None
+        if spec.get("cursor"):
+            try:
+                ts, row_id = str(spec["cursor"]).split(":", 1)
+                self.cursor = (float(ts), int(row_id))
+            except ValueError:
+                raise ValueError(f"invalid cursor: {spec['cursor']!r}") from None
+            op = "<" if self.descending else ">"
+            clauses.append(f"(ts {op} ? OR (ts = ? AND id {op} ?))")
+            params.extend([self.cursor[0], self.cursor[0], self.cursor[1]])
+
+        self.where = " AND ".join(clauses) or "1"
+        self.params = params
+
+    def sql(self) -> tuple[str, list[Any]]:
+        order = "DESC" if self.descending else "ASC"
+        # One row more than the page tells whether another page follows.
+        return (
+            f"SELECT id, ts, event FROM packets WHERE {self.where} ORDER BY ts {order}, id {order} LIMIT ?",
+            [*self.params, self.limit + 1],
+        )
+
+
+class PacketStore:
+    """Queues events on the event loop and writes them in batches from one background thread."""
+
+    def __init__(
+        self,
+        path: str | Path,
+        *,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+        retention_days: float = DEFAULT_RETENTION_DAYS,
+        max_mb: float = DEFAULT_MAX_MB,
+        maintenance_interval: float = DEFAULT_MAINTENANCE_INTERVAL,
+        chunk_size: int = DEFAULT_QUERY_CHUNK_SIZE,
+    ):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.retention_days = retention_days
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.maintenance_interval = maintenance_interval
+        self.chunk_size = max(1, chunk_size)
+        self.name = "packet_store"
+
+        self._pending: list[dict[str, Any]] = []
+        # One writer thread owns the write connection and keeps batches in order.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="packet-store")
+        self._queries = ThreadPoolExecutor(max_workers=2, thread_name_prefix="packet-query")
+        self._conn: sqlite3.Connection | None = None
+        self._writes: set[asyncio.Future] = set()
+        self._tasks: list[asyncio.Task] = []
+
+        self.queued = 0
+        self.rows = 0
+        self.batches = 0
+        self.deleted = 0
+        self.queries = 0
+        self.errors = 0
+
+    def _open(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = connect(self.path)
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def append(self, event: dict[str, Any]) -> None:
+        """Queue one published event. Cheap and non-blocking; call from the event loop.
+
+        Published events are not changed afterwards, so the row is built on the writer thread.
+        """
+        self._pending.append(event)
+        self.queued += 1
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._pending:
+            return
+        events, self._pending = self._pending, []
+        self._submit(self._write_batch, events)
+
+    def _submit(self, fn, *args) -> None:
+        future = asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        self._writes.add(future)
+        future.add_done_callback(self._writes.discard)
+
+    def _write_batch(self, events: list[dict[str, Any]]) -> None:
+        try:
+            conn = self._open()
+            rows = [event_row(event) for event in events]
+            with conn:
+                conn.execute("BEGIN")
+                conn.executemany(_INSERT, rows)
+            self.rows += len(rows)
+            self.batches += 1
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Packet store write of {len(events)} events failed: {e}")
+
+    def _size(self, conn: sqlite3.Connection) -> int:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        used = conn.execute("PRAGMA page_count").fetchone()[0] - conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return used * page_size
+
+    def _delete_oldest(self, conn: sqlite3.Connection, where: str, params: list[Any], limit: int = DELETE_BATCH) -> int:
+        with conn:
+            cursor = conn.execute(
+                f"DELETE FROM packets WHERE id IN (SELECT id FROM packets WHERE {where} ORDER BY ts LIMIT ?)",
+                [*params, limit],
+            )
+        return cursor.rowcount
+
+    def _maintain(self) -> None:
+        try:
+            conn = self._open()
+            deleted = 0
+            if self.retention_days > 0:
+                cutoff = time.time() - self.retention_days * 86400
+                while (n := self._delete_oldest(conn, "ts < ?", [cutoff])) > 0:
+                    deleted += n
+            if self.max_bytes > 0 and self._size(conn) > self.max_bytes:
+                # About 1% of the rows per step, so the cap is not overshot by much.
+                rows = conn.execute("SELECT count(*) FROM packets").fetchone()[0]
+                step = max(1, min(DELETE_BATCH, rows // 100))
+                while self._size(conn) > self.max_bytes and (n := self._delete_oldest(conn, "1", [], step)) > 0:
+                    deleted += n
+            if deleted:
+                self.deleted += deleted
+                logger.info(f"Packet store: deleted {deleted} old rows")
+            # Hand freed pages back to the filesystem and keep the WAL short. executescript runs
+            # incremental_vacuum to completion; a single execute() step frees only one page.
+            conn.executescript("PRAGMA incremental_vacuum;")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            conn.execute("PRAGMA optimize")
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Packet store maintenance failed: {e}")
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+
+    async def _maintain_periodically(self) -> None:
+        while True:
+            self._submit(self._maintain)
+            await asyncio.sleep(self.maintenance_interval)
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        logger.info(f"Storing packets in {self.path}")
+        if self.flush_interval > 0:
+            self._tasks.append(asyncio.create_task(self._flush_periodically()))
+        if self.maintenance_interval > 0:
+            self._tasks.append(asyncio.create_task(self._maintain_periodically()))
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self.flush()
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+        self._queries.shutdown(wait=True)
+        self._executor.submit(self._close_connection).result()
+        self._executor.shutdown(wait=True)
+
+    def _close_connection(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _run_query(self, query: PacketQuery) -> tuple[list[str], str | None]:
+        sql, params = query.sql()
+        conn = connect(self.path, readonly=True)
+        try:
+            rows = conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+        cursor = None
+        if len(rows) > query.limit:
+            rows = rows[: query.limit]
+            last_id, last_ts, _event = rows[-1]
+            cursor = f"{last_ts!r}:{last_id}"
+        return [event for _id, _ts, event in rows], cursor
+
+    async def query(self, spec: dict[str, Any]) -> tuple[list[str], str | None]:
+        """One page of stored event frames matching `spec`, and the cursor of the next page (or None).
+
+        Raises ValueError for an invalid spec.
+        """
+        query = PacketQuery(spec)
+        self.queries += 1
+        if not self.path.exists():
+            return [], None
+        return await asyncio.get_running_loop().run_in_executor(self._queries, self._run_query, query)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "queued": self.queued,
+            "pending": len(self._pending),
+            "rows": self.rows,
+            "batches": self.batches,
+            "deleted": self.deleted,
+            "queries": self.queries,
+            "errors": self.errors,
+        }
+
+
+def iter_query_chunks(request: Any, frames: list[str], cursor: str | None, chunk_size: int):
+    """Wrap a page of stored frames into query result envelopes, the last with "done" and the next cursor."""
+    tag = json.dumps(request)
+    if not frames:
+        yield '{"type":"query","request":' + tag + ',"events":[],"done":true,"cursor":' + json.dumps(cursor) + "}"
+        return
+    for start in range(0, len(frames), chunk_size):
+        tail = ',"done":false}'
+        if start + chunk_size >= len(frames):
+            tail = ',"done":true,"cursor":' + json.dumps(cursor) + "}"
+        yield '{"type":"query","request":' + tag + ',"events":[' + ",".join(frames[start : start + chunk_size]) + "]" + tail
+
+
+def query_spec_from_params(params: dict[str, list[str]]) -> dict[str, Any]:
+    """A query spec from HTTP query parameters; repeated or comma-separated values mean "any of"."""
+    spec: dict[str, Any] = {}
+    for key, values in params.items():
+        items = [item for value in values for item in value.split(",") if item != ""]
+        if key in ("payload_type", "route_type"):
+            spec[key] = [int(item) if item.isdigit() else item for item in items]
+        elif key in ("src_hash", "channel_hash", "channel", "pub_key", "source", "pkt_hash"):
+            spec[key] = items
+        elif items:
+            spec[key] = items[-1]
+    return spec
+
+
+def register_store_commands(stream, store: PacketStore, path: str = DEFAULT_QUERY_PATH) -> None:
+    """{"type": "query", ...} client messages, and GET `path` on the WebSocket port."""
+
+    async def query(sender, message):
+        request = message.get("request")
+        try:
+            frames, cursor = await store.query(message)
+        except ValueError as e:
+            sender.enqueue(json.dumps({"type": "error", "request": "query", "message": str(e)}))
+            return
+        logger.info(f"WS client {sender.peer} query: {len(frames)} events")
+        sender.enqueue_stream(iter_query_chunks(request, frames, cursor, store.chunk_size))
+
+    async def http_query(params: dict[str, list[str]]) -> tuple[str, str]:
+        frames, cursor = await store.query(query_spec_from_params(params))
+        return "application/json", '{"events":[' + ",".join(frames) + '],"cursor":' + json.dumps(cursor) + "}"
+
+    stream.register_command("query", query)
+    if path:
+        stream.register_http(path, http_query)
+
+
+def add_store_arguments(parser) -> None:
+    """Register the packet store options on an argparse parser."""
+    parser.add_argument(
+        "--db",
+        default=None,
+        help="Store every published event in this SQLite database for historical queries",
+    )
+    parser.add_argument(
+        "--db-retention-days",
+        type=float,
+        default=DEFAULT_RETENTION_DAYS,
+        help=f"Delete stored events older than this many days, 0 to keep them (default: {DEFAULT_RETENTION_DAYS:g})",
+    )
+    parser.add_argument(
+        "--db-max-mb",
+        type=float,
+        default=DEFAULT_MAX_MB,
+        help=f"Delete the oldest stored events above this database size in MiB, 0 for no cap (default: {DEFAULT_MAX_MB:g})",
+    )
+    parser.add_argument(
+        "--db-batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help=f"Events written per transaction (default: {DEFAULT_BATCH_SIZE})",
+    )
+    parser.add_argument(
+        "--db-flush-interval",
+        type=float,
+        default=DEFAULT_FLUSH_INTERVAL,
+        help=f"Seconds between writes when traffic is low (default: {DEFAULT_FLUSH_INTERVAL:g})",
+    )
+    parser.add_argument(
+        "--db-query-path",
+        default=DEFAULT_QUERY_PATH,
+        help=f"HTTP path serving queries next to /ws, empty to disable (default: {DEFAULT_QUERY_PATH})",
+    )
+
+
+def create_packet_store(args) -> PacketStore | None:
+    if not args.db:
+        return None
+    return PacketStore(
+        args.db,
+        batch_size=args.db_batch_size,
+        flush_interval=args.db_flush_interval,
+        retention_days=args.db_retention_days,
+        max_mb=args.db_max_mb,
+        chunk_size=args.backfill_chunk_size,
+    )
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+"""
+Ring buffer of recently broadcast frames, replayed to clients on request.
+
+Frames are kept exactly as they were sent, so a backfill never re-runs
+build_packet_json or json.dumps. The buffer is capped by both event count
+and total size.
+"""
+
+from collections import deque
+from itertools import islice
+from typing import Any, Iterator
+from urllib.parse import parse_qs, urlsplit
+
+DEFAULT_REPLAY_MAX_EVENTS = 5000
+DEFAULT_REPLAY_MAX_BYTES = 8 * 1024 * 1024
+DEFAULT_BACKFILL_CHUNK_SIZE = 100
+
+
+class ReplayBuffer:
+    def __init__(
+        self,
+        max_events: int = DEFAULT_REPLAY_MAX_EVENTS,
+        max_bytes: int = DEFAULT_REPLAY_MAX_BYTES,
+    ):
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        # Entries are (ts, frame, size); frames are the serialized text sent to clients,
+        # size is its UTF-8 length, which is what goes over the wire and counts towards max_bytes.
+        self._frames: deque[tuple[float, str, int]] = deque()
+        self._bytes = 0
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+    def append(self, ts: float, frame: str) -> None:
+        if self.max_events <= 0:
+            return
+
+        # Most frames are ASCII JSON, where the length in characters is the length in bytes.
+        size = len(frame) if frame.isascii() else len(frame.encode("utf-8"))
+        self._frames.append((ts, frame, size))
+        self._bytes += size
+
+        while self._frames and (len(self._frames) > self.max_events or self._bytes > self.max_bytes):
+            _, _, old_size = self._frames.popleft()
+            self._bytes -= old_size
+            self.evicted += 1
+
+    def last(self, count: int) -> list[str]:
+        if count <= 0:
+            return []
+        start = max(0, len(self._frames) - count)
+        return [frame for _, frame, _ in islice(self._frames, start, None)]
+
+    def since(self, ts: float) -> list[str]:
+        # Frames are appended in receive order, so walk back from the newest.
+        out: list[str] = []
+        for frame_ts, frame, _ in reversed(self._frames):
+            if frame_ts <= ts:
+                break
+            out.append(frame)
+        out.reverse()
+        return out
+
+    def select(self, request: dict[str, Any]) -> list[str]:
+        """Frames matching a backfill request ({"last": N} and/or {"since": ts})."""
+        if "since" not in request:
+            return self.last(int(request.get("last", 0)))
+
+        frames = self.since(float(request["since"]))
+        if "last" in request:
+            last = int(request["last"])
+            frames = frames[-last:] if last > 0 else []
+        return frames
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "events": len(self._frames),
+            "bytes": self._bytes,
+            "max_events": self.max_events,
+            "max_bytes": self.max_bytes,
+            "evicted": self.evicted,
+        }
+
+
+def iter_backfill_chunks(frames: list[str], chunk_size: int = DEFAULT_BACKFILL_CHUNK_SIZE) -> Iterator[str]:
+    """Wrap stored frames into backfill envelopes of at most `chunk_size` events.
+
+    The envelopes are built by string concatenation of the stored JSON, so the
+    events are never decoded or re-encoded. The last chunk carries "done": true.
+    """
+    chunk_size = max(1, chunk_size)
+    total = len(frames)
+    if total == 0:
+        yield '{"type":"backfill","events":[],"done":true}'
+        return
+
+    for start in range(0, total, chunk_size):
+        chunk = frames[start : start + chunk_size]
+        done = "true" if start + chunk_size >= total else "false"
+        yield '{"type":"backfill","events":[' + ",".join(chunk) + '],"done":' + done + "}"
+
+
+def backfill_request_from_query(path: str | None) -> dict[str, Any] | None:
+    """Parse "?backfill=N" / "?since=TS" from the WebSocket request path."""
+    if not path or "?" not in path:
+        return None
+
+    query = parse_qs(urlsplit(path).query)
+    request: dict[str, Any] = {}
+    try:
+        if "backfill" in query:
+            request["last"] = int(query["backfill"][0])
+        if "since" in query:
+            request["since"] = float(query["since"][0])
+    except ValueError:
+        return None
+    return request or None
+
+
+def backfill_request_from_message(message: dict[str, Any]) -> dict[str, Any] | None:
+    """Validate a {"type": "backfill", "last": N, "since": TS} client message."""
+    request: dict[str, Any] = {}
+    try:
+        if message.get("last") is not None:
+            request["last"] = int(message["last"])
+        if message.get("since") is not None:
+            request["since"] = float(message["since"])
+    except (TypeError, ValueError):
+        return None
+    return request or None
+
+
+def add_replay_arguments(parser) -> None:
+    """Register the shared replay buffer command line options on an argparse parser."""
+    parser.add_argument(
+        "--replay-max-events",
+        type=int,
+        default=DEFAULT_REPLAY_MAX_EVENTS,
+        help=f"Recent events kept for client backfill, 0 to disable (default: {DEFAULT_REPLAY_MAX_EVENTS})",
+    )
+    parser.add_argument(
+        "--replay-max-bytes",
+        type=int,
+        default=DEFAULT_REPLAY_MAX_BYTES,
+        help=f"Size cap of the backfill buffer in bytes (default: {DEFAULT_REPLAY_MAX_BYTES})",
+    )
+    parser.add_argument(
+        "--backfill-chunk-size",
+        type=int,
+        default=DEFAULT_BACKFILL_CHUNK_SIZE,
+        help=f"Events per backfill frame (default: {DEFAULT_BACKFILL_CHUNK_SIZE})",
+    )
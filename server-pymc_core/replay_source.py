@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+"""
+File-backed stand-in for the radio, for running the analyser without hardware.
+
+ReplayRadio implements pymc_core's LoRaRadio interface and feeds recorded
+packets to the dispatcher, so they go through the same handlers, decoding
+and WebSocket fan-out as live traffic. Accepted inputs:
+
+  * a capture directory or .seg file written with --capture-dir
+  * NDJSON as printed by monitor-packets-cli.py (raw_packet.hex, ts, radio)
+  * plain text with one raw packet in hex per line (replayed at 1 packet/s
+    at real-time speed, as the lines carry no timestamps)
+
+Speed is "realtime", "<N>x" (e.g. "10x") or "max".
+"""
+
+import asyncio
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Callable, Iterator
+
+from capture_log import SEGMENT_SUFFIX, CaptureRecord, read_capture, read_segment
+
+from pymc_core.hardware.base import LoRaRadio
+
+logger = logging.getLogger("replay_source")
+
+
+def parse_speed(value: str) -> float:
+    """Speed factor for a --input-speed value; 0 means as fast as possible."""
+    value = value.strip().lower()
+    if value == "max":
+        return 0.0
+    if value == "realtime":
+        return 1.0
+    try:
+        speed = float(value.removesuffix("x"))
+    except ValueError:
+        raise ValueError(f"invalid speed {value!r}: use 'realtime', 'max' or e.g. '10x'") from None
+    if speed <= 0:
+        raise ValueError("speed must be positive")
+    return speed
+
+
+def _iter_text_records(path: Path) -> Iterator[CaptureRecord]:
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                if line.startswith("{"):
+                    event = json.loads(line)
+                    raw_hex = (event.get("raw_packet") or {}).get("hex")
+                    if not raw_hex:
+                        continue
+                    radio = event.get("radio") or {}
+                    yield CaptureRecord(
+                        float(event.get("ts") or lineno), bytes.fromhex(raw_hex), radio.get("rssi"), radio.get("snr")
+                    )
+                else:
+                    yield CaptureRecord(float(lineno), bytes.fromhex(line), None, None)
+            except ValueError as e:
+                logger.warning(f"{path}:{lineno}: skipped unreadable line: {e}")
+
+
+def iter_replay_records(path: str | Path) -> Iterator[CaptureRecord]:
+    path = Path(path)
+    if path.is_dir():
+        return read_capture(path)
+    if path.suffix == SEGMENT_SUFFIX:
+        return read_segment(path)
+    return _iter_text_records(path)
+
+
+class ReplayRadio(LoRaRadio):
+    """LoRaRadio delivering recorded packets to the RX callback at a chosen speed."""
+
+    def __init__(self, path: str | Path, speed: float = 1.0, loop_count: int = 1, start_delay: float = 0.0):
+        self.path = Path(path)
+        self.speed = speed
+        self.loop_count = loop_count
+        self.start_delay = start_delay
+        # When set and returning True, delivery pauses (used to avoid overrunning the ingest queue at max speed).
+        self.backpressure: Callable[[], bool] | None = None
+
+        self._rx_callback = None
+        self._callback_set = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.finished = asyncio.Event()
+        self._last_rssi = 0
+        self._last_snr = 0.0
+
+        self.delivered = 0
+
+    def set_rx_callback(self, callback) -> None:
+        self._rx_callback = callback
+        self._callback_set.set()
+
+    def begin(self):
+        if not self.path.exists():
+            raise FileNotFoundError(f"Replay input not found: {self.path}")
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self) -> None:
+        await self._callback_set.wait()
+        if self.start_delay > 0:
+            await asyncio.sleep(self.start_delay)
+
+        started = time.monotonic()
+        passes = 0
+        while self.loop_count <= 0 or passes < self.loop_count:
+            passes += 1
+            await self._replay_once()
+
+        elapsed = time.monotonic() - started
+        rate = self.delivered / elapsed if elapsed > 0 else 0.0
+        logger.info(f"Replay of {self.path} finished: {self.delivered} packets in {elapsed:.1f}s ({rate:.0f}/s)")
+        self.finished.set()
+
+    async def _replay_once(self) -> None:
+        first_ts = None
+        anchor = time.monotonic()
+        for record in iter_replay_records(self.path):
+            if self.speed > 0:
+                if first_ts is None:
+                    first_ts = record.ts
+                delay = anchor + (record.ts - first_ts) / self.speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            while self.backpressure is not None and self.backpressure():
+                await asyncio.sleep(0.001)
+
+            self._last_rssi = record.rssi if record.rssi is not None else 0
+            self._last_snr = record.snr if record.snr is not None else 0.0
+            self._rx_callback(record.raw, record.rssi, record.snr)
+            self.delivered += 1
+            # Let the dispatcher task for this packet run before producing the next one.
+            await asyncio.sleep(0)
+
+    async def send(self, data: bytes):
+        # Nothing is transmitted during a replay.
+        return None
+
+    async def wait_for_rx(self) -> bytes:
+        await asyncio.Event().wait()
+
+    def sleep(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def get_last_rssi(self) -> int:
+        return self._last_rssi
+
+    def get_last_snr(self) -> float:
+        return self._last_snr
+
+
+def add_replay_source_arguments(parser) -> None:
+    """Register the options of --radio-type file on an argparse parser."""
+    parser.add_argument(
+        "--input",
+        default=None,
+        help="Recording to replay with --radio-type file: capture dir/.seg, CLI NDJSON or hex lines",
+    )
+    parser.add_argument(
+        "--input-speed",
+        default="realtime",
+        help="Replay speed: realtime, <N>x (e.g. 10x) or max (default: realtime)",
+    )
+    parser.add_argument(
+        "--input-loops",
+        type=int,
+        default=1,
+        help="Times to replay the input, 0 for forever (default: 1)",
+    )
+    parser.add_argument(
+        "--input-delay",
+        type=float,
+        default=0.0,
+        help="Seconds to wait before the replay starts, e.g. to let clients connect (default: 0)",
+    )
+
+
+def create_replay_radio(args) -> ReplayRadio:
+    if not args.input:
+        raise ValueError("--radio-type file needs --input")
+    return ReplayRadio(args.input, parse_speed(args.input_speed), args.input_loops, args.input_delay)
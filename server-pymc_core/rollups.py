@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+"""
+Rolling statistics at several time resolutions, for dashboards.
+
+Each resolution (by default 10 s for an hour, 1 min for a day and 1 h for a
+week) is a ring of preallocated buckets; a packet updates the bucket of its
+timestamp at every resolution, and a bucket is reset when the ring comes
+round to it again, so the work per packet is constant and memory is fixed.
+A bucket holds packet counts per payload and route type, RSSI/SNR
+count/min/avg/max overall and per transmitting node hash, and how many
+group and direct text messages were decrypted.
+
+Clients ask with {"type": "rollups", "resolution": 60} and get every bucket
+of that resolution still in the ring; unless they pass "subscribe": false
+they then receive {"type": "rollup", ...} updates with the buckets that
+changed, sent every interval.
+"""
+
+import asyncio
+import json
+import logging
+import math
+from typing import Any
+
+from subscriptions import PAYLOAD_TYPES, ROUTE_TYPES, packet_hashes
+
+logger = logging.getLogger("rollups")
+
+DEFAULT_RESOLUTIONS = "10:360,60:1440,3600:168"
+DEFAULT_UPDATE_INTERVAL = 2.0
+
+_PAYLOAD_GRP_TXT = 0x05
+_PAYLOAD_TXT_MSG = 0x02
+_FLOOD_ROUTES = (0x00, 0x01)
+
+
+class _Signal:
+    """count/sum/min/max of one RSSI or SNR series."""
+
+    __slots__ = ("n", "total", "low", "high")
+
+    def __init__(self):
+        self.n = 0
+        self.total = 0.0
+        self.low = math.inf
+        self.high = -math.inf
+
+    def add(self, value: float) -> None:
+        self.n += 1
+        self.total += value
+        if value < self.low:
+            self.low = value
+        if value > self.high:
+            self.high = value
+
+    def describe(self) -> dict[str, Any] | None:
+        if not self.n:
+            return None
+        return {"n": self.n, "min": self.low, "avg": round(self.total / self.n, 2), "max": self.high}
+
+
+class _Bucket:
+    __slots__ = (
+        "start",
+        "packets",
+        "unique",
+        "payload_types",
+        "route_types",
+        "rssi",
+        "snr",
+        "nodes",
+        "group_text",
+        "group_text_decrypted",
+        "text",
+        "text_decrypted",
+    )
+
+    def __init__(self):
+        self.reset(-1.0)
+
+    def reset(self, start: float) -> None:
+        self.start = start
+        self.packets = 0
+        self.unique = 0
+        # Indexed by the 4-bit payload type and 2-bit route type.
+        self.payload_types = [0] * 16
+        self.route_types = [0] * 4
+        self.rssi = _Signal()
+        self.snr = _Signal()
+        # Transmitter hash -> (rssi, snr), for the nodes heard in this bucket only.
+        self.nodes: dict[int, tuple[_Signal, _Signal]] = {}
+        self.group_text = 0
+        self.group_text_decrypted = 0
+        self.text = 0
+        self.text_decrypted = 0
+
+    def describe(self, resolution: float, nodes: bool = True) -> dict[str, Any]:
+        out = {
+            "t": self.start,
+            "resolution": resolution,
+            "packets": self.packets,
+            "unique": self.unique,
+            "payload_types": {
+                PAYLOAD_TYPES.get(code, str(code)): n for code, n in enumerate(self.payload_types) if n
+            },
+            "route_types": {ROUTE_TYPES.get(code, str(code)): n for code, n in enumerate(self.route_types) if n},
+            "rssi": self.rssi.describe(),
+            "snr": self.snr.describe(),
+            "group_text": {"total": self.group_text, "decrypted": self.group_text_decrypted},
+            "text": {"total": self.text, "decrypted": self.text_decrypted},
+        }
+        if nodes:
+            out["nodes"] = {
+                f"{node:02x}": {"rssi": rssi.describe(), "snr": snr.describe()}
+                for node, (rssi, snr) in self.nodes.items()
+            }
+        return out
+
+
+class RollupSeries:
+    """A ring of `size` buckets of `resolution` seconds each."""
+
+    def __init__(self, resolution: float, size: int):
+        if resolution <= 0 or size < 1:
+            raise ValueError(f"invalid rollup resolution {resolution:g}s x {size}")
+        self.resolution = resolution
+        self.size = size
+        self._buckets = [_Bucket() for _ in range(size)]
+        # Slots changed since the last update was taken.
+        self._dirty: set[int] = set()
+
+    def bucket(self, ts: float) -> _Bucket | None:
+        """The bucket covering `ts`, cleared first if it still holds an older period; None if too old."""
+        period = math.floor(ts / self.resolution)
+        slot = period % self.size
+        bucket = self._buckets[slot]
+        start = period * self.resolution
+        if bucket.start != start:
+            if bucket.start > start:
+                # Older than the ring reaches.
+                return None
+            bucket.reset(start)
+        self._dirty.add(slot)
+        return bucket
+
+    def buckets(self, now: float | None = None) -> list[_Bucket]:
+        """Buckets still in the window ending at the newest one, oldest first."""
+        filled = [b for b in self._buckets if b.start >= 0]
+        if not filled:
+            return []
+        newest = max(b.start for b in filled) if now is None else math.floor(now / self.resolution) * self.resolution
+        oldest = newest - (self.size - 1) * self.resolution
+        return sorted((b for b in filled if oldest <= b.start <= newest), key=lambda b: b.start)
+
+    def take_dirty(self) -> list[_Bucket]:
+        dirty = sorted((self._buckets[slot] for slot in self._dirty), key=lambda b: b.start)
+        self._dirty.clear()
+        return dirty
+
+
+def _transmitter(event: dict[str, Any], src: int | None) -> int | None:
+    """Hash of the node the receiver measured: the last flood hop, or the originator heard directly."""
+    if (event.get("packet") or {}).get("route_type") not in _FLOOD_ROUTES:
+        # A direct path lists the hops still ahead, not who sent it.
+        return None
+    try:
+        path = bytes.fromhex((event.get("routing") or {}).get("path") or "")
+    except ValueError:
+        return None
+    return path[-1] if path else src
+
+
+class Rollups:
+    """Feeds every published event into each resolution's ring."""
+
+    def __init__(self, resolutions: list[tuple[float, int]]):
+        self.series = {resolution: RollupSeries(resolution, size) for resolution, size in resolutions}
+        self.name = "rollups"
+        self.observed = 0
+
+    def observe(self, event: dict[str, Any]) -> None:
+        packet = event.get("packet") or {}
+        ptype = packet.get("payload_type")
+        rtype = packet.get("route_type")
+        radio = event.get("radio") or {}
+        rssi, snr = radio.get("rssi"), radio.get("snr")
+        decoded = event.get("decoded") or {}
+        unique = "dup_of" not in event
+        _dest, src = packet_hashes(event) if "decoded" in event else (None, None)
+        # The signal belongs to whoever transmitted this copy, as for topology's final hop.
+        heard = _transmitter(event, src)
+        decrypted = None
+        if ptype == _PAYLOAD_GRP_TXT:
+            decrypted = bool((decoded.get("group_text") or {}).get("decrypted"))
+        elif ptype == _PAYLOAD_TXT_MSG:
+            decrypted = bool((decoded.get("text") or {}).get("decrypted"))
+
+        ts = event.get("ts") or 0.0
+        for series in self.series.values():
+            bucket = series.bucket(ts)
+            if bucket is None:
+                continue
+            bucket.packets += 1
+            if unique:
+                bucket.unique += 1
+            if ptype is not None:
+                bucket.payload_types[ptype & 0x0F] += 1
+            if rtype is not None:
+                bucket.route_types[rtype & 0x03] += 1
+            if rssi is not None:
+                bucket.rssi.add(rssi)
+            if snr is not None:
+                bucket.snr.add(snr)
+            if heard is not None and (rssi is not None or snr is not None):
+                node = bucket.nodes.get(heard)
+                if node is None:
+                    node = bucket.nodes[heard] = (_Signal(), _Signal())
+                if rssi is not None:
+                    node[0].add(rssi)
+                if snr is not None:
+                    node[1].add(snr)
+            if decrypted is not None and unique:
+                if ptype == _PAYLOAD_GRP_TXT:
+                    bucket.group_text += 1
+                    bucket.group_text_decrypted += decrypted
+                else:
+                    bucket.text += 1
+                    bucket.text_decrypted += decrypted
+        self.observed += 1
+
+    def stats(self) -> dict[str, Any]:
+        return {"observed": self.observed, "resolutions": len(self.series)}
+
+
+class RollupFeed:
+    """Sends the buckets changed each interval to the clients subscribed to their resolution."""
+
+    def __init__(self, rollups: Rollups, interval: float = DEFAULT_UPDATE_INTERVAL):
+        self.rollups = rollups
+        self.interval = interval
+        # id(sender) -> (sender, {resolution: include per-node stats})
+        self._subscribers: dict[int, tuple[Any, dict[float, bool]]] = {}
+        self._task: asyncio.Task | None = None
+
+    def subscribe(self, sender, resolution: float, nodes: bool = True) -> None:
+        entry = self._subscribers.setdefault(id(sender), (sender, {}))
+        entry[1][resolution] = nodes
+
+    def unsubscribe(self, sender, resolution: float) -> None:
+        entry = self._subscribers.get(id(sender))
+        if entry is not None:
+            entry[1].pop(resolution, None)
+            if not entry[1]:
+                del self._subscribers[id(sender)]
+
+    def flush(self) -> None:
+        for key, (sender, _resolutions) in list(self._subscribers.items()):
+            if getattr(sender, "closed", False):
+                del self._subscribers[key]
+        for resolution, series in self.rollups.series.items():
+            dirty = series.take_dirty()
+            if not dirty:
+                continue
+            frames: dict[bool, str] = {}
+            for sender, resolutions in self._subscribers.values():
+                nodes = resolutions.get(resolution)
+                if nodes is None:
+                    continue
+                frame = frames.get(nodes)
+                if frame is None:
+                    frame = frames[nodes] = json.dumps(
+                        {"type": "rollup", "resolution": resolution, "buckets": [b.describe(resolution, nodes) for b in dirty]}
+                    )
+                sender.enqueue(frame)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Sending rollup updates failed: {e}")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+def register_rollup_commands(stream, feed: RollupFeed) -> None:
+    """Client message {"type": "rollups", "resolution": seconds}: the buckets, then updates unless "subscribe" is false."""
+    rollups = feed.rollups
+
+    def reply_error(sender, message: str) -> None:
+        sender.enqueue(json.dumps({"type": "error", "request": "rollups", "message": message}))
+
+    def handler(sender, message):
+        resolutions = sorted(rollups.series)
+        try:
+            resolution = float(message.get("resolution", resolutions[0]))
+        except (TypeError, ValueError):
+            reply_error(sender, "resolution must be a number")
+            return
+        series = rollups.series.get(resolution)
+        if series is None:
+            reply_error(sender, f"unknown resolution, use one of {', '.join(f'{r:g}' for r in resolutions)}")
+            return
+        nodes = bool(message.get("nodes", True))
+        # Pending changes go out first, so updates after the snapshot are all new.
+        feed.flush()
+        if message.get("subscribe", True):
+            feed.subscribe(sender, resolution, nodes)
+        else:
+            feed.unsubscribe(sender, resolution)
+        sender.enqueue(
+            json.dumps(
+                {
+                    "type": "rollups",
+                    "resolution": resolution,
+                    "size": series.size,
+                    "resolutions": resolutions,
+                    "buckets": [b.describe(resolution, nodes) for b in series.buckets()],
+                }
+            )
+        )
+
+    stream.register_command("rollups", handler)
+
+
+def parse_resolutions(spec: str) -> list[tuple[float, int]]:
+    """ "10:360,60:1440" -> [(10.0, 360), (60.0, 1440)] (seconds per bucket : buckets kept)."""
+    out = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            resolution, size = item.split(":", 1)
+            out.append((float(resolution), int(size)))
+        except ValueError:
+            raise ValueError(f"invalid rollup resolution {item!r}, expected seconds:buckets") from None
+    return out
+
+
+def add_rollup_arguments(parser) -> None:
+    """Register the rollup options on an argparse parser."""
+    parser.add_argument(
+        "--rollup-resolutions",
+        default=DEFAULT_RESOLUTIONS,
+        help=f"Rollup resolutions as seconds:buckets, comma-separated, empty to disable (default: {DEFAULT_RESOLUTIONS})",
+    )
+    parser.add_argument(
+        "--rollup-update-interval",
+        type=float,
+        default=DEFAULT_UPDATE_INTERVAL,
+        help=f"Seconds between rollup updates to subscribed clients (default: {DEFAULT_UPDATE_INTERVAL:g})",
+    )
+
+
+def create_rollups(args) -> RollupFeed | None:
+    resolutions = parse_resolutions(args.rollup_resolutions or "")
+    if not resolutions:
+        return None
+    return RollupFeed(Rollups(resolutions), args.rollup_update_interval)
@@ -4,12 +4,46 @@ import argparse
 import asyncio
 import json
 import logging
-from typing import Set
+import time
 
-import websockets
-from websockets.server import WebSocketServerProtocol
-
-from packet_analyser_common import build_packet_json, create_analyser_node
+from airtime import add_airtime_arguments, create_airtime, register_airtime_commands, source_profiles
+from capture_log import add_capture_arguments, create_capture_writer
+from channel_store import add_channel_arguments, register_channel_commands
+from column_store import add_column_store_arguments, create_column_store, register_analytics_commands
+from decode_pool import add_decode_pool_arguments, create_decode_pool
+from dedup import DEDUP_SUPPRESS, add_dedup_arguments, create_deduplicator
+from ingest import ArrivalStamps, IngestQueue, add_ingest_arguments, log_stats_periodically
+from metrics import (
+    STAGE_DECODE,
+    STAGE_QUEUE,
+    add_metrics_arguments,
+    create_metrics,
+    register_metrics_endpoint,
+)
+from node_table import add_node_table_arguments, create_node_table, register_node_commands
+from packet_analyser_common import (
+    DECODE_CACHE,
+    RADIO_TYPES,
+    RawPacketDecoder,
+    add_decode_arguments,
+    build_packet_json,
+    create_analyser_node,
+    create_default_channel_db,
+    create_source_radio,
+    install_channel_reload,
+)
+from packet_store import add_store_arguments, create_packet_store, register_store_commands
+from replay_buffer import ReplayBuffer, add_replay_arguments
+from replay_source import ReplayRadio, add_replay_source_arguments
+from rollups import add_rollup_arguments, create_rollups, register_rollup_commands
+from sim_radio import add_sim_radio_arguments
+from sources import add_source_arguments, create_sources, register_source_commands
+from stream_server import PacketStreamServer
+from topology import add_topology_arguments, create_topology, register_topology_commands
+from tracing import add_trace_arguments, create_tracing, install_trace_signals, register_trace_commands
+from wire_format import add_wire_format_arguments, websocket_compression_options
+from ws_fanout import add_fanout_arguments, create_batching
+from ws_workers import EventFeed, add_ws_worker_arguments
 
 
 logging.basicConfig(
@@ -18,69 +52,262 @@ logging.basicConfig(
 logger = logging.getLogger("packet_analyser_server")
 
 
-async def run_server(radio_type: str, serial_port: str, host: str, port: int):
-    node = create_analyser_node(
-        radio_type=radio_type,
-        serial_port=serial_port,
-        node_name="PacketAnalyserServer",
-    )
+async def run_server(args: argparse.Namespace):
+    channels = create_default_channel_db(args.channels_file)
+    logger.info(f"Loaded {len(channels)} group channels")
+    # With --source the server reads its sources directly and decodes raw
+    # packets itself; otherwise the single --radio-type feeds a MeshNode.
+    if args.decode_workers > 0 and not args.source:
+        # Workers decode raw bytes, so the single radio is read as a source rather than through a MeshNode.
+        port = f":{args.serial_port}" if args.radio_type == "kiss-tnc" else ""
+        args.source = [f"{args.radio_type}{port}"]
+    node = None
+    decoder = None
+    pool = None
+    if args.source:
+        decoder = RawPacketDecoder(channels)
+        pool = create_decode_pool(args, channels)
+    else:
+        node = create_analyser_node(
+            radio_type=args.radio_type,
+            serial_port=args.serial_port,
+            node_name="PacketAnalyserServer",
+            channel_db=channels,
+            radio=create_source_radio(args, channels.get_channels()),
+        )
 
-    clients: Set[WebSocketServerProtocol] = set()
+    metrics = create_metrics(args)
+    if args.ws_workers > 0:
+        # Worker processes serve /ws; they keep their own replay buffers and batching.
+        stream = EventFeed(args, metrics=metrics)
+    else:
+        replay = None
+        if args.replay_max_events > 0:
+            replay = ReplayBuffer(args.replay_max_events, args.replay_max_bytes)
+        stream = PacketStreamServer(
+            client_queue_size=args.client_queue_size,
+            overflow_policy=args.overflow_policy,
+            replay=replay,
+            backfill_chunk_size=args.backfill_chunk_size,
+            serve_options=websocket_compression_options(args),
+            batching=create_batching(args),
+            metrics=metrics,
+        )
 
-    async def broadcast(packet_json: dict):
-        if not clients:
-            return
+    dedup = create_deduplicator(args)
+    # Dedup hands repeats the first copy's decode and a MeshNode drops them before decoding, so this
+    # cache only hits for --source without dedup; decode pool workers keep caches of their own.
+    DECODE_CACHE.resize(args.decode_cache_size if node is None and dedup is None else 0)
+    capture = create_capture_writer(args)
+    tracer, profiler = create_tracing(args)
+    nodes = create_node_table(args)
+    topology = create_topology(args)
+    store = create_packet_store(args)
+    rollups = create_rollups(args)
+    columns = create_column_store(args)
+    airtime = create_airtime(args)
 
-        msg = json.dumps(packet_json, ensure_ascii=False)
-
-        to_remove = []
-        for ws in clients:
-            try:
-                await ws.send(msg)
-            except Exception as e:
-                peer = getattr(ws, "remote_address", None)
-                logger.warning(f"WS send failed to {peer}: {e}")
-                to_remove.append(ws)
-
-        for ws in to_remove:
-            clients.discard(ws)
-
-    async def on_packet(pkt):
-        await broadcast(build_packet_json(pkt))
-
-    node.dispatcher.set_packet_received_callback(on_packet)
-
-    async def ws_handler(ws: WebSocketServerProtocol):
-        peer = getattr(ws, "remote_address", None)
-        clients.add(ws)
-        logger.info(f"WS client connected: {peer} (clients={len(clients)})")
-        try:
-            async for _message in ws:
-                # Client doesn't need to send anything; ignore messages.
-                pass
-        finally:
-            clients.discard(ws)
-            logger.info(f"WS client disconnected: {peer} (clients={len(clients)})")
-
-    async def ws_router(ws: WebSocketServerProtocol):
-        path = getattr(ws, "path", None) or getattr(getattr(ws, "request", None), "path", None)
-        if path != "/ws":
-            peer = getattr(ws, "remote_address", None)
-            logger.warning(f"WS rejected client {peer} with invalid path: {path}")
-            await ws.close(code=1008, reason="Invalid path")
+    def heard(raw: bytes, rx_ts: float, rssi, snr, source: str | None = None) -> None:
+        """Account for one frame as the radio delivered it, before any dedup."""
+        if capture is not None:
+            capture.append(raw, rx_ts, rssi, snr)
+        if dedup is not None and node is not None:
+            # The dispatcher drops repeats; their hearings are only seen here.
+            dedup.hear(raw, rx_ts, rssi, snr)
+        if airtime is not None and raw:
+            # Every copy heard used the channel, also the repeats dedup drops later.
+            airtime.meter.observe(raw, rx_ts, source)
+        if metrics is not None and raw:
+            # The header byte carries the payload and route types.
+            metrics.observe_packet(raw[0], rssi, snr)
+
+    def receive(raw: bytes, rx_ts: float, rssi, snr, source: str | None):
+        """Time and maybe trace one received packet; returns (trace, decode start)."""
+        if metrics is not None:
+            metrics.observe_stage(STAGE_QUEUE, time.time() - rx_ts)
+        trace_args = {"payload_type": (raw[0] >> 2) & 0x0F if raw else None}
+        if source is not None:
+            trace_args["source"] = source
+        trace = tracer.sample(rx_ts, **trace_args)
+        started = time.monotonic()
+        if trace is not None:
+            trace.span("queue", tracer.monotonic(rx_ts), started)
+        return trace, started
+
+    def publish_packet(pkt, rx_ts: float, source: str | None, trace, started: float, decoded=None):
+        if dedup is None:
+            event = build_packet_json(pkt, rx_ts, decoded)
+        else:
+            event = dedup.process(pkt, rx_ts, source, decoded, heard=node is not None)
+        if event is not None and source is not None:
+            event["source"] = source
+        decoded_at = time.monotonic()
+        if metrics is not None:
+            metrics.observe_stage(STAGE_DECODE, decoded_at - started)
+        if trace is not None:
+            trace.span("decode", started, decoded_at, published=event is not None)
+        if event is not None:
+            nodes.table.observe(event)
+            if topology is not None:
+                topology.table.observe(event)
+            if rollups is not None:
+                rollups.rollups.observe(event)
+            if columns is not None:
+                columns.append(event)
+            if store is not None:
+                store.append(event)
+            stream.publish(event, trace)
+
+    async def process_packet(pkt, rx_ts: float):
+        # Parsed and decrypted by the MeshNode dispatcher.
+        rssi, snr = getattr(pkt, "_rssi", None), getattr(pkt, "_snr", None)
+        trace, started = receive(pkt.write_to(), rx_ts, rssi, snr, None)
+        publish_packet(pkt, rx_ts, None, trace, started)
+
+    async def process_source_packet(item, rx_ts: float):
+        source, raw, rssi, snr = item
+        heard(raw, rx_ts, rssi, snr, source)
+        trace, started = receive(raw, rx_ts, rssi, snr, source)
+        if pool is None:
+            pkt = await decoder.packet(raw, rssi, snr)
+            if pkt is not None:
+                publish_packet(pkt, rx_ts, source, trace, started)
             return
-        await ws_handler(ws)
 
-    logger.info(f"Starting WebSocket server on ws://{host}:{port}/ws")
-    ws_server = await websockets.serve(ws_router, host, port)
-    logger.info("WebSocket server started")
+        def decoded_by_pool(decoded):
+            # The worker validated the bytes; parsing them again here is cheap.
+            pkt = decoder.parse(raw, rssi, snr)
+            if pkt is not None:
+                publish_packet(pkt, rx_ts, source, trace, started, decoded)
+
+        await pool.submit(raw, decoded_by_pool)
+
+    def hearings(sender, message):
+        entry = dedup.cache.get(str(message.get("pkt_hash") or "")) if dedup is not None else None
+        reply = entry.describe() if entry is not None else {"pkt_hash": message.get("pkt_hash")}
+        sender.enqueue(json.dumps({"type": "hearings", **reply}))
+
+    stream.register_command("hearings", hearings)
+    register_node_commands(stream, nodes)
+    if topology is not None:
+        register_topology_commands(stream, topology)
+    if rollups is not None:
+        register_rollup_commands(stream, rollups)
+    if airtime is not None:
+        register_airtime_commands(stream, airtime)
+    if columns is not None:
+        register_analytics_commands(stream, columns, args.analytics_path)
+    if store is not None:
+        register_store_commands(stream, store, args.db_query_path)
+    register_channel_commands(stream, channels, allow_admin=args.channel_admin)
+    register_trace_commands(stream, tracer, profiler, allow_admin=args.trace_admin)
+    if metrics is not None:
+        register_metrics_endpoint(stream, metrics, args.metrics_path)
+
+    install_channel_reload(channels, args.channels_file)
+    install_trace_signals(tracer, profiler)
+
+    # The dispatcher callback only timestamps and queues; decoding and fan-out
+    # run in the ingest consumer so reception never waits on them.
+    ingest = IngestQueue(
+        process_packet if node is not None else process_source_packet,
+        maxsize=args.ingest_queue_size,
+        workers=args.ingest_workers,
+    )
+
+    def backpressure() -> bool:
+        return ingest.depth >= ingest.maxsize // 2
+
+    sources = create_sources(args, ingest.submit, channels.get_channels(), backpressure)
+    arrivals = None
+    if node is not None:
+        # The dispatcher calls back after parsing, dedup and decrypting; rx_ts is the radio's
+        # arrival time, and every frame it delivered, repeats included, goes to heard().
+        arrivals = ArrivalStamps()
+        arrivals.install(node, heard)
+        if dedup is not None and dedup.mode != DEDUP_SUPPRESS:
+            logger.info(
+                f"--dedup-mode {dedup.mode}: the MeshNode drops flood repeats, so they are kept as hearings "
+                "but not published; use --source to publish every copy"
+            )
+        node.dispatcher.set_packet_received_callback(lambda pkt: ingest.submit(pkt, arrivals.take(pkt.write_to())))
+        if isinstance(node.radio, ReplayRadio):
+            # Replays at max speed wait for the decoder instead of overflowing the queue.
+            node.radio.backpressure = backpressure
+    else:
+        register_source_commands(stream, sources)
+        if airtime is not None and not args.airtime_profile:
+            airtime.meter.set_source_profiles(source_profiles(sources))
+
+    await stream.start(args.host, args.port)
+
+    if pool is not None:
+        pool.start()
+    ingest.start()
+    nodes.start()
+    if topology is not None:
+        topology.start()
+    if rollups is not None:
+        rollups.start()
+    if airtime is not None:
+        airtime.start()
+    if capture is not None:
+        capture.start()
+    if store is not None:
+        store.start()
+    components = [
+        *([sources, pool if pool is not None else decoder] if sources is not None else []),
+        *([arrivals] if arrivals is not None else []),
+        # Pool workers keep their own decode caches.
+        *([DECODE_CACHE] if pool is None and DECODE_CACHE.max_entries > 0 else []),
+        *([dedup.cache] if dedup is not None else []),
+        *([capture] if capture is not None else []),
+        *([store] if store is not None else []),
+        nodes.table,
+        *([topology.table] if topology is not None else []),
+        *([rollups.rollups] if rollups is not None else []),
+        *([columns] if columns is not None else []),
+        *([airtime.meter] if airtime is not None else []),
+        *([stream] if isinstance(stream, EventFeed) else []),
+    ]
+    if metrics is not None:
+        metrics.watch(ingest, stream.broadcaster, *components)
+    stats_task = None
+    if args.stats_interval > 0:
+        stats_task = asyncio.create_task(
+            log_stats_periodically(args.stats_interval, ingest, stream.broadcaster, *components)
+        )
 
     try:
-        await node.start()
+        if sources is not None:
+            logger.info(f"Receiving from {len(sources)} sources: {', '.join(s.id for s in sources.sources)}")
+            sources.start()
+            # Serve until interrupted, also after file sources have finished.
+            await asyncio.Event().wait()
+        else:
+            await node.start()
     finally:
         logger.info("Shutting down WebSocket server")
-        ws_server.close()
-        await ws_server.wait_closed()
+        if stats_task is not None:
+            stats_task.cancel()
+        if sources is not None:
+            await sources.stop()
+        await ingest.stop()
+        await nodes.stop()
+        if topology is not None:
+            await topology.stop()
+        if rollups is not None:
+            await rollups.stop()
+        if airtime is not None:
+            await airtime.stop()
+        if pool is not None:
+            await pool.close()
+        if capture is not None:
+            await capture.close()
+        if store is not None:
+            await store.close()
+        await stream.stop()
+        tracer.close()
 
 
 def main():
@@ -89,7 +316,7 @@ def main():
     )
     parser.add_argument(
         "--radio-type",
-        choices=["waveshare", "uconsole", "meshadv-mini", "kiss-tnc"],
+        choices=RADIO_TYPES,
         default="uconsole",
         help="Radio hardware type (default: uconsole)",
     )
@@ -98,13 +325,34 @@ def main():
         default="/dev/ttyUSB0",
         help="Serial port for KISS TNC (default: /dev/ttyUSB0)",
     )
+    add_source_arguments(parser)
+    add_replay_source_arguments(parser)
+    add_sim_radio_arguments(parser)
     parser.add_argument("--host", default="localhost")
     parser.add_argument("--port", type=int, default=8080)
+    add_fanout_arguments(parser)
+    add_ws_worker_arguments(parser)
+    add_dedup_arguments(parser)
+    add_node_table_arguments(parser)
+    add_topology_arguments(parser)
+    add_rollup_arguments(parser)
+    add_column_store_arguments(parser)
+    add_airtime_arguments(parser)
+    add_decode_arguments(parser)
+    add_decode_pool_arguments(parser)
+    add_channel_arguments(parser)
+    add_capture_arguments(parser)
+    add_store_arguments(parser)
+    add_ingest_arguments(parser)
+    add_replay_arguments(parser)
+    add_wire_format_arguments(parser)
+    add_metrics_arguments(parser)
+    add_trace_arguments(parser)
 
     args = parser.parse_args()
 
     try:
-        asyncio.run(run_server(args.radio_type, args.serial_port, args.host, args.port))
+        asyncio.run(run_server(args))
     except KeyboardInterrupt:
         pass
 
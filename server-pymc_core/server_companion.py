@@ -2,7 +2,12 @@
 
 """
 MeshCore Companion Bridge — connects to a MeshCore USB Serial Companion device
-and forwards raw radio packets to YAMPA's frontend via WebSocket.
+and forwards radio packets to YAMPA's frontend via WebSocket.
+
+Packets are decoded once on the bridge into the same events server.py sends,
+including group channel decryption, so browsers do not each decode every
+packet. --raw-only forwards just the raw bytes and RSSI/SNR and does not
+need pymc_core.
 
 Usage:
     python3 server_companion.py --serial-port /dev/tty.usbserial-0001
@@ -10,104 +15,220 @@ Usage:
 
 import argparse
 import asyncio
-import json
 import logging
 import time
-from typing import Set
-
-import websockets
-from websockets.server import WebSocketServerProtocol
 
 from meshcore import MeshCore, EventType
 
+from airtime import add_airtime_arguments, create_airtime, register_airtime_commands
+from capture_log import add_capture_arguments, create_capture_writer
+from channel_store import add_channel_arguments, register_channel_commands
+from column_store import add_column_store_arguments, create_column_store, register_analytics_commands
+from ingest import IngestQueue, add_ingest_arguments, log_stats_periodically
+from metrics import (
+    STAGE_DECODE,
+    STAGE_QUEUE,
+    add_metrics_arguments,
+    create_metrics,
+    register_metrics_endpoint,
+)
+from node_table import add_node_table_arguments, create_node_table, register_node_commands
+from packet_store import add_store_arguments, create_packet_store, register_store_commands
+from replay_buffer import ReplayBuffer, add_replay_arguments
+from rollups import add_rollup_arguments, create_rollups, register_rollup_commands
+from stream_server import PacketStreamServer
+from topology import add_topology_arguments, create_topology, register_topology_commands
+from tracing import add_trace_arguments, create_tracing, install_trace_signals, register_trace_commands
+from wire_format import add_wire_format_arguments, websocket_compression_options
+from ws_fanout import add_fanout_arguments, create_batching
+
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 )
 logger = logging.getLogger("companion_bridge")
 
 
-async def run_server(serial_port: str, host: str, port: int):
-    clients: Set[WebSocketServerProtocol] = set()
+async def run_server(args: argparse.Namespace):
+    replay = None
+    if args.replay_max_events > 0:
+        replay = ReplayBuffer(args.replay_max_events, args.replay_max_bytes)
+
+    metrics = create_metrics(args)
+    stream = PacketStreamServer(
+        client_queue_size=args.client_queue_size,
+        overflow_policy=args.overflow_policy,
+        replay=replay,
+        backfill_chunk_size=args.backfill_chunk_size,
+        serve_options=websocket_compression_options(args),
+        batching=create_batching(args),
+        metrics=metrics,
+    )
+    if metrics is not None:
+        register_metrics_endpoint(stream, metrics, args.metrics_path)
+
+    capture = create_capture_writer(args)
+    store = create_packet_store(args)
+    rollups = create_rollups(args)
+    if rollups is not None:
+        register_rollup_commands(stream, rollups)
+    columns = create_column_store(args)
+    airtime = create_airtime(args)
+    if airtime is not None:
+        register_airtime_commands(stream, airtime)
+    if columns is not None:
+        register_analytics_commands(stream, columns, args.analytics_path)
+    if store is not None:
+        register_store_commands(stream, store, args.db_query_path)
+    tracer, profiler = create_tracing(args)
+    register_trace_commands(stream, tracer, profiler, allow_admin=args.trace_admin)
+
+    decoder = None
+    nodes = None
+    topology = None
+    components = []
+    if not args.raw_only:
+        # pymc_core is only needed to decode on the bridge.
+        from packet_analyser_common import (
+            DECODE_CACHE,
+            RawPacketDecoder,
+            build_packet_json,
+            create_default_channel_db,
+            install_channel_reload,
+        )
 
-    async def broadcast(packet_json: dict):
-        if not clients:
-            return
+        channels = create_default_channel_db(args.channels_file)
+        logger.info(f"Decoding packets on the bridge with {len(channels)} group channels")
+        decoder = RawPacketDecoder(channels)
+        register_channel_commands(stream, channels, allow_admin=args.channel_admin)
+        install_channel_reload(channels, args.channels_file)
+        nodes = create_node_table(args)
+        register_node_commands(stream, nodes)
+        components += [decoder, DECODE_CACHE, nodes.table]
+        # Paths come from decoded packets, so the graph needs decoding too.
+        topology = create_topology(args)
+        if topology is not None:
+            register_topology_commands(stream, topology)
+            components.append(topology.table)
 
-        msg = json.dumps(packet_json, ensure_ascii=False)
+    async def process_rx_log_data(payload: dict, rx_ts: float):
+        raw_hex = payload.get("payload", "")
+        raw = bytes.fromhex(raw_hex)
+        rssi, snr = payload["rssi"], payload["snr"]
+        if capture is not None and raw:
+            capture.append(raw, rx_ts, rssi, snr)
+        if airtime is not None and raw:
+            airtime.meter.observe(raw, rx_ts)
+        if metrics is not None:
+            metrics.observe_stage(STAGE_QUEUE, time.time() - rx_ts)
+            if raw:
+                # The header byte carries the payload and route types.
+                metrics.observe_packet(raw[0], rssi, snr)
+        trace = tracer.sample(rx_ts)
+        started = time.monotonic()
+        if trace is not None:
+            trace.span("queue", tracer.monotonic(rx_ts), started)
+        logger.info(f"RX packet: {len(payload['raw_hex']) // 2} bytes, RSSI={rssi}, SNR={snr}")
 
-        to_remove = []
-        for ws in clients:
-            try:
-                await ws.send(msg)
-            except Exception as e:
-                peer = getattr(ws, "remote_address", None)
-                logger.warning(f"WS send failed to {peer}: {e}")
-                to_remove.append(ws)
+        pkt = await decoder.packet(raw, rssi, snr) if decoder is not None and raw else None
+        if pkt is not None:
+            # Decoded once here for every client; clients wanting only raw bytes
+            # subscribe with "fields": ["raw_packet", "radio"].
+            packet_json = build_packet_json(pkt, rx_ts)
+            decoded_at = time.monotonic()
+            if metrics is not None:
+                metrics.observe_stage(STAGE_DECODE, decoded_at - started)
+            if trace is not None:
+                trace.span("decode", started, decoded_at)
+            nodes.table.observe(packet_json)
+            if topology is not None:
+                topology.table.observe(packet_json)
+        else:
+            packet_json = {
+                "ts": rx_ts,
+                "raw_packet": {"hex": raw_hex},
+                "radio": {
+                    "rssi": rssi,
+                    "snr": snr,
+                },
+            }
+        if store is not None:
+            store.append(packet_json)
+        if rollups is not None:
+            rollups.rollups.observe(packet_json)
+        if columns is not None:
+            columns.append(packet_json)
+        stream.publish(packet_json, trace)
 
-        for ws in to_remove:
-            clients.discard(ws)
+    ingest = IngestQueue(process_rx_log_data, maxsize=args.ingest_queue_size, workers=args.ingest_workers)
 
     async def on_rx_log_data(event):
-        payload = event.payload
-        packet_json = {
-            "ts": time.time(),
-            "raw_packet": {"hex": payload.get("payload", "")},
-            "radio": {
-                "rssi": payload["rssi"],
-                "snr": payload["snr"],
-            },
-        }
-        logger.info(
-            f"RX packet: {len(payload['raw_hex']) // 2} bytes, "
-            f"RSSI={payload['rssi']}, SNR={payload['snr']}"
-        )
-        await broadcast(packet_json)
+        ingest.submit(event.payload)
 
-    logger.info(f"Connecting to MeshCore companion on {serial_port}...")
-    mc = await MeshCore.create_serial(port=serial_port)
+    logger.info(f"Connecting to MeshCore companion on {args.serial_port}...")
+    mc = await MeshCore.create_serial(port=args.serial_port)
     logger.info("MeshCore companion connected")
 
     mc.subscribe(EventType.RX_LOG_DATA, on_rx_log_data)
 
-    async def ws_handler(ws: WebSocketServerProtocol):
-        peer = getattr(ws, "remote_address", None)
-        clients.add(ws)
-        logger.info(f"WS client connected: {peer} (clients={len(clients)})")
-        try:
-            async for _message in ws:
-                pass
-        finally:
-            clients.discard(ws)
-            logger.info(f"WS client disconnected: {peer} (clients={len(clients)})")
-
-    async def ws_router(ws: WebSocketServerProtocol):
-        path = getattr(ws, "path", None) or getattr(
-            getattr(ws, "request", None), "path", None
-        )
-        if path != "/ws":
-            peer = getattr(ws, "remote_address", None)
-            logger.warning(f"WS rejected client {peer} with invalid path: {path}")
-            await ws.close(code=1008, reason="Invalid path")
-            return
-        await ws_handler(ws)
+    await stream.start(args.host, args.port)
+    install_trace_signals(tracer, profiler)
 
-    logger.info(f"Starting WebSocket server on ws://{host}:{port}/ws")
-    ws_server = await websockets.serve(ws_router, host, port)
-    logger.info("WebSocket server started")
+    ingest.start()
+    if nodes is not None:
+        nodes.start()
+    if topology is not None:
+        topology.start()
+    if capture is not None:
+        capture.start()
+    if capture is not None:
+        components.append(capture)
+    if store is not None:
+        store.start()
+        components.append(store)
+    if rollups is not None:
+        rollups.start()
+        components.append(rollups.rollups)
+    if columns is not None:
+        components.append(columns)
+    if airtime is not None:
+        airtime.start()
+        components.append(airtime.meter)
+    if metrics is not None:
+        metrics.watch(ingest, stream.broadcaster, *components)
+    stats_task = None
+    if args.stats_interval > 0:
+        stats_task = asyncio.create_task(
+            log_stats_periodically(args.stats_interval, ingest, stream.broadcaster, *components)
+        )
 
     try:
         while mc.is_connected:
             await asyncio.sleep(1)
     finally:
         logger.info("Shutting down...")
-        ws_server.close()
-        await ws_server.wait_closed()
+        if stats_task is not None:
+            stats_task.cancel()
+        await ingest.stop()
+        if nodes is not None:
+            await nodes.stop()
+        if topology is not None:
+            await topology.stop()
+        if capture is not None:
+            await capture.close()
+        if store is not None:
+            await store.close()
+        if rollups is not None:
+            await rollups.stop()
+        if airtime is not None:
+            await airtime.stop()
+        await stream.stop()
+        tracer.close()
         await mc.disconnect()
 
 
 def main():
     parser = argparse.ArgumentParser(
-        description="MeshCore Companion Bridge — forwards raw radio packets to YAMPA via WebSocket"
+        description="MeshCore Companion Bridge — forwards decoded radio packets to YAMPA via WebSocket"
     )
     parser.add_argument(
         "--serial-port",
@@ -116,11 +237,30 @@ def main():
     )
     parser.add_argument("--host", default="localhost")
     parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--raw-only",
+        action="store_true",
+        help="Forward raw bytes and RSSI/SNR only, without decoding on the bridge (no pymc_core needed)",
+    )
+    add_channel_arguments(parser)
+    add_fanout_arguments(parser)
+    add_node_table_arguments(parser)
+    add_topology_arguments(parser)
+    add_rollup_arguments(parser)
+    add_column_store_arguments(parser)
+    add_airtime_arguments(parser)
+    add_ingest_arguments(parser)
+    add_replay_arguments(parser)
+    add_capture_arguments(parser)
+    add_store_arguments(parser)
+    add_wire_format_arguments(parser)
+    add_metrics_arguments(parser)
+    add_trace_arguments(parser)
 
     args = parser.parse_args()
 
     try:
-        asyncio.run(run_server(args.serial_port, args.host, args.port))
+        asyncio.run(run_server(args))
     except KeyboardInterrupt:
         pass
 
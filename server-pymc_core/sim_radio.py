@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+"""
+Simulated LoRa radio generating synthetic MeshCore traffic, for soak tests.
+
+SimulatedRadio implements pymc_core's LoRaRadio interface. A population of
+nodes with real identities originates adverts, group text encrypted with the
+configured channel secrets, direct text, acks, path and trace packets at a
+Poisson rate, optionally with periodic bursts. Flood packets are heard again
+as repeats with growing paths and varying RSSI/SNR, as on a real mesh.
+
+Timing follows the air: a repeat is heard no sooner than one time on air
+after the previous copy, and without --sim-rate the rate is chosen to keep
+about DEFAULT_SIM_LOAD of the analyser's default LoRa profile busy. Higher
+rates are still accepted for soak tests, but no real channel carries them.
+
+Pair it with ws_swarm.py to measure end-to-end latency and drops:
+
+    python3 server.py --radio-type simulated --sim-rate 50 --sim-nodes 200
+    python3 ws_swarm.py --clients 100 --duration 60
+"""
+
+import asyncio
+import logging
+import random
+from types import SimpleNamespace
+from typing import Any
+
+from airtime import DEFAULT_PROFILE, RADIO_PROFILES, time_on_air
+from pymc_core import LocalIdentity
+from pymc_core.hardware.base import LoRaRadio
+from pymc_core.protocol import Identity, Packet, PacketBuilder
+from pymc_core.protocol.constants import ROUTE_TYPE_FLOOD
+
+logger = logging.getLogger("sim_radio")
+
+# Relative frequency of originated packet kinds.
+DEFAULT_TRAFFIC_MIX = {
+    "advert": 15,
+    "group_text": 35,
+    "text": 15,
+    "ack": 20,
+    "path": 10,
+    "trace": 5,
+}
+
+# Share of the channel the default rate keeps busy, repeats included, and the most it picks.
+DEFAULT_SIM_LOAD = 0.2
+MAX_DEFAULT_RATE = 5.0
+# Packets sampled to estimate the airtime one originated packet costs.
+_RATE_SAMPLES = 200
+
+_WORDS = "hello mesh test ok copy anyone out there signal good morning evening relay node qsl".split()
+
+
+class SimNode:
+    __slots__ = ("identity", "name", "hash", "lat", "lon")
+
+    def __init__(self, index: int, rng: random.Random):
+        self.identity = LocalIdentity(bytes(rng.getrandbits(8) for _ in range(32)))
+        self.name = f"sim-{index:03d}"
+        self.hash = self.identity.get_public_key()[0]
+        self.lat = round(51.0 + rng.uniform(-0.5, 0.5), 5)
+        self.lon = round(rng.uniform(-0.5, 0.5), 5)
+
+
+def parse_burst(value: str | None) -> tuple[float, int] | None:
+    """'<every seconds>:<packets>' (e.g. '30:100') into (period, size), or None."""
+    if not value:
+        return None
+    try:
+        period, size = value.split(":", 1)
+        parsed = float(period), int(size)
+    except ValueError:
+        raise ValueError(f"invalid burst pattern {value!r}: use '<seconds>:<packets>'") from None
+    if parsed[0] <= 0 or parsed[1] <= 0:
+        raise ValueError("burst period and size must be positive")
+    return parsed
+
+
+class SimulatedRadio(LoRaRadio):
+    """LoRaRadio producing synthetic traffic from a simulated node population."""
+
+    def __init__(
+        self,
+        *,
+        rate: float | None = None,
+        nodes: int = 50,
+        repeats: float = 3.0,
+        burst: tuple[float, int] | None = None,
+        channels: list[dict[str, Any]] | None = None,
+        traffic_mix: dict[str, int] | None = None,
+        seed: int | None = None,
+    ):
+        self.rate = rate
+        self.repeats = repeats
+        self.burst = burst
+        self.channels = [c for c in (channels or []) if c.get("secret")]
+        mix = traffic_mix or DEFAULT_TRAFFIC_MIX
+        if not self.channels:
+            mix = {k: v for k, v in mix.items() if k != "group_text"}
+        self._kinds = list(mix)
+        self._weights = [mix[k] for k in self._kinds]
+
+        self._rng = random.Random(seed)
+        self.nodes = [SimNode(i, self._rng) for i in range(max(2, nodes))]
+        # The simulation is heard as a radio on the profile the airtime meter assumes for it.
+        self.profile = RADIO_PROFILES[DEFAULT_PROFILE]
+        if self.rate is None:
+            self.rate = self._default_rate()
+
+        self._rx_callback = None
+        self._tasks: list[asyncio.Task] = []
+        self._last_rssi = -100
+        self._last_snr = 0.0
+
+        self.originated = 0
+        self.delivered = 0
+
+    def set_rx_callback(self, callback) -> None:
+        self._rx_callback = callback
+
+    def begin(self):
+        loop = asyncio.get_running_loop()
+        logger.info(
+            f"Simulated radio: {len(self.nodes)} nodes, {self.rate:.3g} packets/s, "
+            f"~{self.repeats:g} repeats per flood, burst={self.burst}, channels={len(self.channels)}"
+        )
+        self._tasks.append(loop.create_task(self._generate()))
+        if self.burst is not None:
+            self._tasks.append(loop.create_task(self._generate_bursts()))
+
+    async def _generate(self) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            await asyncio.sleep(self._rng.expovariate(self.rate))
+            self._originate()
+
+    async def _generate_bursts(self) -> None:
+        period, size = self.burst
+        while True:
+            await asyncio.sleep(period)
+            logger.info(f"Simulated burst of {size} packets")
+            for _ in range(size):
+                self._originate()
+                # Spread the burst (about 5ms per packet) rather than delivering it in one instant.
+                await asyncio.sleep(self._rng.uniform(0.0, 0.01))
+
+    def _default_rate(self) -> float:
+        """Packets/s keeping DEFAULT_SIM_LOAD of the channel busy, from a sample of the traffic mix."""
+        # A separate generator, so --sim-seed runs produce the same traffic as before.
+        rng = random.Random(0)
+        airtime = 0.0
+        for _ in range(_RATE_SAMPLES):
+            pkt = self._build(rng.choices(self._kinds, self._weights)[0], rng)
+            length = len(pkt.write_to())
+            airtime += time_on_air(length, self.profile)
+            if pkt.get_route_type() == ROUTE_TYPE_FLOOD:
+                # Each repeat adds one path byte to the copy before it.
+                for hop in range(1, self._repeat_count(rng) + 1):
+                    airtime += time_on_air(length + hop, self.profile)
+        return min(MAX_DEFAULT_RATE, DEFAULT_SIM_LOAD / (airtime / _RATE_SAMPLES))
+
+    def _repeat_count(self, rng: random.Random) -> int:
+        return int(rng.expovariate(1.0 / self.repeats)) if self.repeats > 0 else 0
+
+    def _originate(self) -> None:
+        try:
+            pkt = self._build(self._rng.choices(self._kinds, self._weights)[0], self._rng)
+        except Exception as e:
+            logger.error(f"Simulated packet generation failed: {e}")
+            return
+        self.originated += 1
+
+        flood = pkt.get_route_type() == ROUTE_TYPE_FLOOD
+        self._deliver(pkt)
+        if not flood:
+            return
+
+        # Repeaters re-flood the packet, each hop appending its hash to the path. A repeater
+        # starts only once the copy it heard has ended, so a repeat is heard at the earliest
+        # one of its own times on air after the previous copy.
+        loop = asyncio.get_running_loop()
+        hops = list(pkt.path[: pkt.path_len])
+        delay = 0.0
+        for _ in range(self._repeat_count(self._rng)):
+            if len(hops) >= 63:
+                break
+            hops.append(self._rng.choice(self.nodes).hash)
+            repeat = Packet()
+            repeat.read_from(pkt.write_to())
+            repeat.path = bytearray(hops)
+            repeat.path_len = len(hops)
+            delay += self._rng.uniform(0.05, 0.5) + time_on_air(len(repeat.write_to()), self.profile)
+            loop.call_later(delay, self._deliver, repeat)
+
+    def _deliver(self, pkt: Packet) -> None:
+        if self._rx_callback is None:
+            return
+        self._last_rssi = int(self._rng.gauss(-95, 12))
+        self._last_snr = round(self._rng.gauss(2.0, 5.0) * 4) / 4
+        self._rx_callback(pkt.write_to(), self._last_rssi, self._last_snr)
+        self.delivered += 1
+
+    @staticmethod
+    def _text(rng: random.Random) -> str:
+        return " ".join(rng.choices(_WORDS, k=rng.randint(1, 8)))
+
+    def _build(self, kind: str, rng: random.Random) -> Packet:
+        src, dest = rng.sample(self.nodes, 2)
+
+        if kind == "advert":
+            return PacketBuilder.create_advert(src.identity, src.name, src.lat, src.lon)
+
+        if kind == "group_text":
+            channel = rng.choice(self.channels)
+            return PacketBuilder.create_group_datagram(
+                channel["name"], src.identity, self._text(rng), src.name, self.channels
+            )
+
+        if kind == "ack":
+            return PacketBuilder.create_ack(
+                dest.identity.get_public_key(), rng.getrandbits(32), 0, self._text(rng)
+            )
+
+        if kind == "trace":
+            hops = [n.hash for n in rng.sample(self.nodes, min(len(self.nodes), rng.randint(1, 4)))]
+            return PacketBuilder.create_trace(rng.getrandbits(32), 0, 0, hops)
+
+        # Direct text and path returns, encrypted and MACed with the pair's shared secret
+        # as the firmware does; the analyser has no contacts, so they stay opaque to it.
+        if kind == "text":
+            contact = SimpleNamespace(public_key=dest.identity.get_public_key().hex(), out_path=[])
+            if rng.random() < 0.5:
+                pkt, _crc = PacketBuilder.create_text_message(contact, src.identity, self._text(rng), 0, "flood")
+            else:
+                path = [n.hash for n in rng.sample(self.nodes, 2)]
+                pkt, _crc = PacketBuilder.create_text_message(
+                    contact, src.identity, self._text(rng), 0, "direct", out_path=path
+                )
+            return pkt
+
+        secret = Identity(dest.identity.get_public_key()).calc_shared_secret(src.identity.get_private_key())
+        path = [n.hash for n in rng.sample(self.nodes, min(len(self.nodes), rng.randint(1, 4)))]
+        return PacketBuilder.create_path_return(dest.hash, src.hash, secret, path)
+
+    async def send(self, data: bytes):
+        # Nothing is transmitted by the simulation.
+        return None
+
+    async def wait_for_rx(self) -> bytes:
+        await asyncio.Event().wait()
+
+    def sleep(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def get_last_rssi(self) -> int:
+        return self._last_rssi
+
+    def get_last_snr(self) -> float:
+        return self._last_snr
+
+
+def add_sim_radio_arguments(parser) -> None:
+    """Register the options of --radio-type simulated on an argparse parser."""
+    parser.add_argument(
+        "--sim-rate",
+        type=float,
+        default=None,
+        help=f"Originated packets per second with --radio-type simulated (default: enough to keep "
+        f"{DEFAULT_SIM_LOAD:.0%} of the channel busy, at most {MAX_DEFAULT_RATE:g})",
+    )
+    parser.add_argument(
+        "--sim-nodes",
+        type=int,
+        default=50,
+        help="Simulated node population (default: 50)",
+    )
+    parser.add_argument(
+        "--sim-repeats",
+        type=float,
+        default=3.0,
+        help="Mean number of times a flood packet is heard again via repeaters (default: 3)",
+    )
+    parser.add_argument(
+        "--sim-burst",
+        default=None,
+        help="Periodic burst as '<seconds>:<packets>', e.g. 30:100 (default: none)",
+    )
+    parser.add_argument(
+        "--sim-seed",
+        type=int,
+        default=None,
+        help="Random seed for reproducible traffic",
+    )
+
+
+def create_sim_radio(args, channels: list[dict[str, Any]] | None = None) -> SimulatedRadio:
+    return SimulatedRadio(
+        rate=args.sim_rate,
+        nodes=args.sim_nodes,
+        repeats=args.sim_repeats,
+        burst=parse_burst(args.sim_burst),
+        channels=channels,
+        seed=args.sim_seed,
+    )
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+
+"""
+Several packet sources feeding one server.py stream.
+
+Each --source is a radio (SX1262 HAT, KISS TNC, replay file, simulated) or
+a MeshCore companion on a serial port, run by its own supervisor task.
+Received packets are tagged with the source id and handed to the shared
+ingest queue, which stamps them on the event loop, so the merged stream is
+in receive-time order. A source that fails (serial unplugged, RX thread
+died, companion disconnected) is closed and reopened with backoff while
+the others keep running.
+
+    --source lora=uconsole --source tnc=kiss-tnc:/dev/ttyUSB0 --source mc=companion:/dev/ttyACM0
+
+The same packet heard by several sources is matched by the dedup cache,
+whose hearings record which source heard each copy.
+"""
+
+import asyncio
+import json
+import logging
+import re
+import threading
+import time
+from typing import Any, Callable
+
+from packet_analyser_common import RADIO_TYPES
+
+logger = logging.getLogger("sources")
+
+SOURCE_COMPANION = "companion"
+SOURCE_KINDS = (*RADIO_TYPES, SOURCE_COMPANION)
+
+STATE_STARTING = "starting"
+STATE_RUNNING = "running"
+STATE_RESTARTING = "restarting"
+STATE_FINISHED = "finished"
+
+DEFAULT_RETRY_MIN = 1.0
+DEFAULT_RETRY_MAX = 60.0
+HEALTH_INTERVAL = 1.0
+# A source up this long before failing retries at the minimum delay again.
+STABLE_SECONDS = 60.0
+
+_SOURCE_ID = re.compile(r"^[A-Za-z0-9_]+$")
+
+
+def parse_source_spec(spec: str) -> tuple[str | None, str, str | None]:
+    """(id, kind, arg) of a "[id=]kind[:arg]" --source value."""
+    source_id = None
+    if "=" in spec:
+        source_id, spec = spec.split("=", 1)
+        if not _SOURCE_ID.match(source_id):
+            raise ValueError(f"invalid source id {source_id!r}: use letters, digits and _")
+    kind, _, arg = spec.partition(":")
+    if kind not in SOURCE_KINDS:
+        raise ValueError(f"unknown source kind {kind!r}: use one of {', '.join(SOURCE_KINDS)}")
+    return source_id, kind, arg or None
+
+
+class PacketSource:
+    """One source under supervision: opened, watched and reopened after failures."""
+
+    def __init__(
+        self,
+        source_id: str,
+        kind: str,
+        arg: str | None,
+        submit: Callable[[Any], bool],
+        *,
+        retry_min: float = DEFAULT_RETRY_MIN,
+        retry_max: float = DEFAULT_RETRY_MAX,
+    ):
+        self.id = source_id
+        self.kind = kind
+        self.arg = arg
+        self._submit = submit
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._loop_thread: int | None = None
+
+        self.state = STATE_STARTING
+        self.last_error: str | None = None
+        self.received = 0
+        self.dropped = 0
+        self.failures = 0
+        self.restarts = 0
+
+    def deliver(self, raw: bytes, rssi: Any = None, snr: Any = None) -> None:
+        """Queue one received packet. Must be called on the event loop."""
+        self.received += 1
+        if not self._submit((self.id, raw, rssi, snr)):
+            self.dropped += 1
+
+    async def run(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        delay = self.retry_min
+        while True:
+            self.state = STATE_STARTING
+            opened_at = time.monotonic()
+            try:
+                await self._run()
+                self.state = STATE_FINISHED
+                logger.info(f"Source {self.id} finished")
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                if time.monotonic() - opened_at > STABLE_SECONDS:
+                    delay = self.retry_min
+                logger.error(f"Source {self.id} ({self.describe_target()}) failed: {e}; retrying in {delay:g}s")
+            finally:
+                await self._close()
+
+            self.state = STATE_RESTARTING
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.retry_max)
+            self.restarts += 1
+
+    async def _run(self) -> None:
+        """Open the source and return only when it is done; raise when it fails."""
+        raise NotImplementedError
+
+    async def _close(self) -> None:
+        """Release whatever _run opened. Must not raise."""
+
+    def describe_target(self) -> str:
+        return f"{self.kind}:{self.arg}" if self.arg else self.kind
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "state": self.state,
+            "received": self.received,
+            "dropped": self.dropped,
+            "failures": self.failures,
+            "restarts": self.restarts,
+        }
+
+
+class RadioSource(PacketSource):
+    """A LoRaRadio: SX1262 HAT, KISS TNC, replayed recording or simulated traffic."""
+
+    def __init__(self, *args, radio_factory: Callable[[], Any], **kwargs):
+        super().__init__(*args, **kwargs)
+        self._radio_factory = radio_factory
+        self.radio = None
+
+    def _on_rx(self, data: bytes, rssi: Any = None, snr: Any = None) -> None:
+        # SX1262 passes only the data; its last RSSI/SNR belong to this packet.
+        radio = self.radio
+        if rssi is None and radio is not None:
+            rssi = radio.get_last_rssi()
+        if snr is None and radio is not None:
+            snr = radio.get_last_snr()
+        if threading.get_ident() == self._loop_thread:
+            self.deliver(bytes(data), rssi, snr)
+        else:
+            # KISS TNCs call back from their serial RX thread.
+            self._loop.call_soon_threadsafe(self.deliver, bytes(data), rssi, snr)
+
+    async def _run(self) -> None:
+        radio = self._radio_factory()
+        self.radio = radio
+        radio.set_rx_callback(self._on_rx)
+        # SX1262Radio.begin() reports failure by returning False.
+        if radio.begin() is False:
+            raise ConnectionError("radio initialisation failed")
+        self.state = STATE_RUNNING
+        logger.info(f"Source {self.id} receiving from {self.describe_target()}")
+
+        finished = getattr(radio, "finished", None)
+        while True:
+            await asyncio.sleep(HEALTH_INTERVAL)
+            if finished is not None and finished.is_set():
+                return
+            if getattr(radio, "is_connected", True) is False:
+                raise ConnectionError("radio disconnected")
+            rx_thread = getattr(radio, "rx_thread", None)
+            if rx_thread is not None and not rx_thread.is_alive():
+                raise ConnectionError("radio RX thread stopped")
+
+    async def _close(self) -> None:
+        radio, self.radio = self.radio, None
+        if radio is None:
+            return
+        try:
+            # KISS disconnect joins its serial threads and SX1262 cleanup releases GPIO and SPI.
+            release = getattr(radio, "disconnect", None) or getattr(radio, "cleanup", None)
+            if release is not None:
+                await asyncio.get_running_loop().run_in_executor(None, release)
+            else:
+                # Replayed and simulated radios stop their generator tasks.
+                radio.sleep()
+        except Exception as e:
+            logger.warning(f"Source {self.id}: closing the radio failed: {e}")
+
+
+class CompanionSource(PacketSource):
+    """A MeshCore USB Serial Companion forwarding its RX log."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._mc = None
+
+    async def _run(self) -> None:
+        # Only needed when a companion source is configured.
+        from meshcore import EventType, MeshCore
+
+        mc = await MeshCore.create_serial(port=self.arg)
+        if mc is None:
+            raise ConnectionError(f"no companion answering on {self.arg}")
+        self._mc = mc
+
+        async def on_rx_log_data(event):
+            payload = event.payload
+            try:
+                raw = bytes.fromhex(payload.get("payload") or "")
+            except ValueError:
+                return
+            if raw:
+                self.deliver(raw, payload.get("rssi"), payload.get("snr"))
+
+        mc.subscribe(EventType.RX_LOG_DATA, on_rx_log_data)
+        self.state = STATE_RUNNING
+        logger.info(f"Source {self.id} receiving from companion on {self.arg}")
+        while mc.is_connected:
+            await asyncio.sleep(HEALTH_INTERVAL)
+        raise ConnectionError("companion disconnected")
+
+    async def _close(self) -> None:
+        mc, self._mc = self._mc, None
+        if mc is None:
+            return
+        try:
+            await mc.disconnect()
+        except Exception as e:
+            logger.warning(f"Source {self.id}: disconnecting the companion failed: {e}")
+
+
+class SourceSet:
+    """All configured sources, each in its own task."""
+
+    def __init__(self, sources: list[PacketSource]):
+        if not sources:
+            raise ValueError("at least one source is needed")
+        ids = [s.id for s in sources]
+        duplicates = sorted({i for i in ids if ids.count(i) > 1})
+        if duplicates:
+            raise ValueError(f"duplicate source ids: {', '.join(duplicates)}")
+        self.sources = sources
+        self.name = "sources"
+        self._tasks: list[asyncio.Task] = []
+
+    def __len__(self) -> int:
+        return len(self.sources)
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        for source in self.sources:
+            self._tasks.append(asyncio.create_task(source.run(), name=f"source-{source.id}"))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._tasks = []
+
+    def describe(self) -> list[dict[str, Any]]:
+        return [
+            {"id": s.id, "target": s.describe_target(), "last_error": s.last_error, **s.stats()}
+            for s in self.sources
+        ]
+
+    def stats(self) -> dict[str, Any]:
+        out: dict[str, Any] = {}
+        for source in self.sources:
+            for key, value in source.stats().items():
+                out[f"{source.id}_{key}"] = value
+        return out
+
+
+def register_source_commands(stream, sources: SourceSet) -> None:
+    """{"type": "sources"} lists the sources with their state and counters."""
+
+    def list_sources(sender, _message):
+        sender.enqueue(json.dumps({"type": "sources", "sources": sources.describe()}))
+
+    stream.register_command("sources", list_sources)
+
+
+def add_source_arguments(parser) -> None:
+    """Register the multi-source options on an argparse parser."""
+    parser.add_argument(
+        "--source",
+        action="append",
+        default=[],
+        metavar="[ID=]KIND[:ARG]",
+        help=(
+            "Packet source, repeatable; replaces --radio-type. KIND is one of "
+            f"{', '.join(SOURCE_KINDS)}. ARG is the serial port for kiss-tnc and companion, "
+            "the recording for file and the random seed for simulated"
+        ),
+    )
+    parser.add_argument(
+        "--source-retry-max",
+        type=float,
+        default=DEFAULT_RETRY_MAX,
+        help=f"Longest wait in seconds before reopening a failed source (default: {DEFAULT_RETRY_MAX:g})",
+    )
+
+
+def _radio_factory(kind: str, arg: str | None, args, channels: list[dict[str, Any]] | None):
+    if kind == "file":
+        from replay_source import ReplayRadio, parse_speed
+
+        path = arg or args.input
+        if not path:
+            raise ValueError("file sources need a path: --source file:<recording>")
+        speed = parse_speed(args.input_speed)
+        return lambda: ReplayRadio(path, speed, args.input_loops, args.input_delay)
+
+    if kind == "simulated":
+        from sim_radio import SimulatedRadio, parse_burst
+
+        seed = int(arg) if arg else args.sim_seed
+        return lambda: SimulatedRadio(
+            rate=args.sim_rate,
+            nodes=args.sim_nodes,
+            repeats=args.sim_repeats,
+            burst=parse_burst(args.sim_burst),
+            channels=channels,
+            seed=seed,
+        )
+
+    from common import create_radio
+
+    if kind == "kiss-tnc":
+        port = arg or args.serial_port
+        # begin() connects the KISS wrapper and raises if the port cannot be opened.
+        return lambda: create_radio(kind, port)
+    return lambda: create_radio(kind)
+
+
+def create_sources(
+    args,
+    submit: Callable[[Any], bool],
+    channels: list[dict[str, Any]] | None = None,
+    backpressure: Callable[[], bool] | None = None,
+) -> SourceSet | None:
+    """The sources given with --source, or None when the server runs a single --radio-type."""
+    if not args.source:
+        return None
+
+    sources: list[PacketSource] = []
+    for spec in args.source:
+        source_id, kind, arg = parse_source_spec(spec)
+        if source_id is None:
+            # Unnamed sources are numbered per kind: kiss_tnc, kiss_tnc2, ...
+            base = kind.replace("-", "_")
+            taken = sum(1 for s in sources if s.kind == kind)
+            source_id = base if not taken else f"{base}{taken + 1}"
+        options = {"retry_max": max(DEFAULT_RETRY_MIN, args.source_retry_max)}
+        if kind == SOURCE_COMPANION:
+            if not arg:
+                raise ValueError("companion sources need a serial port: --source companion:<port>")
+            sources.append(CompanionSource(source_id, kind, arg, submit, **options))
+            continue
+
+        factory = _radio_factory(kind, arg, args, channels)
+        if kind == "file" and backpressure is not None:
+            # Replays at max speed wait for the decoder instead of overflowing the queue.
+            factory = _with_backpressure(factory, backpressure)
+        sources.append(RadioSource(source_id, kind, arg, submit, radio_factory=factory, **options))
+    return SourceSet(sources)
+
+
+def _with_backpressure(factory: Callable[[], Any], backpressure: Callable[[], bool]) -> Callable[[], Any]:
+    def create():
+        radio = factory()
+        radio.backpressure = backpressure
+        return radio
+
+    return create
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+"""
+The /ws endpoint shared by server.py and server_companion.py.
+
+Owns the connected clients, their subscription filters, the backfill replay
+buffer and the small JSON control protocol clients may speak. The servers
+only feed it packet events through publish().
+"""
+
+import inspect
+import json
+import logging
+import time
+from http import HTTPStatus
+from typing import Any, Awaitable, Callable
+from urllib.parse import parse_qs, urlsplit
+
+import websockets
+from websockets.server import WebSocketServerProtocol
+
+from client_protocol import batching_requested, parse_client_message, request_path
+from replay_buffer import (
+    DEFAULT_BACKFILL_CHUNK_SIZE,
+    ReplayBuffer,
+    backfill_request_from_message,
+    backfill_request_from_query,
+    iter_backfill_chunks,
+)
+from subscriptions import MATCH_ALL, CompiledFilter, SubscriptionIndex
+from wire_format import (
+    FORMAT_BINARY,
+    FORMAT_JSON,
+    KIND_BACKFILL,
+    SUBPROTOCOLS,
+    batch_combiner,
+    encode_binary,
+    encode_binary_batch,
+    encode_event,
+    format_for_subprotocol,
+    select_subprotocol,
+)
+from ws_fanout import (
+    DEFAULT_QUEUE_SIZE,
+    OVERFLOW_DROP_OLDEST,
+    AdaptiveBatching,
+    Broadcaster,
+    ClientSender,
+)
+
+logger = logging.getLogger("stream_server")
+
+WS_PATH = "/ws"
+
+CommandHandler = Callable[[ClientSender, dict[str, Any]], Awaitable[None] | None]
+# Returns (content type, body), or an awaitable of it, for a plain HTTP GET on a registered path.
+# It gets the query parameters as parse_qs() returns them and raises ValueError for a bad request.
+HttpHandler = Callable[[dict[str, list[str]]], tuple[str, str] | Awaitable[tuple[str, str]]]
+
+
+class PacketStreamServer:
+    def __init__(
+        self,
+        *,
+        client_queue_size: int = DEFAULT_QUEUE_SIZE,
+        overflow_policy: str = OVERFLOW_DROP_OLDEST,
+        replay: ReplayBuffer | None = None,
+        backfill_chunk_size: int = DEFAULT_BACKFILL_CHUNK_SIZE,
+        serve_options: dict[str, Any] | None = None,
+        batching: AdaptiveBatching | None = None,
+        metrics=None,
+    ):
+        self.batching = batching
+        self.metrics = metrics
+        self.broadcaster = Broadcaster(
+            max_queue=client_queue_size, overflow=overflow_policy, batching=batching, metrics=metrics
+        )
+        self.replay = replay
+        self.backfill_chunk_size = backfill_chunk_size
+        self.serve_options = serve_options or {}
+        self._ws_server = None
+        self.subscriptions = SubscriptionIndex()
+        self._commands: dict[str, CommandHandler] = {}
+        self._command_fallback: CommandHandler | None = None
+        self._http_routes: dict[str, HttpHandler] = {}
+
+        self.register_command("backfill", self._cmd_backfill)
+        self.register_command("subscribe", self._cmd_subscribe)
+        self.register_command("unsubscribe", self._cmd_unsubscribe)
+        self.register_command("batch", self._cmd_batch)
+
+    def register_command(self, name: str, handler: CommandHandler) -> None:
+        """Handle client messages of {"type": name}. Later registrations replace earlier ones."""
+        self._commands[name] = handler
+
+    def set_command_fallback(self, handler: CommandHandler | None) -> None:
+        """Handle client messages of types nobody registered (e.g. by forwarding them elsewhere)."""
+        self._command_fallback = handler
+
+    def register_http(self, path: str, handler: HttpHandler) -> None:
+        """Answer plain HTTP GETs of `path` (e.g. /metrics) on the WebSocket port."""
+        self._http_routes[path] = handler
+
+    def publish(self, packet_json: dict[str, Any], trace=None, json_frame: str | None = None) -> None:
+        """Match one packet event against every filter group and send it to matching clients.
+
+        Each distinct (projection, wire format) output of the event is
+        serialized at most once, no matter how many clients receive it.
+        `trace` is the PacketTrace of a sampled packet (see tracing.py).
+        `json_frame` is the event already encoded as JSON, if the caller has it.
+        """
+        if self.batching is not None:
+            self.batching.record()
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.observe_event(packet_json)
+            started = time.perf_counter()
+
+        frames: dict[tuple, str | bytes] = {}
+        if json_frame is not None:
+            frames[(None, FORMAT_JSON)] = json_frame
+        if self.replay is not None:
+            frame = frames.get((None, FORMAT_JSON))
+            if frame is None:
+                encode_started = time.monotonic() if trace is not None else 0.0
+                frame = frames[(None, FORMAT_JSON)] = encode_event(packet_json, FORMAT_JSON)
+                if trace is not None:
+                    trace.span("encode", encode_started, time.monotonic(), format=FORMAT_JSON)
+            self.replay.append(packet_json.get("ts", 0.0), frame)
+
+        for fields, flt, clients in self.subscriptions.route(packet_json):
+            for sender in clients:
+                key = (fields, sender.format)
+                frame = frames.get(key)
+                if frame is None:
+                    encode_started = time.monotonic() if trace is not None else 0.0
+                    frame = frames[key] = encode_event(flt.project(packet_json), sender.format)
+                    if trace is not None:
+                        trace.span("encode", encode_started, time.monotonic(), format=sender.format)
+                sender.enqueue(frame, batchable=True, trace=trace)
+
+        if metrics is not None:
+            # Serialization plus enqueueing, per event, however many clients it reached.
+            metrics.observe_serialize(time.perf_counter() - started)
+            for (_fields, fmt), frame in frames.items():
+                metrics.observe_frame(fmt, frame)
+
+    def send_backfill(self, sender: ClientSender, request: dict[str, Any]) -> None:
+        if self.replay is None:
+            if sender.format == FORMAT_BINARY:
+                sender.enqueue(encode_binary_batch([], done=True, kind=KIND_BACKFILL))
+            else:
+                sender.enqueue('{"type":"backfill","events":[],"done":true}')
+            return
+
+        frames = self.replay.select(request)
+        flt = self.subscriptions.get(sender)
+        logger.info(f"WS client {sender.peer} backfill: up to {len(frames)} events ({request})")
+
+        if sender.format == FORMAT_BINARY:
+            sender.enqueue_stream(self._iter_binary_backfill(frames, flt))
+            return
+
+        if flt.signature:
+            # Stored frames are unfiltered; re-check them against this client's filter.
+            frames = [
+                encode_event(flt.project(event), FORMAT_JSON)
+                for event in map(json.loads, frames)
+                if flt.matches(event)
+            ]
+        sender.enqueue_stream(iter_backfill_chunks(frames, self.backfill_chunk_size))
+
+    def _iter_binary_backfill(self, frames: list[str], flt: CompiledFilter):
+        # Replay keeps JSON frames; binary clients get them re-encoded chunk by chunk.
+        records = [
+            encode_binary(flt.project(event)) for event in map(json.loads, frames) if flt.matches(event)
+        ]
+        chunk_size = max(1, self.backfill_chunk_size)
+        if not records:
+            yield encode_binary_batch([], done=True, kind=KIND_BACKFILL)
+        for start in range(0, len(records), chunk_size):
+            yield encode_binary_batch(
+                records[start : start + chunk_size],
+                done=start + chunk_size >= len(records),
+                kind=KIND_BACKFILL,
+            )
+
+    def _cmd_backfill(self, sender: ClientSender, message: dict[str, Any]) -> None:
+        request = backfill_request_from_message(message)
+        if request is None:
+            logger.warning(f"WS client {sender.peer} sent an invalid backfill request: {message}")
+            return
+        self.send_backfill(sender, request)
+
+    def _cmd_subscribe(self, sender: ClientSender, message: dict[str, Any]) -> None:
+        spec = message.get("filter") or {}
+        try:
+            if not isinstance(spec, dict):
+                raise ValueError("filter must be an object")
+            flt = CompiledFilter(spec)
+        except (TypeError, ValueError) as e:
+            logger.warning(f"WS client {sender.peer} sent an invalid filter: {e}")
+            sender.enqueue(json.dumps({"type": "error", "request": "subscribe", "message": str(e)}))
+            return
+
+        self.subscriptions.set(sender, flt)
+        logger.info(
+            f"WS client {sender.peer} subscribed: {flt.describe()} "
+            f"(filter groups={self.subscriptions.group_count()})"
+        )
+        sender.enqueue(json.dumps({"type": "subscribed", "filter": flt.describe()}))
+
+    def _cmd_unsubscribe(self, sender: ClientSender, message: dict[str, Any]) -> None:
+        self.subscriptions.set(sender, MATCH_ALL)
+        sender.enqueue(json.dumps({"type": "subscribed", "filter": {}}))
+
+    def _cmd_batch(self, sender: ClientSender, message: dict[str, Any]) -> None:
+        sender.accepts_batches = bool(message.get("enabled", True))
+        sender.enqueue(json.dumps({"type": "batch", "enabled": sender.accepts_batches}))
+
+    async def _handle_message(self, sender: ClientSender, raw: str | bytes) -> None:
+        message = parse_client_message(raw, sender.peer)
+        if message is None:
+            return
+
+        handler = self._commands.get(message["type"], self._command_fallback)
+        if handler is None:
+            logger.warning(f"WS client {sender.peer} sent unknown message type: {message['type']}")
+            return
+
+        try:
+            result = handler(sender, message)
+            if result is not None:
+                await result
+        except Exception as e:
+            logger.error(f"WS command {message['type']} from {sender.peer} failed: {e}")
+
+    async def _ws_handler(self, ws: WebSocketServerProtocol, path: str | None):
+        peer = getattr(ws, "remote_address", None)
+        fmt = format_for_subprotocol(getattr(ws, "subprotocol", None))
+        sender = self.broadcaster.add(ws, fmt, batch_combiner(fmt))
+        # Binary clients always understand batch records; JSON clients get
+        # arrays only after opting in, since older frontends expect one object per frame.
+        sender.accepts_batches = fmt == FORMAT_BINARY or batching_requested(path)
+        self.subscriptions.set(sender, MATCH_ALL)
+        logger.info(f"WS client connected: {peer} (format={fmt}, clients={len(self.broadcaster)})")
+
+        # Queue the backfill before any live frame reaches this client.
+        request = backfill_request_from_query(path)
+        if request is not None:
+            self.send_backfill(sender, request)
+
+        try:
+            async for message in ws:
+                await self._handle_message(sender, message)
+        finally:
+            self.subscriptions.discard(sender)
+            await self.broadcaster.remove(ws)
+            logger.info(
+                f"WS client disconnected: {peer} (clients={len(self.broadcaster)}, "
+                f"sent={sender.sent}, dropped={sender.dropped}, max_lag={sender.max_lag:.3f}s)"
+            )
+
+    async def _ws_router(self, ws: WebSocketServerProtocol):
+        path = request_path(ws)
+        if (path or "").split("?", 1)[0] != WS_PATH:
+            peer = getattr(ws, "remote_address", None)
+            logger.warning(f"WS rejected client {peer} with invalid path: {path}")
+            await ws.close(code=1008, reason="Invalid path")
+            return
+        await self._ws_handler(ws, path)
+
+    async def _process_request(self, first, second):
+        """websockets process_request hook serving the registered HTTP paths.
+
+        The new asyncio API calls it as (connection, request), the legacy API
+        as (path, request_headers). Any other path continues to the handshake.
+        """
+        path = first if isinstance(first, str) else getattr(second, "path", "")
+        url = urlsplit(path or "")
+        handler = self._http_routes.get(url.path)
+        if handler is None:
+            return None
+
+        status = HTTPStatus.OK
+        try:
+            result = handler(parse_qs(url.query))
+            if inspect.isawaitable(result):
+                result = await result
+            content_type, body = result
+        except ValueError as e:
+            status = HTTPStatus.BAD_REQUEST
+            content_type, body = "text/plain; charset=utf-8", f"{e}\n"
+        except Exception as e:
+            logger.error(f"HTTP handler for {path} failed: {e}")
+            status = HTTPStatus.INTERNAL_SERVER_ERROR
+            content_type, body = "text/plain; charset=utf-8", "Internal error\n"
+
+        if isinstance(first, str):
+            return status, [("Content-Type", content_type)], body.encode()
+        response = first.respond(status, body)
+        del response.headers["Content-Type"]
+        response.headers["Content-Type"] = content_type
+        return response
+
+    async def start(self, host: str, port: int) -> None:
+        logger.info(f"Starting WebSocket server on ws://{host}:{port}{WS_PATH}")
+        self._ws_server = await websockets.serve(
+            self._ws_router,
+            host,
+            port,
+            subprotocols=list(SUBPROTOCOLS),
+            select_subprotocol=select_subprotocol,
+            process_request=self._process_request if self._http_routes else None,
+            **self.serve_options,
+        )
+        logger.info("WebSocket server started")
+        for path in self._http_routes:
+            logger.info(f"Serving http://{host}:{port}{path}")
+
+    async def stop(self) -> None:
+        if self._ws_server is not None:
+            self._ws_server.close()
+            await self._ws_server.wait_closed()
+            self._ws_server = None
+        await self.broadcaster.close()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+"""
+Server-side subscription filters for /ws clients.
+
+A client declares a filter once with {"type": "subscribe", "filter": {...}};
+it is compiled into a CompiledFilter and clients with identical filters are
+grouped, so every packet is matched once per distinct filter and serialized
+once per distinct output rather than once per client.
+"""
+
+from typing import Any, Iterable, Iterator
+
+# Mirrors pymc_core.protocol.utils so the companion bridge does not need pymc_core.
+PAYLOAD_TYPES = {
+    0x00: "REQ",
+    0x01: "RESPONSE",
+    0x02: "TXT_MSG",
+    0x03: "ACK",
+    0x04: "ADVERT",
+    0x05: "GRP_TXT",
+    0x06: "GRP_DATA",
+    0x07: "ANON_REQ",
+    0x08: "PATH",
+    0x09: "TRACE",
+    0x0A: "MULTIPART",
+    0x0B: "CONTROL",
+    0x0F: "RAW_CUSTOM",
+}
+ROUTE_TYPES = {
+    0x00: "TRANSPORT_FLOOD",
+    0x01: "FLOOD",
+    0x02: "DIRECT",
+    0x03: "TRANSPORT_DIRECT",
+}
+
+# Top-level event sections a client may project to.
+EVENT_SECTIONS = ("raw_packet", "packet", "radio", "routing", "payload", "decoded")
+# Scalar annotations kept by every projection.
+EVENT_ANNOTATIONS = ("ts", "type", "pkt_hash", "dup_of", "repeat", "source")
+
+# Payload types whose payload starts with dest_hash(1) | src_hash(1): REQ, RESPONSE, TXT_MSG, PATH.
+_ADDRESSED_TYPES = (0x00, 0x01, 0x02, 0x08)
+_PAYLOAD_TYPE_ADVERT = 0x04
+_PAYLOAD_TYPE_ANON_REQ = 0x07
+
+_PAYLOAD_TYPE_CODES = {name: code for code, name in PAYLOAD_TYPES.items()}
+_ROUTE_TYPE_CODES = {name: code for code, name in ROUTE_TYPES.items()}
+
+
+def _type_codes(values: Any, codes: dict[str, int], what: str) -> frozenset[int]:
+    if not isinstance(values, list):
+        values = [values]
+    out = set()
+    for value in values:
+        if isinstance(value, int):
+            out.add(value)
+        elif isinstance(value, str) and value.upper() in codes:
+            out.add(codes[value.upper()])
+        else:
+            raise ValueError(f"unknown {what}: {value!r}")
+    return frozenset(out)
+
+
+def _hash_bytes(values: Any, what: str) -> frozenset[int]:
+    """1-byte node/channel hashes given as ints or hex strings ("a1", "0xA1")."""
+    if not isinstance(values, list):
+        values = [values]
+    out = set()
+    for value in values:
+        try:
+            byte = value if isinstance(value, int) else int(str(value), 16)
+        except ValueError:
+            raise ValueError(f"invalid {what}: {value!r}") from None
+        if not 0 <= byte <= 0xFF:
+            raise ValueError(f"{what} out of range: {value!r}")
+        out.add(byte)
+    return frozenset(out)
+
+
+def _hops(values: Any) -> frozenset[str]:
+    if not isinstance(values, list):
+        values = [values]
+    out = set()
+    for value in values:
+        hop = (f"{value:02x}" if isinstance(value, int) else str(value)).lower().removeprefix("0x")
+        try:
+            bytes.fromhex(hop)
+        except ValueError:
+            raise ValueError(f"invalid path hop: {value!r}") from None
+        if not hop:
+            raise ValueError("empty path hop")
+        out.add(hop)
+    return frozenset(out)
+
+
+def packet_hashes(event: dict[str, Any]) -> tuple[int | None, int | None]:
+    """Best-effort (dest_hash, src_hash) of a packet event."""
+    ptype = event.get("packet", {}).get("payload_type")
+    decoded = event.get("decoded") or {}
+
+    if ptype == _PAYLOAD_TYPE_ADVERT:
+        pub_key = (decoded.get("advert") or {}).get("pub_key") or ""
+        return None, int(pub_key[:2], 16) if len(pub_key) >= 2 else None
+
+    if ptype in _ADDRESSED_TYPES or ptype == _PAYLOAD_TYPE_ANON_REQ:
+        payload_hex = event.get("payload", {}).get("hex") or ""
+        dest = int(payload_hex[0:2], 16) if len(payload_hex) >= 2 else None
+        src = int(payload_hex[2:4], 16) if len(payload_hex) >= 4 else None
+        return dest, src
+
+    return None, None
+
+
+_CONDITIONS = (
+    "payload_types",
+    "route_types",
+    "min_rssi",
+    "min_snr",
+    "src_hashes",
+    "dest_hashes",
+    "channel_hashes",
+    "channel_names",
+    "path_hops",
+    "sources",
+)
+
+
+class CompiledFilter:
+    """Immutable, pre-validated form of a client's filter declaration."""
+
+    __slots__ = _CONDITIONS + ("fields", "match_all", "signature")
+
+    def __init__(self, spec: dict[str, Any] | None = None):
+        spec = spec or {}
+        unknown = set(spec) - {
+            "payload_types",
+            "route_types",
+            "min_rssi",
+            "min_snr",
+            "src_hash",
+            "dest_hash",
+            "channel_hash",
+            "channel_name",
+            "path_contains",
+            "source",
+            "fields",
+        }
+        if unknown:
+            raise ValueError(f"unknown filter keys: {', '.join(sorted(unknown))}")
+
+        def opt(key, convert):
+            return convert(spec[key]) if spec.get(key) is not None else None
+
+        self.payload_types = opt("payload_types", lambda v: _type_codes(v, _PAYLOAD_TYPE_CODES, "payload type"))
+        self.route_types = opt("route_types", lambda v: _type_codes(v, _ROUTE_TYPE_CODES, "route type"))
+        self.min_rssi = opt("min_rssi", float)
+        self.min_snr = opt("min_snr", float)
+        self.src_hashes = opt("src_hash", lambda v: _hash_bytes(v, "src_hash"))
+        self.dest_hashes = opt("dest_hash", lambda v: _hash_bytes(v, "dest_hash"))
+        self.channel_hashes = opt("channel_hash", lambda v: _hash_bytes(v, "channel_hash"))
+        self.channel_names = opt(
+            "channel_name", lambda v: frozenset(str(n) for n in (v if isinstance(v, list) else [v]))
+        )
+        self.path_hops = opt("path_contains", _hops)
+        self.sources = opt("source", lambda v: frozenset(str(s) for s in (v if isinstance(v, list) else [v])))
+
+        fields = spec.get("fields")
+        if fields is not None:
+            fields = tuple(sorted(set(fields if isinstance(fields, list) else [fields])))
+            bad = [f for f in fields if f not in EVENT_SECTIONS]
+            if bad:
+                raise ValueError(f"unknown event sections: {', '.join(bad)}")
+        self.fields = fields
+
+        self.match_all = all(getattr(self, name) is None for name in _CONDITIONS)
+        self.signature = tuple(
+            (name, tuple(sorted(value)) if isinstance(value, frozenset) else value)
+            for name in _CONDITIONS + ("fields",)
+            if (value := getattr(self, name)) is not None
+        )
+
+    def matches(self, event: dict[str, Any]) -> bool:
+        packet = event.get("packet") or {}
+        if self.payload_types is not None and packet.get("payload_type") not in self.payload_types:
+            return False
+        if self.route_types is not None and packet.get("route_type") not in self.route_types:
+            return False
+
+        radio = event.get("radio") or {}
+        if self.min_rssi is not None and (radio.get("rssi") is None or radio["rssi"] < self.min_rssi):
+            return False
+        if self.min_snr is not None and (radio.get("snr") is None or radio["snr"] < self.min_snr):
+            return False
+
+        if self.src_hashes is not None or self.dest_hashes is not None:
+            dest, src = packet_hashes(event)
+            if self.src_hashes is not None and src not in self.src_hashes:
+                return False
+            if self.dest_hashes is not None and dest not in self.dest_hashes:
+                return False
+
+        if self.channel_hashes is not None or self.channel_names is not None:
+            group_text = (event.get("decoded") or {}).get("group_text")
+            if not group_text:
+                return False
+            if self.channel_hashes is not None and group_text.get("channel_hash") not in self.channel_hashes:
+                return False
+            if self.channel_names is not None and group_text.get("channel_name") not in self.channel_names:
+                return False
+
+        if self.path_hops is not None:
+            path = (event.get("routing") or {}).get("path") or ""
+            if not any(_path_contains(path, hop) for hop in self.path_hops):
+                return False
+
+        if self.sources is not None and event.get("source") not in self.sources:
+            return False
+
+        return True
+
+    def project(self, event: dict[str, Any]) -> dict[str, Any]:
+        if self.fields is None:
+            return event
+        out = {"ts": event.get("ts")}
+        for key in EVENT_ANNOTATIONS[1:] + self.fields:
+            if key in event:
+                out[key] = event[key]
+        return out
+
+    def describe(self) -> dict[str, Any]:
+        return {name: list(value) if isinstance(value, tuple) else value for name, value in self.signature}
+
+
+def _path_contains(path_hex: str, hop: str) -> bool:
+    # Only compare at hop boundaries so "a1" does not match the middle of "2a1b".
+    step = len(hop)
+    return any(path_hex[i : i + step] == hop for i in range(0, len(path_hex) - step + 1, step))
+
+
+MATCH_ALL = CompiledFilter()
+
+
+class SubscriptionIndex:
+    """Clients grouped by filter signature."""
+
+    def __init__(self):
+        self._filters: dict[Any, CompiledFilter] = {}
+        self._groups: dict[tuple, tuple[CompiledFilter, set]] = {}
+
+    def __len__(self) -> int:
+        return len(self._filters)
+
+    def get(self, client) -> CompiledFilter:
+        return self._filters.get(client, MATCH_ALL)
+
+    def set(self, client, flt: CompiledFilter) -> None:
+        self.discard(client)
+        self._filters[client] = flt
+        group = self._groups.get(flt.signature)
+        if group is None:
+            group = self._groups[flt.signature] = (flt, set())
+        group[1].add(client)
+
+    def discard(self, client) -> None:
+        flt = self._filters.pop(client, None)
+        if flt is None:
+            return
+        group = self._groups.get(flt.signature)
+        if group is not None:
+            group[1].discard(client)
+            if not group[1]:
+                del self._groups[flt.signature]
+
+    def route(self, event: dict[str, Any]) -> Iterator[tuple[tuple | None, CompiledFilter, Iterable]]:
+        """Yield (fields, filter, clients) for every filter group the event matches."""
+        for flt, clients in self._groups.values():
+            if flt.match_all or flt.matches(event):
+                yield flt.fields, flt, clients
+
+    def group_count(self) -> int:
+        return len(self._groups)
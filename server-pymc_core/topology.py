@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+"""
+Mesh topology graph built incrementally from the paths packets were heard over.
+
+A flood packet's routing.path lists the 1-byte hashes of the repeaters that
+forwarded it, in order. Together with the originator's hash (adverts,
+direct text, path packets...) and the receiver it gives a chain of hops:
+
+    src -> path[0] -> path[1] -> ... -> path[-1] -> receiver
+
+and each hop becomes a directed edge "transmitter was heard by" in the
+graph. Edges count how often they were heard and when, and the last hop
+into the receiver also keeps its RSSI/SNR. Direct-routed packets are left
+out: their path is the route still ahead, not the hops already taken.
+
+Edge weights decay with a half-life, so links that stop being heard fade;
+edges below the minimum weight, or beyond the maximum edge count (least
+recently heard first), are pruned. Clients ask with {"type": "topology"}
+and get one snapshot, then "topology_delta" frames with only the edges
+that changed or were pruned, sequenced like node table deltas.
+"""
+
+import json
+import time
+from collections import OrderedDict
+from typing import Any
+
+from node_table import NodeDeltas
+from subscriptions import packet_hashes
+
+DEFAULT_TOPOLOGY_HALF_LIFE = 3600.0
+DEFAULT_TOPOLOGY_MIN_WEIGHT = 0.05
+DEFAULT_TOPOLOGY_MAX_EDGES = 20000
+DEFAULT_TOPOLOGY_DELTA_INTERVAL = 2.0
+PRUNE_INTERVAL = 60.0
+
+_FLOOD_ROUTES = (0x00, 0x01)
+
+# Exponential average weight of a new RSSI/SNR sample on a final hop.
+_SIGNAL_ALPHA = 0.25
+
+# The receiving radio, as a graph node: "rx" alone, or "rx:<source id>" per --source.
+RECEIVER = "rx"
+
+
+def receiver_id(source: str | None) -> str:
+    return RECEIVER if source is None else f"{RECEIVER}:{source}"
+
+
+class Edge:
+    __slots__ = ("src", "dst", "weight", "count", "first_seen", "last_seen", "rssi", "snr", "rssi_avg", "snr_avg")
+
+    def __init__(self, src: str, dst: str, ts: float):
+        self.src = src
+        self.dst = dst
+        # Decayed hearing count as of last_seen.
+        self.weight = 0.0
+        self.count = 0
+        self.first_seen = ts
+        self.last_seen = ts
+        self.rssi = None
+        self.snr = None
+        self.rssi_avg: float | None = None
+        self.snr_avg: float | None = None
+
+    def weight_at(self, now: float, half_life: float) -> float:
+        return self.weight * 0.5 ** (max(0.0, now - self.last_seen) / half_life)
+
+    def describe(self) -> dict[str, Any]:
+        return {
+            "from": self.src,
+            "to": self.dst,
+            "weight": round(self.weight, 3),
+            "count": self.count,
+            "first_seen": self.first_seen,
+            "last_seen": self.last_seen,
+            "rssi": self.rssi,
+            "snr": self.snr,
+            "rssi_avg": None if self.rssi_avg is None else round(self.rssi_avg, 2),
+            "snr_avg": None if self.snr_avg is None else round(self.snr_avg, 2),
+        }
+
+
+def _average(avg: float | None, value) -> float | None:
+    if value is None:
+        return avg
+    return float(value) if avg is None else avg + _SIGNAL_ALPHA * (value - avg)
+
+
+class TopologyGraph:
+    """Directed edges by (from, to), least recently heard first, with the ones changed since the last delta."""
+
+    def __init__(
+        self,
+        half_life: float = DEFAULT_TOPOLOGY_HALF_LIFE,
+        min_weight: float = DEFAULT_TOPOLOGY_MIN_WEIGHT,
+        max_edges: int = DEFAULT_TOPOLOGY_MAX_EDGES,
+    ):
+        self.half_life = half_life
+        self.min_weight = min_weight
+        self.max_edges = max_edges
+        self._edges: OrderedDict[tuple[str, str], Edge] = OrderedDict()
+        self._changed: set[tuple[str, str]] = set()
+        self._removed: set[tuple[str, str]] = set()
+        self._pruned_at = 0.0
+        self.seq = 0
+        self.name = "topology"
+
+        self.paths = 0
+        self.skipped = 0
+        self.pruned = 0
+
+    def __len__(self) -> int:
+        return len(self._edges)
+
+    def get(self, src: str, dst: str) -> Edge | None:
+        return self._edges.get((src, dst))
+
+    def hops(self, event: dict[str, Any]) -> list[str]:
+        """The chain of node ids a flood packet travelled, ending at the receiver; [] if it tells nothing."""
+        packet = event.get("packet") or {}
+        if packet.get("route_type") not in _FLOOD_ROUTES:
+            return []
+        path = (event.get("routing") or {}).get("path") or ""
+        try:
+            chain = [f"{byte:02x}" for byte in bytes.fromhex(path)]
+        except ValueError:
+            return []
+        _dest, src = packet_hashes(event) if "decoded" in event else (None, None)
+        if src is not None:
+            chain.insert(0, f"{src:02x}")
+        if not chain:
+            return []
+        chain.append(receiver_id(event.get("source")))
+        return chain
+
+    def observe(self, event: dict[str, Any]) -> int:
+        """Add the hops of one published event; returns how many edges were touched."""
+        chain = self.hops(event)
+        if len(chain) < 2:
+            self.skipped += 1
+            return 0
+        self.paths += 1
+        ts = event.get("ts") or time.time()
+        radio = event.get("radio") or {}
+        touched = 0
+        last = len(chain) - 2
+        for i in range(len(chain) - 1):
+            src, dst = chain[i], chain[i + 1]
+            if src == dst:
+                # A repeater sharing the originator's hash, or a hash collision along the path.
+                continue
+            key = (src, dst)
+            edge = self._edges.get(key)
+            if edge is None:
+                edge = self._edges[key] = Edge(src, dst, ts)
+                self._removed.discard(key)
+            else:
+                self._edges.move_to_end(key)
+            edge.weight = edge.weight_at(ts, self.half_life) + 1.0
+            edge.count += 1
+            edge.last_seen = max(edge.last_seen, ts)
+            if i == last:
+                edge.rssi = radio.get("rssi")
+                edge.snr = radio.get("snr")
+                edge.rssi_avg = _average(edge.rssi_avg, edge.rssi)
+                edge.snr_avg = _average(edge.snr_avg, edge.snr)
+            self._changed.add(key)
+            touched += 1
+
+        while len(self._edges) > self.max_edges:
+            self._remove(next(iter(self._edges)))
+        return touched
+
+    def _remove(self, key: tuple[str, str]) -> None:
+        del self._edges[key]
+        self._changed.discard(key)
+        self._removed.add(key)
+        self.pruned += 1
+
+    def evict(self, now: float | None = None, force: bool = False) -> int:
+        """Drop edges decayed below min_weight, at most once per PRUNE_INTERVAL unless forced."""
+        now = now if now is not None else time.time()
+        if not force and now - self._pruned_at < PRUNE_INTERVAL:
+            return 0
+        self._pruned_at = now
+        stale = [key for key, edge in self._edges.items() if edge.weight_at(now, self.half_life) < self.min_weight]
+        for key in stale:
+            self._remove(key)
+        return len(stale)
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "type": "topology",
+            "seq": self.seq,
+            "half_life": self.half_life,
+            "edges": [edge.describe() for edge in self._edges.values()],
+        }
+
+    def take_delta(self) -> dict[str, Any] | None:
+        """The edges changed and removed since the last call, or None if nothing changed."""
+        if not self._changed and not self._removed:
+            return None
+        self.seq += 1
+        delta = {
+            "type": "topology_delta",
+            "seq": self.seq,
+            "edges": [self._edges[key].describe() for key in self._changed],
+            "removed": [list(key) for key in sorted(self._removed)],
+        }
+        self._changed.clear()
+        self._removed.clear()
+        return delta
+
+    def stats(self) -> dict[str, Any]:
+        nodes = {node for key in self._edges for node in key} if self._edges else set()
+        return {
+            "edges": len(self._edges),
+            "nodes": len(nodes),
+            "paths": self.paths,
+            "skipped": self.skipped,
+            "pruned": self.pruned,
+            "seq": self.seq,
+        }
+
+
+def register_topology_commands(stream, deltas: NodeDeltas) -> None:
+    """Client message {"type": "topology"}: a snapshot of the graph, then deltas unless "subscribe" is false."""
+
+    def topology(sender, message):
+        # As for the node table: flush pending changes first so the snapshot's seq is current.
+        deltas.flush()
+        if message.get("subscribe", True):
+            deltas.subscribe(sender)
+        else:
+            deltas.unsubscribe(sender)
+        sender.enqueue(json.dumps(deltas.table.snapshot()))
+
+    stream.register_command("topology", topology)
+
+
+def add_topology_arguments(parser) -> None:
+    """Register the topology graph options on an argparse parser."""
+    parser.add_argument(
+        "--topology-half-life",
+        type=float,
+        default=DEFAULT_TOPOLOGY_HALF_LIFE,
+        help=f"Seconds for a topology edge's weight to halve when not heard, 0 to disable the graph (default: {DEFAULT_TOPOLOGY_HALF_LIFE:g})",
+    )
+    parser.add_argument(
+        "--topology-min-weight",
+        type=float,
+        default=DEFAULT_TOPOLOGY_MIN_WEIGHT,
+        help=f"Edges decayed below this weight are pruned (default: {DEFAULT_TOPOLOGY_MIN_WEIGHT:g})",
+    )
+    parser.add_argument(
+        "--topology-max-edges",
+        type=int,
+        default=DEFAULT_TOPOLOGY_MAX_EDGES,
+        help=f"Edges kept at most, least recently heard dropped first (default: {DEFAULT_TOPOLOGY_MAX_EDGES})",
+    )
+    parser.add_argument(
+        "--topology-delta-interval",
+        type=float,
+        default=DEFAULT_TOPOLOGY_DELTA_INTERVAL,
+        help=f"Seconds between topology_delta frames to subscribed clients (default: {DEFAULT_TOPOLOGY_DELTA_INTERVAL:g})",
+    )
+
+
+def create_topology(args) -> NodeDeltas | None:
+    if args.topology_half_life <= 0:
+        return None
+    graph = TopologyGraph(args.topology_half_life, args.topology_min_weight, args.topology_max_edges)
+    return NodeDeltas(graph, args.topology_delta_interval)
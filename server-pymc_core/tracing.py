@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+"""
+Runtime diagnostics for live latency spikes: a sampling per-packet tracer
+and a time-boxed profile of the event loop, both switched on without
+restarting the radio process (SIGUSR1 / SIGUSR2, or admin WebSocket
+commands).
+
+A sampled packet records spans for its time in the ingest queue (from the
+radio callback), decoding, encoding of each wire format and the send
+to each client. Traces are written as Chrome trace-event JSON, one file per
+session, and open in chrome://tracing or https://ui.perfetto.dev. Spans sit
+on one row for the pipeline and one row per client.
+
+Profiles run cProfile on the event loop thread for a fixed time and are
+dumped as .pstats (for pstats/snakeviz) plus a text summary.
+"""
+
+import asyncio
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any
+
+logger = logging.getLogger("tracing")
+
+DEFAULT_TRACE_DIR = "traces"
+DEFAULT_SAMPLE_RATE = 0.01
+DEFAULT_PROFILE_SECONDS = 30.0
+MAX_PROFILE_SECONDS = 600.0
+
+ROW_PIPELINE = "pipeline"
+
+
+def _stamp() -> str:
+    return time.strftime("%Y%m%d-%H%M%S")
+
+
+class PacketTrace:
+    """Spans of one sampled packet. Times are time.monotonic() values."""
+
+    __slots__ = ("tracer", "seq", "args")
+
+    def __init__(self, tracer: "PacketTracer", seq: int, args: dict[str, Any]):
+        self.tracer = tracer
+        self.seq = seq
+        self.args = args
+
+    def span(self, name: str, start: float, end: float, row: str = ROW_PIPELINE, **args: Any) -> None:
+        self.tracer.emit(name, start, end, row, {"packet": self.seq, **self.args, **args})
+
+
+class PacketTracer:
+    """Samples packets while enabled and writes their spans as Chrome trace events."""
+
+    def __init__(
+        self,
+        directory: str | Path = DEFAULT_TRACE_DIR,
+        sample_rate: float = DEFAULT_SAMPLE_RATE,
+        flush_events: int = 512,
+    ):
+        self.directory = Path(directory)
+        self.sample_rate = sample_rate
+        self.flush_events = flush_events
+        self.enabled = False
+        self.path: Path | None = None
+
+        # Offset turning monotonic times into wall clock microseconds for the trace file.
+        self._wall_offset = time.time() - time.monotonic()
+        self._pid = os.getpid()
+        self._rows: dict[str, int] = {}
+        self._pending: list[str] = []
+        self._written = 0
+        self._credit = 0.0
+        self._seq = 0
+        # One worker keeps writes in order and off the event loop.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trace")
+
+        self.sampled = 0
+        self.events = 0
+
+    def start(self, sample_rate: float | None = None) -> Path:
+        if sample_rate is not None:
+            if not 0 < sample_rate <= 1:
+                raise ValueError("sample_rate must be in (0, 1]")
+            self.sample_rate = sample_rate
+        if self.enabled:
+            return self.path
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.path = self.directory / f"trace-{_stamp()}.json"
+        self._rows = {}
+        self._written = 0
+        self._credit = 0.0
+        self.sampled = 0
+        self.events = 0
+        self.enabled = True
+        self._executor.submit(self._write, self.path, "[", "w")
+        logger.info(f"Tracing 1 in {1 / self.sample_rate:.0f} packets to {self.path}")
+        return self.path
+
+    def stop(self) -> Path | None:
+        if not self.enabled:
+            return None
+        self.enabled = False
+        self._flush(closing=True)
+        logger.info(f"Tracing stopped: {self.sampled} packets, {self.events} events in {self.path}")
+        return self.path
+
+    def toggle(self) -> None:
+        if self.enabled:
+            self.stop()
+        else:
+            self.start()
+
+    def sample(self, rx_ts: float, **args: Any) -> PacketTrace | None:
+        """A trace for this packet if it is sampled, else None. Call once per packet."""
+        if not self.enabled:
+            return None
+        # Deterministic 1-in-N sampling: no random draw per packet.
+        self._credit += self.sample_rate
+        if self._credit < 1.0:
+            return None
+        self._credit -= 1.0
+        self._seq += 1
+        self.sampled += 1
+        trace = PacketTrace(self, self._seq, args)
+        self.instant("rx", self.monotonic(rx_ts), packet=self._seq, **args)
+        return trace
+
+    def monotonic(self, wall_ts: float) -> float:
+        return wall_ts - self._wall_offset
+
+    def _row(self, row: str) -> int:
+        tid = self._rows.get(row)
+        if tid is None:
+            tid = self._rows[row] = len(self._rows) + 1
+            self._append({"name": "thread_name", "ph": "M", "pid": self._pid, "tid": tid, "args": {"name": row}})
+        return tid
+
+    def emit(self, name: str, start: float, end: float, row: str, args: dict[str, Any]) -> None:
+        if not self.enabled:
+            return
+        self._append(
+            {
+                "name": name,
+                "ph": "X",
+                "pid": self._pid,
+                "tid": self._row(row),
+                "ts": round((start + self._wall_offset) * 1e6, 1),
+                "dur": round(max(0.0, end - start) * 1e6, 1),
+                "args": args,
+            }
+        )
+
+    def instant(self, name: str, at: float, row: str = ROW_PIPELINE, **args: Any) -> None:
+        self._append(
+            {
+                "name": name,
+                "ph": "i",
+                "s": "t",
+                "pid": self._pid,
+                "tid": self._row(row),
+                "ts": round((at + self._wall_offset) * 1e6, 1),
+                "args": args,
+            }
+        )
+
+    def _append(self, event: dict[str, Any]) -> None:
+        self._pending.append(json.dumps(event, separators=(",", ":"), default=str))
+        self.events += 1
+        if len(self._pending) >= self.flush_events:
+            self._flush()
+
+    def _flush(self, closing: bool = False) -> None:
+        # Separators go before each event, so the file is a valid JSON array once closed.
+        text = "".join(
+            ("," if self._written + i else "") + "\n" + line for i, line in enumerate(self._pending)
+        )
+        self._written += len(self._pending)
+        self._pending = []
+        if closing:
+            text += "\n]\n"
+        if text:
+            self._executor.submit(self._write, self.path, text, "a")
+
+    @staticmethod
+    def _write(path: Path, text: str, mode: str) -> None:
+        try:
+            with open(path, mode, encoding="utf-8") as f:
+                f.write(text)
+        except OSError as e:
+            logger.error(f"Trace write to {path} failed: {e}")
+
+    def close(self) -> None:
+        self.stop()
+        self._executor.shutdown(wait=True)
+
+    def describe(self) -> dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "path": str(self.path) if self.path else None,
+            "sampled": self.sampled,
+            "events": self.events,
+        }
+
+
+class LoopProfiler:
+    """Runs cProfile on the event loop thread for a fixed time and dumps the result."""
+
+    def __init__(self, directory: str | Path = DEFAULT_TRACE_DIR, default_seconds: float = DEFAULT_PROFILE_SECONDS):
+        self.directory = Path(directory)
+        self.default_seconds = default_seconds
+        self._task: asyncio.Task | None = None
+        self.last_path: Path | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, seconds: float | None = None) -> asyncio.Task | None:
+        """Start a profile unless one is running. Must be called on the event loop."""
+        if self.running:
+            return None
+        seconds = min(MAX_PROFILE_SECONDS, max(0.1, seconds or self.default_seconds))
+        self._task = asyncio.create_task(self._run(seconds))
+        return self._task
+
+    async def _run(self, seconds: float) -> Path:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f"profile-{_stamp()}.pstats"
+        logger.info(f"Profiling the event loop for {seconds:g}s")
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+        await asyncio.get_running_loop().run_in_executor(None, self._dump, profiler, path)
+        self.last_path = path
+        logger.info(f"Profile written to {path} (summary in {path.with_suffix('.txt')})")
+        return path
+
+    @staticmethod
+    def _dump(profiler: cProfile.Profile, path: Path) -> None:
+        profiler.dump_stats(str(path))
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(40)
+        path.with_suffix(".txt").write_text(out.getvalue(), encoding="utf-8")
+
+    def describe(self) -> dict[str, Any]:
+        return {"running": self.running, "last_path": str(self.last_path) if self.last_path else None}
+
+
+def register_trace_commands(
+    stream, tracer: PacketTracer, profiler: LoopProfiler, allow_admin: bool = False
+) -> None:
+    """Client messages to switch tracing on and off and to start a profile, when allowed."""
+
+    def reply(sender, **fields):
+        sender.enqueue(json.dumps({"type": "trace", **fields}, default=str))
+
+    def trace(sender, message):
+        if not allow_admin:
+            reply(sender, error="trace admin disabled")
+            return
+        if "enabled" in message:
+            try:
+                if message["enabled"]:
+                    tracer.start(message.get("sample_rate"))
+                else:
+                    tracer.stop()
+            except (TypeError, ValueError) as e:
+                reply(sender, error=str(e))
+                return
+            logger.info(f"WS client {sender.peer} set tracing enabled={tracer.enabled}")
+        reply(sender, tracer=tracer.describe(), profiler=profiler.describe())
+
+    def profile(sender, message):
+        if not allow_admin:
+            reply(sender, error="trace admin disabled")
+            return
+        try:
+            seconds = float(message.get("seconds") or 0) or None
+        except (TypeError, ValueError):
+            reply(sender, error="seconds must be a number")
+            return
+        task = profiler.start(seconds)
+        if task is None:
+            reply(sender, error="a profile is already running")
+            return
+        logger.info(f"WS client {sender.peer} started a profile")
+        reply(sender, profiler=profiler.describe())
+
+        # Answer again once the dump is written; the client's other messages are not held up.
+        def done(task: asyncio.Task) -> None:
+            if not task.cancelled() and task.exception() is None:
+                reply(sender, profile=str(task.result()))
+
+        task.add_done_callback(done)
+
+    stream.register_command("trace", trace)
+    stream.register_command("profile", profile)
+
+
+def install_trace_signals(tracer: PacketTracer, profiler: LoopProfiler) -> None:
+    """SIGUSR1 toggles tracing, SIGUSR2 starts a profile. Call from the event loop."""
+    if not hasattr(signal, "SIGUSR1"):
+        return
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGUSR1, tracer.toggle)
+    loop.add_signal_handler(signal.SIGUSR2, profiler.start)
+
+
+def add_trace_arguments(parser) -> None:
+    """Register the tracing and profiling options on an argparse parser."""
+    parser.add_argument(
+        "--trace-dir",
+        default=DEFAULT_TRACE_DIR,
+        help=f"Directory for packet traces and profiles (default: {DEFAULT_TRACE_DIR})",
+    )
+    parser.add_argument(
+        "--trace-sample-rate",
+        type=float,
+        default=DEFAULT_SAMPLE_RATE,
+        help=f"Fraction of packets traced while tracing is on (default: {DEFAULT_SAMPLE_RATE:g})",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="Start with tracing on (otherwise toggle it with SIGUSR1)",
+    )
+    parser.add_argument(
+        "--profile-seconds",
+        type=float,
+        default=DEFAULT_PROFILE_SECONDS,
+        help=f"Length of an event loop profile started with SIGUSR2 (default: {DEFAULT_PROFILE_SECONDS:g})",
+    )
+    parser.add_argument(
+        "--trace-admin",
+        action="store_true",
+        help="Allow WebSocket clients to switch tracing on and off and to start profiles",
+    )
+
+
+def create_tracing(args) -> tuple[PacketTracer, LoopProfiler]:
+    if not 0 < args.trace_sample_rate <= 1:
+        raise ValueError("--trace-sample-rate must be in (0, 1]")
+    tracer = PacketTracer(args.trace_dir, args.trace_sample_rate)
+    if args.trace:
+        tracer.start()
+    return tracer, LoopProfiler(args.trace_dir, args.profile_seconds)
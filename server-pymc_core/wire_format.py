@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+
+"""
+Wire formats for packet events, negotiated through the WebSocket subprotocol.
+
+JSON stays the default (no subprotocol, or "yampa.json"). Clients that offer
+"yampa.bin.v1" receive events as binary frames: a fixed little-endian struct
+header with enum codes instead of name strings, raw bytes instead of hex,
+and only the "decoded" section as compact JSON. Control messages (subscribed,
+errors, ...) are always JSON text frames.
+
+Binary event record (all integers little-endian):
+
+    kind u8 (=1) | sections u8 | ts f64
+    [packet]   header u8 | payload_type u8 | route_type u8 | crc u32 | payload_len u16 | raw_len u16
+    [radio]    rssi i16 | snr i16 (quarter dB)           -- -32768 means "unknown"
+    [routing]  path_len u8 | path_bytes u8 | path bytes
+    [raw]      len u16 | raw packet bytes
+    [payload]  len u16 | payload bytes
+    [decoded]  len u32 | compact UTF-8 JSON
+    [dedup]    role u8 (0 first copy, 1 duplicate, 2 repeat update) | pkt_hash 8 bytes | repeat u16
+    [source]   len u8 | UTF-8 source id                  -- server.py with several --source
+
+When the raw section is present, routing path bytes and payload bytes are
+not repeated: they are slices of the raw packet
+(header | [transport codes] | path_len | path | payload).
+
+Batch records (coalesced live events, kind 2, and backfill envelopes, kind 3):
+
+    kind u8 | done u8 | count u32 | count x (len u32 | event record)
+
+JSON clients that opted into batching receive coalesced live events as a
+JSON array of event objects.
+"""
+
+import json
+import struct
+from typing import Any
+
+SUBPROTOCOL_JSON = "yampa.json"
+SUBPROTOCOL_BINARY = "yampa.bin.v1"
+SUBPROTOCOLS = (SUBPROTOCOL_JSON, SUBPROTOCOL_BINARY)
+
+FORMAT_JSON = "json"
+FORMAT_BINARY = "binary"
+
+KIND_EVENT = 1
+KIND_BATCH = 2
+KIND_BACKFILL = 3
+
+SECTION_PACKET = 0x01
+SECTION_RADIO = 0x02
+SECTION_ROUTING = 0x04
+SECTION_RAW = 0x08
+SECTION_PAYLOAD = 0x10
+SECTION_DECODED = 0x20
+SECTION_DEDUP = 0x40
+SECTION_SOURCE = 0x80
+
+DEDUP_FIRST = 0
+DEDUP_DUPLICATE = 1
+DEDUP_REPEAT = 2
+
+UNKNOWN_I16 = -32768
+
+_HEAD = struct.Struct("<BBd")
+_PACKET = struct.Struct("<BBBIHH")
+_RADIO = struct.Struct("<hh")
+_ROUTING = struct.Struct("<BB")
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+_BATCH = struct.Struct("<BBI")
+_DEDUP = struct.Struct("<B8sH")
+_U8 = struct.Struct("<B")
+
+
+def select_subprotocol(first, second) -> str | None:
+    """websockets select_subprotocol hook: pick ours if offered, else continue without one.
+
+    The new asyncio API calls it as (connection, offered), the legacy API as
+    (offered, server_subprotocols). Clients offering nothing get plain JSON.
+    """
+    offered = first if isinstance(first, (list, tuple)) else second
+    for subprotocol in SUBPROTOCOLS:
+        if subprotocol in offered:
+            return subprotocol
+    return None
+
+
+def format_for_subprotocol(subprotocol: str | None) -> str:
+    return FORMAT_BINARY if subprotocol == SUBPROTOCOL_BINARY else FORMAT_JSON
+
+
+def _i16(value: Any, scale: float = 1.0) -> int:
+    if value is None:
+        return UNKNOWN_I16
+    return max(-32767, min(32767, int(round(float(value) * scale))))
+
+
+def _hex_bytes(section: Any) -> bytes:
+    try:
+        return bytes.fromhex((section or {}).get("hex") or "")
+    except (AttributeError, ValueError):
+        return b""
+
+
+def encode_json(event: dict[str, Any]) -> str:
+    return json.dumps(event, ensure_ascii=False)
+
+
+def encode_binary(event: dict[str, Any]) -> bytes:
+    sections = 0
+    parts: list[bytes] = []
+
+    raw = _hex_bytes(event["raw_packet"]) if "raw_packet" in event else None
+
+    packet = event.get("packet")
+    if packet:
+        sections |= SECTION_PACKET
+        parts.append(
+            _PACKET.pack(
+                packet.get("header") or 0,
+                packet.get("payload_type") or 0,
+                packet.get("route_type") or 0,
+                packet.get("crc") or 0,
+                packet.get("payload_len") or 0,
+                packet.get("raw_len") or 0,
+            )
+        )
+
+    radio = event.get("radio")
+    if radio:
+        sections |= SECTION_RADIO
+        parts.append(_RADIO.pack(_i16(radio.get("rssi")), _i16(radio.get("snr"), 4.0)))
+
+    routing = event.get("routing")
+    if routing:
+        sections |= SECTION_ROUTING
+        path = _hex_bytes({"hex": routing.get("path")})
+        parts.append(_ROUTING.pack((routing.get("path_len") or 0) & 0xFF, len(path)))
+        if raw is None:
+            parts.append(path)
+
+    if raw is not None:
+        sections |= SECTION_RAW
+        parts.append(_U16.pack(len(raw)))
+        parts.append(raw)
+
+    if "payload" in event:
+        sections |= SECTION_PAYLOAD
+        payload = _hex_bytes(event["payload"])
+        parts.append(_U16.pack(len(payload)))
+        if raw is None:
+            parts.append(payload)
+
+    decoded = event.get("decoded")
+    if decoded:
+        sections |= SECTION_DECODED
+        body = json.dumps(decoded, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        parts.append(_U32.pack(len(body)))
+        parts.append(body)
+
+    key = event.get("pkt_hash") or event.get("dup_of")
+    if key:
+        sections |= SECTION_DEDUP
+        if event.get("type") == "repeat":
+            role = DEDUP_REPEAT
+        else:
+            role = DEDUP_DUPLICATE if "dup_of" in event else DEDUP_FIRST
+        parts.append(_DEDUP.pack(role, bytes.fromhex(key), min(event.get("repeat") or 1, 0xFFFF)))
+
+    source = event.get("source")
+    if source:
+        sections |= SECTION_SOURCE
+        name = str(source).encode("utf-8")[:0xFF]
+        parts.append(_U8.pack(len(name)))
+        parts.append(name)
+
+    return _HEAD.pack(KIND_EVENT, sections, float(event.get("ts") or 0.0)) + b"".join(parts)
+
+
+def encode_event(event: dict[str, Any], fmt: str) -> str | bytes:
+    return encode_binary(event) if fmt == FORMAT_BINARY else encode_json(event)
+
+
+def encode_binary_batch(records: list[bytes], done: bool = True, kind: int = KIND_BATCH) -> bytes:
+    out = [_BATCH.pack(kind, 1 if done else 0, len(records))]
+    for record in records:
+        out.append(_U32.pack(len(record)))
+        out.append(record)
+    return b"".join(out)
+
+
+def encode_json_batch(frames: list[str]) -> str:
+    # Frames are already serialized objects, so the array is plain concatenation.
+    return "[" + ",".join(frames) + "]"
+
+
+def batch_combiner(fmt: str):
+    """Function merging several serialized event frames of `fmt` into one frame."""
+    return encode_binary_batch if fmt == FORMAT_BINARY else encode_json_batch
+
+
+def decode_binary(data: bytes) -> dict[str, Any]:
+    """Inverse of encode_binary, used by the tooling in this directory."""
+    kind, sections, ts = _HEAD.unpack_from(data, 0)
+    if kind != KIND_EVENT:
+        raise ValueError(f"not an event record: kind={kind}")
+    off = _HEAD.size
+    event: dict[str, Any] = {"ts": ts}
+
+    if sections & SECTION_PACKET:
+        header, ptype, rtype, crc, payload_len, raw_len = _PACKET.unpack_from(data, off)
+        off += _PACKET.size
+        event["packet"] = {
+            "header": header,
+            "payload_type": ptype,
+            "route_type": rtype,
+            "payload_len": payload_len,
+            "raw_len": raw_len,
+            "crc": crc,
+        }
+
+    if sections & SECTION_RADIO:
+        rssi, snr = _RADIO.unpack_from(data, off)
+        off += _RADIO.size
+        event["radio"] = {
+            "rssi": None if rssi == UNKNOWN_I16 else rssi,
+            "snr": None if snr == UNKNOWN_I16 else snr / 4.0,
+        }
+
+    path = b""
+    path_len = path_bytes = 0
+    if sections & SECTION_ROUTING:
+        path_len, path_bytes = _ROUTING.unpack_from(data, off)
+        off += _ROUTING.size
+        if not sections & SECTION_RAW:
+            path = data[off : off + path_bytes]
+            off += path_bytes
+
+    raw = None
+    if sections & SECTION_RAW:
+        (n,) = _U16.unpack_from(data, off)
+        off += _U16.size
+        raw = data[off : off + n]
+        off += n
+        event["raw_packet"] = {"hex": raw.hex()}
+
+    if sections & SECTION_ROUTING:
+        if raw is not None and raw:
+            start = 2 + (4 if (raw[0] & 0x03) in (0x00, 0x03) else 0)
+            path = raw[start : start + path_bytes]
+        event["routing"] = {"path_len": path_len, "path": path.hex()}
+
+    if sections & SECTION_PAYLOAD:
+        (n,) = _U16.unpack_from(data, off)
+        off += _U16.size
+        if raw is not None:
+            payload = raw[len(raw) - n :] if n else b""
+        else:
+            payload = data[off : off + n]
+            off += n
+        event["payload"] = {"hex": payload.hex()}
+
+    if sections & SECTION_DECODED:
+        (n,) = _U32.unpack_from(data, off)
+        off += _U32.size
+        event["decoded"] = json.loads(data[off : off + n].decode("utf-8"))
+        off += n
+
+    if sections & SECTION_DEDUP:
+        role, key, repeat = _DEDUP.unpack_from(data, off)
+        off += _DEDUP.size
+        if role == DEDUP_FIRST:
+            event["pkt_hash"] = key.hex()
+        else:
+            event["dup_of"] = key.hex()
+            event["repeat"] = repeat
+            if role == DEDUP_REPEAT:
+                event["type"] = "repeat"
+
+    if sections & SECTION_SOURCE:
+        (n,) = _U8.unpack_from(data, off)
+        off += _U8.size
+        event["source"] = data[off : off + n].decode("utf-8", "replace")
+        off += n
+
+    return event
+
+
+def decode_binary_frame(data: bytes) -> list[dict[str, Any]]:
+    """Decode a binary frame holding either one event or a batch of events."""
+    if data and data[0] in (KIND_BATCH, KIND_BACKFILL):
+        _, _done, count = _BATCH.unpack_from(data, 0)
+        off = _BATCH.size
+        events = []
+        for _ in range(count):
+            (n,) = _U32.unpack_from(data, off)
+            off += _U32.size
+            events.append(decode_binary(data[off : off + n]))
+            off += n
+        return events
+    return [decode_binary(data)]
+
+
+def add_wire_format_arguments(parser) -> None:
+    """Register the shared WebSocket encoding/compression options on an argparse parser."""
+    parser.add_argument(
+        "--ws-compression",
+        choices=["deflate", "none"],
+        default="deflate",
+        help="permessage-deflate negotiation (default: deflate)",
+    )
+    parser.add_argument(
+        "--deflate-level",
+        type=int,
+        default=6,
+        help="zlib compression level 1-9 for permessage-deflate (default: 6)",
+    )
+    parser.add_argument(
+        "--deflate-window-bits",
+        type=int,
+        default=12,
+        help="LZ77 window size in bits, 9-15 (default: 12)",
+    )
+    parser.add_argument(
+        "--deflate-mem-level",
+        type=int,
+        default=5,
+        help="zlib memLevel 1-9 for permessage-deflate (default: 5)",
+    )
+
+
+def websocket_compression_options(args) -> dict[str, Any]:
+    """Keyword arguments for websockets.serve() matching the compression options."""
+    if args.ws_compression == "none":
+        return {"compression": None}
+
+    from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+
+    return {
+        "compression": "deflate",
+        "extensions": [
+            ServerPerMessageDeflateFactory(
+                server_max_window_bits=args.deflate_window_bits,
+                client_max_window_bits=args.deflate_window_bits,
+                compress_settings={"level": args.deflate_level, "memLevel": args.deflate_mem_level},
+            )
+        ],
+    }
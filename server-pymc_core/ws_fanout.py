@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+
+"""
+Per-client WebSocket fan-out for the packet servers.
+
+Every connected client gets its own bounded outbound queue drained by a
+dedicated writer task, so a slow or stalled dashboard only ever backs up its
+own queue instead of the radio callback and every other client.
+
+Under burst load (see AdaptiveBatching) the writer coalesces queued packet
+events for clients that accept batches into a single frame per window.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Callable, Iterable
+
+logger = logging.getLogger("ws_fanout")
+
+OVERFLOW_DROP_OLDEST = "drop-oldest"
+OVERFLOW_DROP_NEWEST = "drop-newest"
+OVERFLOW_DISCONNECT = "disconnect"
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_DISCONNECT)
+
+DEFAULT_QUEUE_SIZE = 256
+
+DEFAULT_BATCH_THRESHOLD = 20.0
+DEFAULT_BATCH_WINDOW_MS = 50
+DEFAULT_BATCH_MAX_EVENTS = 64
+
+# WebSocket close code 1013 is "Try Again Later".
+_CLOSE_CODE_SLOW_CONSUMER = 1013
+
+
+class AdaptiveBatching:
+    """Switches frame coalescing on while the event rate is above a threshold.
+
+    The rate is measured over a sliding `rate_window`. Batching turns on at
+    `threshold` events/s and back off below half of it, so it does not flap
+    around the threshold.
+    """
+
+    def __init__(
+        self,
+        threshold: float = DEFAULT_BATCH_THRESHOLD,
+        window: float = DEFAULT_BATCH_WINDOW_MS / 1000.0,
+        max_events: int = DEFAULT_BATCH_MAX_EVENTS,
+        rate_window: float = 1.0,
+    ):
+        self.threshold = threshold
+        self.window = window
+        self.max_events = max(1, max_events)
+        self.rate_window = rate_window
+        self._times: deque[float] = deque()
+        self.active = False
+        self.activations = 0
+
+    @property
+    def rate(self) -> float:
+        return len(self._times) / self.rate_window
+
+    def record(self) -> None:
+        if self.threshold <= 0:
+            return
+
+        now = time.monotonic()
+        self._times.append(now)
+        horizon = now - self.rate_window
+        while self._times and self._times[0] < horizon:
+            self._times.popleft()
+
+        rate = self.rate
+        if not self.active and rate >= self.threshold:
+            self.active = True
+            self.activations += 1
+            logger.info(f"Burst detected ({rate:.0f} events/s): batching frames every {self.window * 1000:.0f}ms")
+        elif self.active and rate < self.threshold / 2:
+            self.active = False
+            logger.info(f"Load back to normal ({rate:.0f} events/s): sending frames immediately")
+
+
+class FrameStream:
+    """Several frames queued as one entry and sent back-to-back (e.g. a backfill)."""
+
+    def __init__(self, frames: Iterable[Any]):
+        self.frames = frames
+
+
+class ClientSender:
+    """Bounded outbound queue plus writer task for one WebSocket client."""
+
+    def __init__(
+        self,
+        ws,
+        *,
+        max_queue: int = DEFAULT_QUEUE_SIZE,
+        overflow: str = OVERFLOW_DROP_OLDEST,
+        fmt: str = "json",
+        batching: AdaptiveBatching | None = None,
+        combine: Callable[[list[Any]], Any] | None = None,
+        metrics=None,
+        background: set[asyncio.Task] | None = None,
+    ):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}. Use one of {', '.join(OVERFLOW_POLICIES)}")
+        if max_queue < 1:
+            raise ValueError("max_queue must be at least 1")
+
+        self.ws = ws
+        self.peer = getattr(ws, "remote_address", None)
+        # Wire format negotiated for this client (see wire_format.py).
+        self.format = fmt
+        self.max_queue = max_queue
+        self.overflow = overflow
+        # Shared burst detector, and how to merge several event frames into one.
+        # Coalescing only happens for clients that accept batches.
+        self.batching = batching
+        self.combine = combine
+        self.accepts_batches = False
+        # Shared PacketMetrics (see metrics.py) recording send lag and drops, if enabled.
+        self.metrics = metrics
+
+        # Entries are (enqueued_at, frame, batchable, trace); a plain deque keeps drop-oldest O(1).
+        # trace is the PacketTrace of a sampled packet (see tracing.py), usually None.
+        self._queue: deque[tuple[float, Any, bool, Any]] = deque()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        # Fire-and-forget tasks (slow-consumer closes) are held here until done; the loop keeps only weak references.
+        self._background = background if background is not None else set()
+        self.closed = False
+
+        self.connected_at = time.time()
+        self.sent = 0
+        self.batches = 0
+        self.dropped = 0
+        self.send_errors = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._writer(), name=f"ws-writer-{self.peer}")
+
+    def enqueue(self, frame: Any, batchable: bool = False, trace=None) -> bool:
+        """Queue a frame without blocking. Returns False if the frame was not queued.
+
+        Only frames marked batchable (single packet events) may be coalesced.
+        """
+        if self.closed:
+            return False
+
+        if len(self._queue) >= self.max_queue:
+            if self.overflow == OVERFLOW_DROP_NEWEST:
+                self._count_drop()
+                return False
+            if self.overflow == OVERFLOW_DISCONNECT:
+                self._count_drop()
+                self._disconnect_slow_consumer()
+                return False
+            self._count_drop()
+            self._queue.popleft()
+
+        self._queue.append((time.monotonic(), frame, batchable, trace))
+        self._wakeup.set()
+        return True
+
+    def enqueue_stream(self, frames: Iterable[Any]) -> bool:
+        """Queue a lazily produced sequence of frames as a single queue entry."""
+        return self.enqueue(FrameStream(frames))
+
+    def _count_drop(self) -> None:
+        self.dropped += 1
+        if self.metrics is not None:
+            self.metrics.observe_drop()
+        # Log the first drop and then every 100th, so a stuck client cannot flood the log.
+        if self.dropped == 1 or self.dropped % 100 == 0:
+            logger.warning(
+                f"WS client {self.peer} is lagging: dropped={self.dropped} "
+                f"queue={len(self._queue)}/{self.max_queue} policy={self.overflow}"
+            )
+
+    def _disconnect_slow_consumer(self) -> None:
+        logger.warning(f"WS client {self.peer} disconnected: send queue full ({self.max_queue})")
+        self.closed = True
+        self._queue.clear()
+        self._wakeup.set()
+        task = asyncio.create_task(self._close_ws(_CLOSE_CODE_SLOW_CONSUMER, "Send queue overflow"))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _close_ws(self, code: int, reason: str) -> None:
+        try:
+            await self.ws.close(code=code, reason=reason)
+        except Exception as e:
+            logger.debug(f"WS close failed for {self.peer}: {e}")
+
+    async def _writer(self) -> None:
+        while not self.closed:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            enqueued_at, frame, batchable, trace = self._queue.popleft()
+            traces = [(enqueued_at, trace)] if trace is not None else []
+            if batchable and self.accepts_batches and self.batching is not None and self.batching.active:
+                frames = await self._collect_batch(frame, enqueued_at, traces)
+                if self.closed:
+                    return
+                if len(frames) > 1:
+                    frame = self.combine(frames)
+                    self.batches += 1
+            stream = isinstance(frame, FrameStream)
+            try:
+                if stream:
+                    for part in frame.frames:
+                        await self.ws.send(part)
+                        if self.closed:
+                            return
+                else:
+                    await self.ws.send(frame)
+            except Exception as e:
+                self.send_errors += 1
+                logger.warning(f"WS send failed to {self.peer}: {e}")
+                self.closed = True
+                self._queue.clear()
+                await self._close_ws(1011, "Send failed")
+                return
+
+            self.sent += 1
+            self.last_lag = time.monotonic() - enqueued_at
+            if self.last_lag > self.max_lag:
+                self.max_lag = self.last_lag
+            if self.metrics is not None and not stream:
+                self.metrics.observe_send(self.last_lag)
+            if traces:
+                sent_at = time.monotonic()
+                for queued_at, trace in traces:
+                    trace.span("send", queued_at, sent_at, row=f"client {self.peer}", format=self.format)
+
+    async def _collect_batch(self, first: Any, enqueued_at: float, traces: list) -> list[Any]:
+        """Gather event frames queued within the batch window of the first one.
+
+        Traces of the gathered frames are appended to `traces` with their enqueue times.
+        """
+        frames = [first]
+        deadline = enqueued_at + self.batching.window
+        while len(frames) < self.batching.max_events and not self.closed:
+            if self._queue:
+                if not self._queue[0][2]:
+                    break
+                queued_at, frame, _batchable, trace = self._queue.popleft()
+                frames.append(frame)
+                if trace is not None:
+                    traces.append((queued_at, trace))
+                continue
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return frames
+
+    async def close(self) -> None:
+        self.closed = True
+        self._queue.clear()
+        self._wakeup.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+
+    def stats(self) -> dict[str, Any]:
+        # Age of the oldest queued frame: how far behind live this client currently is.
+        queue_age = time.monotonic() - self._queue[0][0] if self._queue else 0.0
+        return {
+            "peer": str(self.peer),
+            "format": self.format,
+            "connected_at": self.connected_at,
+            "queue_depth": len(self._queue),
+            "queue_size": self.max_queue,
+            "sent": self.sent,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "send_errors": self.send_errors,
+            "queue_age": queue_age,
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+        }
+
+
+class Broadcaster:
+    """Registry of connected clients that fans frames out without awaiting any send."""
+
+    def __init__(
+        self,
+        *,
+        max_queue: int = DEFAULT_QUEUE_SIZE,
+        overflow: str = OVERFLOW_DROP_OLDEST,
+        batching: AdaptiveBatching | None = None,
+        metrics=None,
+    ):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}. Use one of {', '.join(OVERFLOW_POLICIES)}")
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.batching = batching
+        self.metrics = metrics
+        self.clients: dict[Any, ClientSender] = {}
+        # Close tasks of disconnected slow consumers, shared by every sender.
+        self._background: set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self.clients)
+
+    def add(self, ws, fmt: str = "json", combine: Callable[[list[Any]], Any] | None = None) -> ClientSender:
+        sender = ClientSender(
+            ws,
+            max_queue=self.max_queue,
+            overflow=self.overflow,
+            fmt=fmt,
+            batching=self.batching,
+            combine=combine,
+            metrics=self.metrics,
+            background=self._background,
+        )
+        self.clients[ws] = sender
+        sender.start()
+        return sender
+
+    async def remove(self, ws) -> ClientSender | None:
+        sender = self.clients.pop(ws, None)
+        if sender is not None:
+            await sender.close()
+        return sender
+
+    def broadcast(self, frame: Any, batchable: bool = False) -> None:
+        """Queue a frame for every client. Never blocks on a slow consumer."""
+        for sender in self.clients.values():
+            # Closed senders stay registered until their handler calls remove().
+            sender.enqueue(frame, batchable)
+
+    async def close(self) -> None:
+        for ws in list(self.clients):
+            await self.remove(ws)
+        if self._background:
+            await asyncio.gather(*self._background, return_exceptions=True)
+
+    def stats(self) -> list[dict[str, Any]]:
+        return [sender.stats() for sender in self.clients.values()]
+
+
+def add_fanout_arguments(parser) -> None:
+    """Register the shared fan-out command line options on an argparse parser."""
+    parser.add_argument(
+        "--client-queue-size",
+        type=int,
+        default=DEFAULT_QUEUE_SIZE,
+        help=f"Per-client outbound queue length in frames (default: {DEFAULT_QUEUE_SIZE})",
+    )
+    parser.add_argument(
+        "--overflow-policy",
+        choices=OVERFLOW_POLICIES,
+        default=OVERFLOW_DROP_OLDEST,
+        help=f"What to do when a client's queue is full (default: {OVERFLOW_DROP_OLDEST})",
+    )
+    parser.add_argument(
+        "--batch-threshold",
+        type=float,
+        default=DEFAULT_BATCH_THRESHOLD,
+        help=f"Events/s above which frames are coalesced, 0 to never batch (default: {DEFAULT_BATCH_THRESHOLD:g})",
+    )
+    parser.add_argument(
+        "--batch-window-ms",
+        type=int,
+        default=DEFAULT_BATCH_WINDOW_MS,
+        help=f"How long events are collected into one frame during bursts (default: {DEFAULT_BATCH_WINDOW_MS})",
+    )
+    parser.add_argument(
+        "--batch-max-events",
+        type=int,
+        default=DEFAULT_BATCH_MAX_EVENTS,
+        help=f"Maximum events per coalesced frame (default: {DEFAULT_BATCH_MAX_EVENTS})",
+    )
+
+
+def create_batching(args) -> AdaptiveBatching | None:
+    """AdaptiveBatching matching the command line options, or None when disabled."""
+    if args.batch_threshold <= 0:
+        return None
+    return AdaptiveBatching(args.batch_threshold, args.batch_window_ms / 1000.0, args.batch_max_events)
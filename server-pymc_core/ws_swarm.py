@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+"""
+WebSocket client swarm: connects N clients to a packet stream and reports
+end-to-end latency (client receive time minus the event's server receive
+"ts", so run it on the server host) and per-client losses.
+
+    python3 ws_swarm.py --url ws://localhost:8080/ws --clients 100 --duration 60
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+from typing import Any
+
+import websockets
+
+from wire_format import SUBPROTOCOL_BINARY, decode_binary_frame
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger("ws_swarm")
+
+
+def percentile(sorted_values: list[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class SwarmClient:
+    def __init__(self, index: int):
+        self.index = index
+        self.events = 0
+        self.frames = 0
+        self.latencies: list[float] = []
+        self.connected = False
+        self.close_code: int | None = None
+        self.error: str | None = None
+
+    def record(self, events: list[dict[str, Any]], received_at: float) -> None:
+        for event in events:
+            ts = event.get("ts")
+            # Skip control messages; dedup "repeat" updates are events too.
+            if ts is None or event.get("type", "repeat") != "repeat":
+                continue
+            self.events += 1
+            self.latencies.append(received_at - ts)
+
+
+def _frame_events(message: str | bytes) -> list[dict[str, Any]]:
+    if isinstance(message, bytes):
+        return decode_binary_frame(message)
+    data = json.loads(message)
+    return data if isinstance(data, list) else [data]
+
+
+async def run_client(client: SwarmClient, url: str, subprotocols, deadline: float, subscribe) -> None:
+    try:
+        async with websockets.connect(url, subprotocols=subprotocols, max_size=None) as ws:
+            client.connected = True
+            if subscribe is not None:
+                await ws.send(json.dumps({"type": "subscribe", "filter": subscribe}))
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                try:
+                    message = await asyncio.wait_for(ws.recv(), remaining)
+                except asyncio.TimeoutError:
+                    return
+                client.frames += 1
+                client.record(_frame_events(message), time.time())
+    except websockets.ConnectionClosed as e:
+        client.close_code = e.rcvd.code if e.rcvd is not None else None
+    except Exception as e:
+        client.error = str(e)
+
+
+def summarize(clients: list[SwarmClient], duration: float) -> dict[str, Any]:
+    latencies = sorted(lat for c in clients for lat in c.latencies)
+    counts = [c.events for c in clients if c.connected]
+    best = max(counts, default=0)
+    return {
+        "clients": len(clients),
+        "connected": sum(c.connected for c in clients),
+        "closed_by_server": sum(c.close_code is not None for c in clients),
+        "errors": sum(c.error is not None for c in clients),
+        "events": sum(counts),
+        "events_per_client_s": round(best / duration, 2) if duration > 0 else 0.0,
+        "frames": sum(c.frames for c in clients),
+        # A client "lost" whatever the best-served client saw and it did not.
+        "lost_vs_best": sum(best - n for n in counts),
+        "min_events": min(counts, default=0),
+        "max_events": best,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p90": round(percentile(latencies, 90) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+            "max": round((latencies[-1] if latencies else 0.0) * 1000, 2),
+        },
+    }
+
+
+async def run_swarm(args: argparse.Namespace) -> dict[str, Any]:
+    url = args.url
+    if args.batch:
+        url += ("&" if "?" in url else "?") + "batch=1"
+    subprotocols = [SUBPROTOCOL_BINARY] if args.binary else None
+    subscribe = json.loads(args.subscribe) if args.subscribe else None
+
+    clients = [SwarmClient(i) for i in range(args.clients)]
+    logger.info(f"Connecting {len(clients)} clients to {url} for {args.duration:g}s")
+    start = time.time()
+    deadline = start + args.ramp + args.duration
+    tasks = []
+    for client in clients:
+        tasks.append(asyncio.create_task(run_client(client, url, subprotocols, deadline, subscribe)))
+        if args.ramp > 0:
+            await asyncio.sleep(args.ramp / len(clients))
+    await asyncio.gather(*tasks)
+    return summarize(clients, args.duration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Connect N WebSocket clients and measure latency and drops")
+    parser.add_argument("--url", default="ws://localhost:8080/ws")
+    parser.add_argument("--clients", type=int, default=10, help="Number of clients (default: 10)")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to measure (default: 30)")
+    parser.add_argument("--ramp", type=float, default=0.0, help="Seconds over which clients connect (default: 0)")
+    parser.add_argument("--binary", action="store_true", help=f"Negotiate the {SUBPROTOCOL_BINARY} format")
+    parser.add_argument("--batch", action="store_true", help="Opt JSON clients into batched frames")
+    parser.add_argument("--subscribe", default=None, help="Subscription filter JSON sent by every client")
+    args = parser.parse_args()
+
+    try:
+        summary = asyncio.run(run_swarm(args))
+    except KeyboardInterrupt:
+        return
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
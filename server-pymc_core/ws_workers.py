@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+
+"""
+Multi-process WebSocket serving: one ingest process, several fan-out workers.
+
+With --ws-workers N, server.py keeps the radio, decoding, dedup and capture
+in one process. It publishes every event once, already JSON-encoded, over a
+Unix socket. N worker processes each run the usual /ws server on the same
+port (SO_REUSEPORT, so the kernel spreads connections over them), subscribe
+to that feed and do all per-client work: filters, binary encoding,
+compression, batching, backfill and sending. A slow worker has events
+dropped at its socket; it never holds up the ingest process.
+
+Client messages a worker does not handle itself (hearings, channels, trace,
+sources, ...) are forwarded to the ingest process and the answers routed
+back to the client, and so are HTTP GETs such as /metrics. Workers report
+their clients and fan-out metrics every second, so the ingest process's
+stats log and /metrics cover every client.
+
+Feed messages, both ways:
+
+    len u32 | kind u8 | body (UTF-8; events are the JSON frame itself, the rest JSON objects)
+"""
+
+import argparse
+import asyncio
+import inspect
+import json
+import logging
+import os
+import struct
+import tempfile
+import weakref
+from multiprocessing import get_context
+from typing import Any
+
+from metrics import create_metrics
+from replay_buffer import ReplayBuffer
+from stream_server import CommandHandler, HttpHandler, PacketStreamServer
+from wire_format import encode_json, websocket_compression_options
+from ws_fanout import create_batching
+
+logger = logging.getLogger("ws_workers")
+
+MSG_HELLO = 1  # ingest -> worker: {"http": [paths]}
+MSG_EVENT = 2  # ingest -> worker: JSON event
+MSG_REPLY = 3  # ingest -> worker: {"client", "frame"} or {"client", "frames"}
+MSG_HTTP_RESPONSE = 4  # ingest -> worker: {"request", "content_type", "body"} or {"request", "error", "bad_request"}
+MSG_COMMAND = 5  # worker -> ingest: {"client", "peer", "message"}
+MSG_HTTP_REQUEST = 6  # worker -> ingest: {"request", "path", "params"}
+MSG_STATS = 7  # worker -> ingest: {"worker", "clients", "senders", "metrics"}
+
+# Bytes queued on one worker's socket before events for it are dropped.
+DEFAULT_FEED_BUFFER = 4 * 1024 * 1024
+STATS_INTERVAL = 1.0
+RECONNECT_INTERVAL = 1.0
+HTTP_TIMEOUT = 5.0
+WORKER_CHECK_INTERVAL = 1.0
+
+_HEADER = struct.Struct("<IB")
+
+
+def _pack(kind: int, body: str | bytes) -> bytes:
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    return _HEADER.pack(len(body), kind) + body
+
+
+async def _read_message(reader: asyncio.StreamReader) -> tuple[int, bytes]:
+    length, kind = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+    return kind, await reader.readexactly(length)
+
+
+def default_ipc_socket(port: int) -> str:
+    return os.path.join(tempfile.gettempdir(), f"yampa-{port}.sock")
+
+
+class WorkerLink:
+    """One connected fan-out worker, seen from the ingest process."""
+
+    def __init__(self, writer: asyncio.StreamWriter, max_buffer: int):
+        self.writer = writer
+        self.max_buffer = max_buffer
+        self.worker: int | None = None
+        self.clients: list[dict[str, Any]] = []
+        # Forwarding clients still connected to the worker, as of its stats_seq'th report.
+        self.live: set[int] = set()
+        self.stats_seq = 0
+        self.senders: dict[int, RemoteSender] = {}
+        # The last command task per client, so each client's commands run in order.
+        self.commands: dict[int, asyncio.Task] = {}
+        self.sent = 0
+        self.dropped = 0
+
+    def send(self, message: bytes, droppable: bool = False) -> bool:
+        if self.writer.is_closing():
+            return False
+        if droppable and self.writer.transport.get_write_buffer_size() > self.max_buffer:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                logger.warning(f"Fan-out worker {self.worker} is behind, dropped={self.dropped}")
+            return False
+        self.writer.write(message)
+        self.sent += 1
+        return True
+
+
+class RemoteSender:
+    """Stands in for a worker's ClientSender while the ingest process answers a forwarded command."""
+
+    def __init__(self, link: WorkerLink, client_id: int, peer: str):
+        self.link = link
+        self.client_id = client_id
+        self.peer = peer
+        self._since = link.stats_seq
+
+    @property
+    def closed(self) -> bool:
+        # Only a report sent after this client's command can tell it has gone.
+        link = self.link
+        return link.writer.is_closing() or (link.stats_seq > self._since and self.client_id not in link.live)
+
+    def enqueue(self, frame: Any, batchable: bool = False, trace=None) -> bool:
+        return self.link.send(_pack(MSG_REPLY, json.dumps({"client": self.client_id, "frame": frame})))
+
+    def enqueue_stream(self, frames) -> bool:
+        return self.link.send(_pack(MSG_REPLY, json.dumps({"client": self.client_id, "frames": list(frames)})))
+
+
+class RemoteClients:
+    """Every worker's clients, in the shape of a Broadcaster for the stats log and metrics."""
+
+    def __init__(self, links: list[WorkerLink]):
+        self._links = links
+
+    def __len__(self) -> int:
+        return sum(len(link.clients) for link in self._links)
+
+    def stats(self) -> list[dict[str, Any]]:
+        return [client for link in self._links for client in link.clients]
+
+
+class EventFeed:
+    """Ingest-process side: runs the worker processes, feeds them events and answers their requests.
+
+    Offers what server.py uses of PacketStreamServer: publish(),
+    register_command(), register_http(), broadcaster, start() and stop().
+    """
+
+    def __init__(self, args: argparse.Namespace, metrics=None, max_buffer: int = DEFAULT_FEED_BUFFER):
+        self.args = args
+        self.path = args.ipc_socket or default_ipc_socket(args.port)
+        self.workers = args.ws_workers
+        self.metrics = metrics
+        self.max_buffer = max_buffer
+        self.name = "feed"
+
+        self._links: list[WorkerLink] = []
+        self.broadcaster = RemoteClients(self._links)
+        self._commands: dict[str, CommandHandler] = {}
+        self._http_routes: dict[str, HttpHandler] = {}
+        self._server: asyncio.AbstractServer | None = None
+        self._processes: list = []
+        self._supervisor: asyncio.Task | None = None
+
+        self.published = 0
+        self.worker_restarts = 0
+
+    def register_command(self, name: str, handler: CommandHandler) -> None:
+        self._commands[name] = handler
+
+    def register_http(self, path: str, handler: HttpHandler) -> None:
+        self._http_routes[path] = handler
+
+    def publish(self, packet_json: dict[str, Any], trace=None) -> None:
+        """Send one event to every worker. Encoded once; per-client work happens in the workers."""
+        if self.metrics is not None:
+            self.metrics.observe_event(packet_json)
+        message = _pack(MSG_EVENT, encode_json(packet_json))
+        for link in self._links:
+            link.send(message, droppable=True)
+        self.published += 1
+
+    async def start(self, host: str, port: int) -> None:
+        if os.path.exists(self.path):
+            # Left over from a previous run that did not shut down cleanly.
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._serve_link, self.path)
+        logger.info(f"Event feed on {self.path}; starting {self.workers} WebSocket workers on {host}:{port}")
+        self._processes = [self._spawn(index) for index in range(self.workers)]
+        self._supervisor = asyncio.create_task(self._supervise())
+
+    def _spawn(self, index: int):
+        process = get_context("spawn").Process(
+            target=run_worker_process, args=(vars(self.args), index, os.getpid()), name=f"ws-worker-{index}"
+        )
+        process.start()
+        return process
+
+    async def _supervise(self) -> None:
+        # A worker that dies is started again; its clients reconnect to the others meanwhile.
+        while True:
+            await asyncio.sleep(WORKER_CHECK_INTERVAL)
+            for index, process in enumerate(self._processes):
+                if not process.is_alive():
+                    logger.error(f"WebSocket worker {index} exited with code {process.exitcode}; restarting")
+                    self.worker_restarts += 1
+                    self._processes[index] = self._spawn(index)
+
+    async def stop(self) -> None:
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            self._supervisor = None
+        for process in self._processes:
+            process.terminate()
+        for process in self._processes:
+            await asyncio.get_running_loop().run_in_executor(None, process.join, 5.0)
+        self._processes = []
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        for link in list(self._links):
+            link.writer.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def _serve_link(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        link = WorkerLink(writer, self.max_buffer)
+        self._links.append(link)
+        link.send(_pack(MSG_HELLO, json.dumps({"http": list(self._http_routes)})))
+        try:
+            while True:
+                kind, body = await _read_message(reader)
+                data = json.loads(body)
+                if kind == MSG_STATS:
+                    self._on_stats(link, data)
+                elif kind == MSG_COMMAND:
+                    # Handlers may wait (a query reads SQLite in an executor); the link keeps reading meanwhile.
+                    self._queue_command(link, data)
+                elif kind == MSG_HTTP_REQUEST:
+                    asyncio.create_task(self._on_http(link, data))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"Fan-out worker {link.worker} link failed: {e}")
+        finally:
+            self._links.remove(link)
+            writer.close()
+            logger.info(f"Fan-out worker {link.worker} disconnected from the feed")
+
+    def _on_stats(self, link: WorkerLink, data: dict[str, Any]) -> None:
+        if link.worker is None:
+            logger.info(f"Fan-out worker {data.get('worker')} connected to the feed")
+        link.worker = data.get("worker")
+        link.clients = data.get("clients") or []
+        link.live = set(data.get("senders") or [])
+        link.stats_seq += 1
+        for client_id in [c for c in link.senders if c not in link.live]:
+            del link.senders[client_id]
+        if self.metrics is not None and data.get("metrics"):
+            self.metrics.set_remote(link.worker, data["metrics"])
+
+    def _queue_command(self, link: WorkerLink, data: dict[str, Any]) -> None:
+        client = data.get("client")
+        task = asyncio.create_task(self._on_command(link, data, link.commands.get(client)))
+        link.commands[client] = task
+
+        def forget(done: asyncio.Task) -> None:
+            if link.commands.get(client) is done:
+                del link.commands[client]
+
+        task.add_done_callback(forget)
+
+    async def _on_command(self, link: WorkerLink, data: dict[str, Any], previous: asyncio.Task | None = None) -> None:
+        if previous is not None:
+            await asyncio.wait([previous])
+        message = data.get("message") or {}
+        sender = link.senders.get(data.get("client"))
+        if sender is None or sender.closed:
+            sender = link.senders[data.get("client")] = RemoteSender(link, data.get("client"), data.get("peer"))
+        handler = self._commands.get(message.get("type"))
+        if handler is None:
+            logger.warning(f"WS client {sender.peer} sent unknown message type: {message.get('type')}")
+            return
+        try:
+            result = handler(sender, message)
+            if result is not None:
+                await result
+        except Exception as e:
+            logger.error(f"WS command {message.get('type')} from {sender.peer} failed: {e}")
+
+    async def _on_http(self, link: WorkerLink, data: dict[str, Any]) -> None:
+        reply: dict[str, Any] = {"request": data.get("request")}
+        handler = self._http_routes.get(data.get("path"))
+        try:
+            if handler is None:
+                raise LookupError(f"no handler for {data.get('path')}")
+            result = handler(data.get("params") or {})
+            if inspect.isawaitable(result):
+                result = await result
+            reply["content_type"], reply["body"] = result
+        except ValueError as e:
+            reply["error"], reply["bad_request"] = str(e), True
+        except Exception as e:
+            reply["error"] = str(e)
+        link.send(_pack(MSG_HTTP_RESPONSE, json.dumps(reply)))
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "workers": len(self._processes),
+            "connected": len(self._links),
+            "published": self.published,
+            "dropped": sum(link.dropped for link in self._links),
+            "worker_restarts": self.worker_restarts,
+        }
+
+
+class FeedClient:
+    """Worker-process side: feeds a PacketStreamServer from the ingest process's event feed."""
+
+    def __init__(self, path: str, stream: PacketStreamServer, index: int, metrics=None, parent_pid: int | None = None):
+        self.path = path
+        self.stream = stream
+        self.index = index
+        self.metrics = metrics
+        self.parent_pid = parent_pid
+        # Set once the first HELLO has registered the forwarded HTTP paths.
+        self.ready = asyncio.Event()
+
+        self._writer: asyncio.StreamWriter | None = None
+        self._clients: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+        self._http_pending: dict[int, asyncio.Future] = {}
+        self._http_seq = 0
+
+        self.events = 0
+
+    def _parent_gone(self) -> bool:
+        return self.parent_pid is not None and os.getppid() != self.parent_pid
+
+    async def run(self) -> None:
+        """Stay subscribed to the feed, reconnecting when it drops; returns when the ingest process is gone."""
+        while not self._parent_gone():
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except OSError:
+                await asyncio.sleep(RECONNECT_INTERVAL)
+                continue
+            self._writer = writer
+            stats_task = asyncio.create_task(self._report_stats())
+            try:
+                await self._read(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                logger.warning(f"Worker {self.index} lost the event feed; reconnecting")
+            finally:
+                stats_task.cancel()
+                self._writer = None
+                for future in self._http_pending.values():
+                    future.cancel()
+                self._http_pending.clear()
+                writer.close()
+            await asyncio.sleep(RECONNECT_INTERVAL)
+
+    async def _read(self, reader: asyncio.StreamReader) -> None:
+        while True:
+            kind, body = await _read_message(reader)
+            if kind == MSG_EVENT:
+                frame = body.decode("utf-8")
+                self.stream.publish(json.loads(frame), json_frame=frame)
+                self.events += 1
+                continue
+
+            data = json.loads(body)
+            if kind == MSG_REPLY:
+                sender = self._clients.get(data.get("client"))
+                if sender is not None and "frames" in data:
+                    sender.enqueue_stream(data["frames"])
+                elif sender is not None:
+                    sender.enqueue(data.get("frame"))
+            elif kind == MSG_HTTP_RESPONSE:
+                future = self._http_pending.pop(data.get("request"), None)
+                if future is not None and not future.done():
+                    future.set_result(data)
+            elif kind == MSG_HELLO:
+                for path in data.get("http") or []:
+                    self.stream.register_http(path, lambda params, path=path: self._forward_http(path, params))
+                self.ready.set()
+
+    def _send(self, kind: int, data: dict[str, Any]) -> bool:
+        if self._writer is None or self._writer.is_closing():
+            return False
+        self._writer.write(_pack(kind, json.dumps(data, default=str)))
+        return True
+
+    def forward_command(self, sender, message: dict[str, Any]) -> None:
+        """PacketStreamServer command fallback: let the ingest process answer."""
+        self._clients[id(sender)] = sender
+        forwarded = self._send(MSG_COMMAND, {"client": id(sender), "peer": str(sender.peer), "message": message})
+        if not forwarded:
+            sender.enqueue(
+                json.dumps({"type": "error", "request": message.get("type"), "message": "ingest process unavailable"})
+            )
+
+    async def _forward_http(self, path: str, params: dict[str, list[str]]) -> tuple[str, str]:
+        self._http_seq += 1
+        future = asyncio.get_running_loop().create_future()
+        self._http_pending[self._http_seq] = future
+        if not self._send(MSG_HTTP_REQUEST, {"request": self._http_seq, "path": path, "params": params}):
+            self._http_pending.pop(self._http_seq, None)
+            raise ConnectionError("ingest process unavailable")
+        reply = await asyncio.wait_for(future, HTTP_TIMEOUT)
+        if "error" in reply:
+            raise (ValueError if reply.get("bad_request") else RuntimeError)(reply["error"])
+        return reply["content_type"], reply["body"]
+
+    async def _report_stats(self) -> None:
+        while True:
+            self._send(
+                MSG_STATS,
+                {
+                    "worker": self.index,
+                    "clients": self.stream.broadcaster.stats(),
+                    "senders": [key for key, sender in list(self._clients.items()) if not sender.closed],
+                    "metrics": self.metrics.client_snapshot() if self.metrics is not None else None,
+                },
+            )
+            await asyncio.sleep(STATS_INTERVAL)
+
+
+async def run_worker(args: argparse.Namespace, index: int, parent_pid: int | None = None) -> None:
+    replay = None
+    if args.replay_max_events > 0:
+        replay = ReplayBuffer(args.replay_max_events, args.replay_max_bytes)
+
+    # Only the fan-out families are filled in here; they are reported to the ingest process.
+    metrics = create_metrics(args)
+
+    stream = PacketStreamServer(
+        client_queue_size=args.client_queue_size,
+        overflow_policy=args.overflow_policy,
+        replay=replay,
+        backfill_chunk_size=args.backfill_chunk_size,
+        serve_options={**websocket_compression_options(args), "reuse_port": True},
+        batching=create_batching(args),
+        metrics=metrics,
+    )
+    feed = FeedClient(args.ipc_socket or default_ipc_socket(args.port), stream, index, metrics, parent_pid)
+    stream.set_command_fallback(feed.forward_command)
+
+    feed_task = asyncio.create_task(feed.run())
+    # The HTTP paths to forward must be known before the server starts.
+    await feed.ready.wait()
+    await stream.start(args.host, args.port)
+    try:
+        await feed_task
+    finally:
+        await stream.stop()
+
+
+def run_worker_process(options: dict[str, Any], index: int, parent_pid: int) -> None:
+    """Entry point of a spawned worker process."""
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    try:
+        asyncio.run(run_worker(argparse.Namespace(**options), index, parent_pid))
+    except KeyboardInterrupt:
+        pass
+
+
+def add_ws_worker_arguments(parser) -> None:
+    """Register the multi-process serving options on an argparse parser."""
+    parser.add_argument(
+        "--ws-workers",
+        type=int,
+        default=0,
+        help="Serve /ws from this many worker processes sharing the port, 0 to serve in-process (default: 0)",
+    )
+    parser.add_argument(
+        "--ipc-socket",
+        default=None,
+        help="Unix socket feeding events to the WebSocket workers (default: yampa-<port>.sock in the temp dir)",
+    )